@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import json
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressed tar archives of the world, written as a series of independently
+# compressed blocks (gzip members or zstd frames). The result is still an
+# ordinary .tar.gz/.tar.zst, but the blocks can be compressed on several
+# cores at once, and with the block index saved next to the archive a single
+# file can be extracted by seeking straight to the block it starts in.
+
+BLOCK_SIZE = 4 << 20
+
+ARCHIVE_NAMES = {
+    "gzip": "world.tar.gz",
+    "zstd": "world.tar.zst",
+}
+INDEX_NAME = "index.json.gz"
+
+
+def _compressor(compression, level):
+    if compression == "gzip":
+        def compress(data):
+            # wbits=31 makes a complete gzip member
+            c = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return c.compress(data) + c.flush()
+        return compress
+
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard module")
+        # One compressor per thread, they aren't thread safe
+        compressors = {}
+
+        def compress(data):
+            ident = threading.get_ident()
+            if ident not in compressors:
+                compressors[ident] = zstandard.ZstdCompressor(level=level)
+            return compressors[ident].compress(data)
+        return compress
+
+    raise ValueError("Unknown compression " + compression)
+
+
+# Raise if archives can't be written with compression here, so that a bad
+# config shows up at startup rather than at the first backup
+def check_compression(compression):
+    _compressor(compression, 1)
+
+
+def _decompressing_reader(compression, f):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard module")
+        return zstandard.ZstdDecompressor().stream_reader(
+            f, read_across_frames=True)
+    raise ValueError("Unknown compression " + compression)
+
+
+# File-like object for tarfile to write into. Cuts the stream into blocks,
+# compresses them on a thread pool and writes them to out in order.
+class _BlockWriter:
+    def __init__(self, out, compress, threads):
+        self._out = out
+        self._compress = compress
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads)
+        # Don't let the reader get too far ahead of the compressors
+        self._max_pending = threads * 2
+        self._pending = collections.deque()
+        self._buf = bytearray()
+        self._offset = 0
+        self._out_offset = 0
+        # (compressed offset, uncompressed offset) of every block
+        self.blocks = []
+
+    def tell(self):
+        return self._offset
+
+    def write(self, data):
+        self._buf += data
+        self._offset += len(data)
+        while len(self._buf) >= BLOCK_SIZE:
+            self._submit(bytes(self._buf[:BLOCK_SIZE]))
+            del self._buf[:BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block):
+        uncompressed_offset = self._offset - len(self._buf)
+        self._pending.append((uncompressed_offset,
+                              self._executor.submit(self._compress, block)))
+        while len(self._pending) > self._max_pending:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        uncompressed_offset, future = self._pending.popleft()
+        data = future.result()
+        self.blocks.append((self._out_offset, uncompressed_offset))
+        self._out.write(data)
+        self._out_offset += len(data)
+
+    def close(self):
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._write_oldest()
+        self._executor.shutdown()
+
+    # Give up on the blocks not written yet
+    def abort(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+
+    @property
+    def compressed_size(self):
+        return self._out_offset
+
+
+def _round_up(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * \
+        tarfile.BLOCKSIZE
+
+
+# Write src as a compressed tar into the directory dst (which must not
+# exist), along with its index. progress(files_done, files_total,
+# bytes_done, bytes_total) is called from this thread after every file.
+# Returns the compressed size. If it fails, dst is removed again.
+def write_archive(src, dst, compression="gzip", level=6, threads=4,
+                  progress=None):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        entries.append((dirpath, rel_dir, True))
+        for filename in filenames:
+            entries.append((os.path.join(dirpath, filename),
+                            os.path.normpath(os.path.join(rel_dir, filename)),
+                            False))
+
+    files_total = sum(1 for _, _, is_dir in entries if not is_dir)
+    bytes_total = sum(os.path.getsize(path)
+                      for path, _, is_dir in entries if not is_dir)
+    files_done = 0
+    bytes_done = 0
+
+    os.makedirs(dst)
+    index = {"compression": compression, "dirs": [], "files": {}}
+
+    try:
+        with open(os.path.join(dst, ARCHIVE_NAMES[compression]),
+                  "wb") as out:
+            writer = _BlockWriter(out, _compressor(compression, level),
+                                  threads)
+            try:
+                with tarfile.open(fileobj=writer, mode="w",
+                                  format=tarfile.PAX_FORMAT) as tar:
+                    for path, rel_path, is_dir in entries:
+                        tarinfo = tar.gettarinfo(path, rel_path)
+                        if is_dir:
+                            tar.addfile(tarinfo)
+                            index["dirs"].append(rel_path)
+                            continue
+
+                        with open(path, "rb") as f:
+                            tar.addfile(tarinfo, f)
+                        index["files"][rel_path] = {
+                            "offset": tar.offset - _round_up(tarinfo.size),
+                            "size": tarinfo.size,
+                            "mtime": tarinfo.mtime,
+                            "mode": tarinfo.mode,
+                        }
+
+                        files_done += 1
+                        bytes_done += tarinfo.size
+                        if progress:
+                            progress(files_done, files_total, bytes_done,
+                                     bytes_total)
+                writer.close()
+            except BaseException:
+                writer.abort()
+                raise
+
+        index["blocks"] = writer.blocks
+        with gzip.open(os.path.join(dst, INDEX_NAME), "wt") as f:
+            json.dump(index, f, separators=(',', ':'))
+    except BaseException:
+        # Without its index it's no use, and it mustn't look like a backup
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+    return writer.compressed_size
+
+
+def _load_index(archive_dir):
+    try:
+        with gzip.open(os.path.join(archive_dir, INDEX_NAME), "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError("{} has no {}; not an archive backup, or not a "
+                         "finished one".format(archive_dir, INDEX_NAME))
+
+
+def _matches(rel_path, paths):
+    return any(rel_path == x or rel_path.startswith(x + os.sep)
+               for x in paths)
+
+
+# Extract files from the archive in archive_dir into dst. If paths is given,
+# only files at or below those paths (e.g. "DIM-1" or
+# "region/r.0.0.mca") are extracted, decompressing only the blocks they are
+# in. Returns the number of files extracted.
+def extract(archive_dir, dst, paths=None):
+    index = _load_index(archive_dir)
+    compression = index["compression"]
+    block_offsets = [uncompressed for _, uncompressed in index["blocks"]]
+
+    if paths:
+        paths = [os.path.normpath(x) for x in paths]
+    wanted = sorted((entry["offset"], rel_path, entry)
+                    for rel_path, entry in index["files"].items()
+                    if not paths or _matches(rel_path, paths))
+
+    for rel_dir in index["dirs"]:
+        if not paths or _matches(rel_dir, paths):
+            os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+
+    archive_path = os.path.join(archive_dir, ARCHIVE_NAMES[compression])
+    with open(archive_path, "rb") as f:
+        reader = None
+        position = None
+        for offset, rel_path, entry in wanted:
+            block = bisect.bisect_right(block_offsets, offset) - 1
+            # Carry on reading if the file starts in the block we're in or
+            # the next one, otherwise seek to the block it starts in
+            if (reader is None or position > offset or
+                    block > bisect.bisect_right(block_offsets, position)):
+                f.seek(index["blocks"][block][0])
+                reader = _decompressing_reader(compression, f)
+                position = block_offsets[block]
+
+            while position < offset:
+                skipped = len(reader.read(min(offset - position, 1 << 20)))
+                if not skipped:
+                    raise EOFError("Archive truncated")
+                position += skipped
+
+            out_path = os.path.join(dst, rel_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            left = entry["size"]
+            with open(out_path, "wb") as out:
+                while left:
+                    data = reader.read(min(left, 1 << 20))
+                    if not data:
+                        raise EOFError("Archive truncated")
+                    out.write(data)
+                    left -= len(data)
+            position += entry["size"]
+
+            os.chmod(out_path, entry["mode"])
+            os.utime(out_path, (entry["mtime"], entry["mtime"]))
+
+    return len(wanted)
+
+
+def usage():
+    print("Usage: {} restore backups/timestamp dest [path ...]".format(
+        sys.argv[0]))
+    print("       {} list backups/timestamp".format(sys.argv[0]))
+
+
+def main():
+    if len(sys.argv) < 3:
+        usage()
+        return
+
+    try:
+        if sys.argv[1] == "restore":
+            if len(sys.argv) < 4:
+                usage()
+                return
+            extracted = extract(sys.argv[2], sys.argv[3], sys.argv[4:])
+            print("Extracted {} files".format(extracted))
+
+        elif sys.argv[1] == "list":
+            index = _load_index(sys.argv[2])
+            for rel_path, entry in sorted(index["files"].items()):
+                print("{:>12} {}".format(entry["size"], rel_path))
+
+        else:
+            usage()
+    except ValueError as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
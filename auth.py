@@ -0,0 +1,129 @@
+import binascii
+import collections
+import json
+import os
+import time
+
+import ed25519
+
+
+# Don't look at the config file more often than this (seconds)
+RELOAD_CHECK_INTERVAL = 2
+
+
+# The users allowed to run commands and their parsed verifying keys, from
+# config["users"] ({nick: base64 key}). Keys are parsed once, and again only
+# when the config file changes.
+class KeyCache:
+    _config_path = None
+    # nick -> ed25519.VerifyingKey, or None if the key didn't parse
+    _keys = None
+    _mtime = None
+    _checked_at = 0
+
+    def __init__(self, users, config_path=None):
+        self._config_path = config_path
+        self._keys = self._parse(users)
+        if config_path:
+            self._mtime = self._stat()
+        self._checked_at = time.monotonic()
+
+    def _stat(self):
+        try:
+            return os.stat(self._config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _parse(self, users):
+        keys = {}
+        for nick, vk_enc in users.items():
+            try:
+                keys[nick] = ed25519.VerifyingKey(vk_enc, encoding='base64')
+            except (AssertionError, ValueError, binascii.Error):
+                print("Bad verifying key for {}".format(nick))
+                keys[nick] = None
+        return keys
+
+    # Pick up changes to the config file. A config that doesn't load keeps
+    # the keys we have.
+    def maybe_reload(self):
+        now = time.monotonic()
+        if (not self._config_path or
+                now - self._checked_at < RELOAD_CHECK_INTERVAL):
+            return
+        self._checked_at = now
+
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self._config_path, 'r') as f:
+                users = json.load(f)["users"]
+        except (OSError, ValueError, KeyError) as e:
+            print("Not reloading users: {}".format(e))
+            return
+        self._keys = self._parse(users)
+        print("Reloaded {} users".format(len(self._keys)))
+
+    def __contains__(self, nick):
+        return nick in self._keys
+
+    def get(self, nick):
+        return self._keys.get(nick)
+
+
+# Outstanding nonces, per user, so that admins don't invalidate each
+# other's and can ask for several before signing. A nonce is good for one
+# command within ttl seconds of being handed out. Asking for more than
+# pool_size drops the oldest.
+class NoncePool:
+    _random = None
+    _pool_size = None
+    _ttl = None
+    # nick -> OrderedDict of nonce -> time handed out, oldest first
+    _pools = None
+
+    def __init__(self, random, pool_size=8, ttl=300):
+        self._random = random
+        self._pool_size = pool_size
+        self._ttl = ttl
+        self._pools = {}
+
+    def _expire(self, nick, now):
+        pool = self._pools.get(nick)
+        if pool is None:
+            return None
+        while pool and next(iter(pool.values())) <= now - self._ttl:
+            pool.popitem(last=False)
+        if not pool:
+            del self._pools[nick]
+            return None
+        return pool
+
+    def issue(self, nick):
+        now = time.monotonic()
+        self._expire(nick, now)
+        pool = self._pools.setdefault(nick, collections.OrderedDict())
+        while len(pool) >= self._pool_size:
+            pool.popitem(last=False)
+        nonce = self._random.read(16)
+        pool[nonce] = now
+        return nonce
+
+    # The user's live nonces, newest first
+    def outstanding(self, nick):
+        pool = self._expire(nick, time.monotonic())
+        if pool is None:
+            return []
+        return list(reversed(pool))
+
+    # Use up a nonce. False if it isn't (or is no longer) outstanding.
+    def consume(self, nick, nonce):
+        pool = self._expire(nick, time.monotonic())
+        if pool is None or nonce not in pool:
+            return False
+        del pool[nonce]
+        if not pool:
+            del self._pools[nick]
+        return True
@@ -0,0 +1,412 @@
+import archive
+import asyncio
+import concurrent.futures
+import errno
+import os
+import regionstore
+import shutil
+import time
+
+
+# Walk the source tree, create the matching directories under dst and return
+# the list of files that need copying. If link_dest is given, files that look
+# unchanged (same size and mtime) compared to the copy in link_dest are
+# hard-linked from there instead, like rsync --link-dest. Runs in a worker
+# thread.
+def _scan_tree(src, dst, link_dest=None):
+    files = []
+    dirs = []
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        dst_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        os.makedirs(dst_dir)
+        dirs.append((dirpath, dst_dir))
+
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.join(dst_dir, filename)
+            try:
+                src_stat = os.stat(src_file)
+            except OSError:
+                # Vanished between listdir and stat (e.g. session.lock)
+                continue
+
+            prev_file = None
+            if link_dest:
+                prev_file = os.path.normpath(
+                    os.path.join(link_dest, rel_dir, filename))
+                try:
+                    prev_stat = os.stat(prev_file)
+                    if (prev_stat.st_size != src_stat.st_size or
+                            prev_stat.st_mtime_ns != src_stat.st_mtime_ns):
+                        prev_file = None
+                except OSError:
+                    prev_file = None
+
+            files.append((src_file, dst_file, src_stat.st_size, prev_file))
+
+    return files, dirs
+
+
+# Returns (bytes in the snapshot, bytes actually written)
+def _copy_file(src, dst, prev=None):
+    if prev:
+        try:
+            os.link(prev, dst)
+            return os.path.getsize(dst), 0
+        except OSError as exception:
+            # Too many links or a filesystem without hard links; just copy
+            if exception.errno not in (errno.EMLINK, errno.EPERM,
+                                       errno.EXDEV, errno.ENOTSUP):
+                raise
+
+    shutil.copy2(src, dst)
+    size = os.path.getsize(dst)
+    return size, size
+
+
+# Like _scan_tree but only lists the files (as paths relative to src, with
+# sizes) and directories without creating anything
+def _list_tree(src):
+    files = []
+    dirs = []
+
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        dirs.append(rel_dir)
+
+        for filename in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dir, filename))
+            try:
+                size = os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            files.append((rel_path, size))
+
+    return files, dirs
+
+
+def _copy_dir_stats(dirs):
+    # Deepest first so that fixing up a parent doesn't get undone
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
+
+
+class BackupEngine:
+    _loop = None
+    _executor = None
+    _progress_interval = None
+
+    def __init__(self, loop, workers=4, progress_interval=10):
+        self._loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._progress_interval = progress_interval
+
+    def run(self, func, *args):
+        return self._loop.run_in_executor(self._executor, func, *args)
+
+    # Run func(*args) for every args tuple in jobs on the worker pool. Each
+    # call must return a tuple starting with (bytes in the snapshot, bytes
+    # actually written). progress is called on the event loop as
+    # progress(files_done, files_total, bytes_done, bytes_total)
+    # Returns the results in the same order as jobs.
+    async def _run_jobs(self, func, jobs, bytes_total, progress=None):
+        files_total = len(jobs)
+        files_done = 0
+        bytes_done = 0
+        last_report = time.monotonic()
+
+        futures = [self.run(func, *args) for args in jobs]
+
+        try:
+            for future in asyncio.as_completed(futures, loop=self._loop):
+                result = await future
+                bytes_done += result[0]
+                files_done += 1
+
+                now = time.monotonic()
+                if progress and now - last_report >= self._progress_interval:
+                    last_report = now
+                    progress(files_done, files_total, bytes_done, bytes_total)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        if progress:
+            progress(files_done, files_total, bytes_done, bytes_total)
+
+        return [future.result() for future in futures]
+
+    # Copy the tree at src to dst (which must not exist) using the worker
+    # pool, hard-linking unchanged files from link_dest if given.
+    # Returns the number of bytes actually written.
+    async def copy_tree(self, src, dst, progress=None, link_dest=None):
+        files, dirs = await self.run(_scan_tree, src, dst, link_dest)
+
+        bytes_total = sum(size for _, _, size, _ in files)
+        jobs = [(src_file, dst_file, prev_file)
+                for src_file, dst_file, _, prev_file in files]
+        results = await self._run_jobs(_copy_file, jobs, bytes_total,
+                                       progress)
+
+        await self.run(_copy_dir_stats, dirs)
+
+        return sum(written for _, written in results)
+
+    # Store the tree at src as snapshot name in a regionstore.ChunkStore.
+    # Files that are unchanged since snapshot prev_name are not read again.
+    # Returns the number of bytes actually written.
+    async def chunk_snapshot(self, store, src, name, progress=None,
+                             prev_name=None):
+        files, dirs = await self.run(_list_tree, src)
+
+        prev_files = {}
+        if prev_name:
+            prev_manifest = await self.run(store.load_manifest, prev_name)
+            if prev_manifest:
+                prev_files = prev_manifest["files"]
+
+        bytes_total = sum(size for _, size in files)
+        jobs = [(os.path.join(src, rel_path), prev_files.get(rel_path))
+                for rel_path, _ in files]
+        results = await self._run_jobs(store.store_file, jobs, bytes_total,
+                                       progress)
+
+        manifest = {
+            "dirs": dirs,
+            "files": {rel_path: entry
+                      for (rel_path, _), (_, _, entry) in zip(files, results)},
+        }
+        await self.run(store.write_manifest, name, manifest)
+
+        return sum(written for _, written, _ in results)
+
+    # Write src as a compressed tar into the directory dst, see
+    # archive.write_archive. Returns the compressed size.
+    async def archive_tree(self, src, dst, progress=None, compression="gzip",
+                           level=6, threads=4):
+        last_report = time.monotonic()
+
+        # Called on the worker thread
+        def report(files_done, files_total, bytes_done, bytes_total):
+            nonlocal last_report
+            now = time.monotonic()
+            if (progress and (now - last_report >= self._progress_interval or
+                              files_done == files_total)):
+                last_report = now
+                self._loop.call_soon_threadsafe(
+                    progress, files_done, files_total, bytes_done, bytes_total)
+
+        return await self.run(archive.write_archive, src, dst, compression,
+                              level, threads, report)
+
+    async def remove_tree(self, path):
+        await self.run(shutil.rmtree, path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class SaveTimeout(Exception):
+    pass
+
+
+# Drives the server through save-off, save-all flush and save-on so that
+# nothing writes to the world while a backup reads it:
+#
+#   idle -> save-off -> flushing -> paused -> save-on -> idle
+#
+# The server's replies are picked out by a classifier.LineClassifier, which
+# must be set up to call feed() for each of EVENTS.
+class SaveCoordinator:
+    IDLE = "idle"
+    SAVE_OFF = "save-off"
+    FLUSHING = "flushing"
+    PAUSED = "paused"
+    SAVE_ON = "save-on"
+
+    # Event name -> pattern for the server's INFO lines
+    EVENTS = {
+        "save_off": (b"(?:Automatic saving is now disabled|"
+                     b"Turned off world auto-saving|"
+                     b"Saving is already turned off)"),
+        "saved": b"(?:Saved the game|Saved the world|Save complete)",
+        "save_on": (b"(?:Automatic saving is now enabled|"
+                    b"Turned on world auto-saving|"
+                    b"Saving is already turned on)"),
+    }
+
+    _EXPECT = {
+        SAVE_OFF: "save_off",
+        FLUSHING: "saved",
+        SAVE_ON: "save_on",
+    }
+
+    _loop = None
+    _send = None
+    _timeout = None
+    _event = None
+    state = IDLE
+    paused_at = None
+    last_pause = None
+
+    # send(command) writes a command line to the server
+    def __init__(self, loop, send, timeout=60):
+        self._loop = loop
+        self._send = send
+        self._timeout = timeout
+        self._event = asyncio.Event(loop=loop)
+
+    @property
+    def idle(self):
+        return self.state == self.IDLE
+
+    def feed(self, event):
+        if self._EXPECT.get(self.state) == event:
+            self._event.set()
+
+    async def _step(self, state, command):
+        self.state = state
+        self._event.clear()
+        self._send(command)
+        try:
+            await asyncio.wait_for(self._event.wait(), self._timeout,
+                                   loop=self._loop)
+        except asyncio.TimeoutError:
+            raise SaveTimeout(
+                "No reply to '{}' after {}s".format(command, self._timeout))
+
+    # Stop autosave and flush everything to disk. On return the world files
+    # are consistent until resume() is called. resume() must be called even
+    # if this raises.
+    async def pause(self):
+        self.paused_at = time.monotonic()
+        await self._step(self.SAVE_OFF, "save-off")
+        await self._step(self.FLUSHING, "save-all flush")
+        self.state = self.PAUSED
+
+    # Turn autosave back on without waiting for the server to confirm
+    def abort(self):
+        if self.state != self.IDLE:
+            self._send("save-on")
+            self.state = self.IDLE
+            self.last_pause = time.monotonic() - self.paused_at
+
+    # Turn autosave back on. Returns how long it was off, in seconds.
+    async def resume(self):
+        try:
+            await self._step(self.SAVE_ON, "save-on")
+        finally:
+            self.state = self.IDLE
+            self.last_pause = time.monotonic() - self.paused_at
+        return self.last_pause
+
+
+# Size and mtime of every region file in the world. Comparing two of these
+# tells us whether the server wrote any chunks in between. Runs in a worker
+# thread.
+def region_index(world):
+    index = {}
+    for dirpath, dirnames, filenames in os.walk(world):
+        for filename in filenames:
+            if not filename.endswith(regionstore.REGION_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            index[path] = (st.st_size, st.st_mtime_ns)
+    return index
+
+
+# Decides when the next backup should happen. Backups happen every interval
+# seconds, or every busy_interval seconds once at least busy_players were
+# online at the same time since the last one. If nobody was online and no
+# region file changed since the last backup, it is skipped.
+class BackupScheduler:
+    _interval = None
+    _busy_interval = None
+    _busy_players = None
+    _online = None
+    _peak_players = 0
+    _last_backup = None
+    _last_index = None
+
+    def __init__(self, interval, busy_interval=None, busy_players=4):
+        self._interval = interval
+        self._busy_interval = busy_interval or interval
+        self._busy_players = busy_players
+        self._online = set()
+        self._last_backup = time.monotonic()
+
+    def player_joined(self, player):
+        self._online.add(player)
+        self._peak_players = max(self._peak_players, len(self._online))
+
+    def player_left(self, player):
+        self._online.discard(player)
+
+    def server_stopped(self):
+        self._online.clear()
+
+    @property
+    def players_online(self):
+        return len(self._online)
+
+    @property
+    def busy(self):
+        return self._peak_players >= self._busy_players
+
+    # Seconds until the next backup is due (may be negative)
+    def time_left(self):
+        interval = self._busy_interval if self.busy else self._interval
+        return self._last_backup + interval - time.monotonic()
+
+    # Whether a backup would be a waste. index is the current region_index.
+    def is_idle(self, index):
+        return (self._peak_players == 0 and self._last_index is not None and
+                index == self._last_index)
+
+    # Start counting again from now. index is the region_index taken while
+    # the world was flushed for the backup (or None if we don't have one).
+    def reset(self, index=None):
+        self._last_backup = time.monotonic()
+        # Anyone still online counts towards the next interval
+        self._peak_players = len(self._online)
+        if index is not None:
+            self._last_index = index
+
+
+PERIOD_FORMATS = {
+    "hourly": "%Y%m%d%H",
+    "daily": "%Y%m%d",
+    "weekly": "%G%V",
+    "monthly": "%Y%m",
+}
+
+
+# Given backup names (%Y%m%d%H%M%S timestamps, oldest first) pick the ones
+# to keep. retention maps "last" (keep the N newest) and the keys of
+# PERIOD_FORMATS (keep the newest backup of each of the N most recent
+# hours/days/...) to counts. The newest backup is always kept.
+def backups_to_keep(names, retention):
+    newest_first = list(reversed(names))
+    keep = set(newest_first[:max(retention.get("last", 0), 1)])
+
+    for tier, period_format in PERIOD_FORMATS.items():
+        count = retention.get(tier, 0)
+        periods = set()
+        for name in newest_first:
+            if len(periods) >= count:
+                break
+            period = time.strftime(period_format,
+                                   time.strptime(name, "%Y%m%d%H%M%S"))
+            if period not in periods:
+                periods.add(period)
+                keep.add(name)
+
+    return keep
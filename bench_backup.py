@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import archive
+import asyncio
+import backup
+import ircqueue
+import main as wrapper
+import metrics
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+MODES = ("copy", "link", "archive", "chunks")
+
+
+# Something for the backups to copy: count files of up to 64 KiB in a few
+# directories
+def make_world(path, rng, count=200):
+    for i in range(count):
+        directory = os.path.join(path, "dir{}".format(i % 5))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "{}.dat".format(i)), "wb") as f:
+            f.write(os.urandom(rng.randint(0, 64 * 1024)))
+
+
+def make_instance(loop, root, mode):
+    config = {
+        "directory": root,
+        "backup_mode": mode,
+        "backup_interval": 3600,
+        "backup_threads": 4,
+        "irc_channel": "#bench",
+    }
+    irc_queue = ircqueue.OutboundQueue(loop, lambda *args: None)
+    engine = backup.BackupEngine(loop, config["backup_threads"])
+    backup_limit = asyncio.Semaphore(1, loop=loop)
+    instance = wrapper.MinecraftServerWrapper(
+        "bench", config, loop, irc_queue, engine, backup_limit,
+        metrics.Registry())
+    return instance, engine
+
+
+class InjectedFailure(Exception):
+    pass
+
+
+# Make func fail on its calls after the first after, from any thread
+def failing_after(func, after):
+    calls = 0
+
+    def wrapped(*args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls > after:
+            raise InjectedFailure()
+        return func(*args, **kwargs)
+    return wrapped
+
+
+# Break the backup in mode part of the way through
+def inject_failure(instance, mode, after):
+    if mode in ("copy", "link"):
+        backup._copy_file = failing_after(backup._copy_file, after)
+    elif mode == "archive":
+        write_archive = archive.write_archive
+
+        def failing_write_archive(src, dst, compression, level, threads,
+                                  progress):
+            return write_archive(src, dst, compression, level, threads,
+                                 failing_after(progress, after))
+        archive.write_archive = failing_write_archive
+    else:
+        store = instance._chunk_store
+        store.store_file = failing_after(store.store_file, after)
+
+
+# A backup that fails part of the way through must leave nothing that
+# list_backups() would take for a backup, and no partial copy once the
+# next one starts. Returns the number of problems.
+async def check_mode(loop, mode, rng):
+    problems = 0
+    saved = backup._copy_file, archive.write_archive
+    root = tempfile.mkdtemp()
+    engine = None
+    try:
+        make_world(os.path.join(root, "world"), rng)
+        instance, engine = make_instance(loop, root, mode)
+        await instance.do_backup()
+        good = instance.list_backups()
+
+        # Backups are named by the second they start in
+        await asyncio.sleep(1.1)
+        inject_failure(instance, mode, rng.randint(0, 100))
+        try:
+            await instance.do_backup()
+            problems += 1
+            print("{}: FAILED BACKUP SUCCEEDED".format(mode))
+        except InjectedFailure:
+            pass
+        backup._copy_file, archive.write_archive = saved
+
+        if instance.list_backups() != good:
+            problems += 1
+            print("{}: FAILED BACKUP LISTED {}".format(
+                mode, instance.list_backups()))
+
+        await asyncio.sleep(1.1)
+        instance._chunk_store.__dict__.pop("store_file", None)
+        await instance.do_backup()
+        backups = instance.list_backups()
+        partial = [x for x in os.listdir(instance.path("backups"))
+                   if x.endswith(wrapper.PARTIAL_BACKUP_SUFFIX)]
+        if len(backups) != len(good) + 1 or partial:
+            problems += 1
+            print("{}: AFTER THE NEXT BACKUP {} {}".format(
+                mode, backups, partial))
+    finally:
+        backup._copy_file, archive.write_archive = saved
+        if engine:
+            engine.shutdown()
+        shutil.rmtree(root)
+    return problems
+
+
+async def check(loop, count):
+    rng = random.Random(1)
+    problems = 0
+    for _ in range(count):
+        for mode in MODES:
+            problems += await check_mode(loop, mode, rng)
+    print("{} failed backups in each mode checked, {} problems".format(
+        count, problems))
+    return problems
+
+
+async def bench(loop, count):
+    rng = random.Random(2)
+    for mode in MODES:
+        root = tempfile.mkdtemp()
+        try:
+            make_world(os.path.join(root, "world"), rng, count)
+            instance, engine = make_instance(loop, root, mode)
+            for name in ("first", "second"):
+                started = time.perf_counter()
+                await instance.do_backup()
+                print("{:8} {:6} backup {:>6.2f} s".format(
+                    mode, name, time.perf_counter() - started))
+                await asyncio.sleep(1.1)
+            engine.shutdown()
+        finally:
+            shutil.rmtree(root)
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    loop = asyncio.get_event_loop()
+    if mode == "check":
+        problems = loop.run_until_complete(check(loop, count))
+        loop.close()
+        sys.exit(1 if problems else 0)
+    elif mode == "bench":
+        loop.run_until_complete(bench(loop, count * 1000))
+        loop.close()
+    else:
+        print("Usage: {} [check|bench] [count]".format(sys.argv[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import backup
+import classifier
+import glob
+import gzip
+import main
+import re
+import sys
+import time
+
+
+# Lines in roughly the mix a busy modded server prints
+SYNTHETIC_LINES = [
+    b"[12:34:56] [Server thread/INFO]: <Steve> hello everyone\n",
+    b"[12:34:56] [Server thread/INFO]: <Alex> !is anyone on irc\n",
+    b"[12:34:56] [Server thread/INFO]: Steve[/127.0.0.1:51234] logged in "
+    b"with entity id 123 at (1.5, 64.0, -3.2)\n",
+    b"[12:34:56] [Server thread/INFO]: Steve lost connection: Disconnected\n",
+    b"[12:34:56] [Server thread/INFO]: Alex was slain by Zombie\n",
+    b"[12:34:56] [Server thread/INFO]: Alex has made the advancement "
+    b"[Stone Age]\n",
+    b"[12:34:56] [Server thread/INFO]: Saved the game\n",
+    b"[12:34:56] [Server thread/WARN]: Can't keep up! Is the server "
+    b"overloaded? Running 2345ms or 46 ticks behind\n",
+] + [
+    b"[12:34:56] [Server thread/INFO]: [SomePlugin] Tick handler took "
+    b"12ms for world DIM0 entity batch 42\n",
+    b"[12:34:56] [Server thread/WARN]: [SomeMod] Skipping BlockEntity with "
+    b"id minecraft:chest at 10, 64, 10\n",
+    b"\tat net.minecraft.server.MinecraftServer.run(SourceFile:123)\n",
+] * 10
+
+
+def load_corpus(paths):
+    lines = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            lines.extend(f.readlines())
+    return lines
+
+
+def handler(*args):
+    pass
+
+
+# The events the classifier handles, as (name, pattern, level)
+def events():
+    events = [(name, pattern, "INFO")
+              for name, pattern in backup.SaveCoordinator.EVENTS.items()]
+    events += [
+        ("chat", main.SERVER_CHAT_RE, "INFO"),
+        ("join", main.SERVER_JOIN_RE, "INFO"),
+        ("leave", main.SERVER_LEAVE_RE, "INFO"),
+        ("death", main.SERVER_DEATH_RE, "INFO"),
+        ("advancement", main.SERVER_ADVANCEMENT_RE, "INFO"),
+        ("lag", main.SERVER_LAG_RE, "WARN"),
+    ]
+    return events
+
+
+# What the stdout loop did before: decode, then one search per pattern
+def legacy(lines):
+    server_chat_re = re.compile(
+        "INFO\]: <([A-Za-z0-9_]+)> (.*)$")
+    server_join_re = re.compile(
+        "INFO\]: ([A-Za-z0-9_]+) ?\[.*\] logged in")
+    server_leave_re = re.compile(
+        "INFO\]: ([A-Za-z0-9_]+) lost connection")
+    saving_re_1 = re.compile("Save complete.")
+    saving_re_2 = re.compile("Saved the world")
+
+    matched = 0
+    for output_line in lines:
+        output_line = output_line.decode('utf-8')
+        if (saving_re_1.search(output_line) or
+                saving_re_2.search(output_line)):
+            matched += 1
+        chat_match = server_chat_re.search(output_line)
+        if chat_match:
+            handler(chat_match.group(1), chat_match.group(2))
+            matched += 1
+        join_match = server_join_re.search(output_line)
+        if join_match:
+            handler(join_match.group(1))
+            matched += 1
+        leave_match = server_leave_re.search(output_line)
+        if leave_match:
+            handler(leave_match.group(1))
+            matched += 1
+    return matched
+
+
+# The same approach stretched to cover every event the classifier knows
+def legacy_all(lines):
+    regexes = [re.compile(level + "\\]: " + pattern.decode('ascii'))
+               for _, pattern, level in events()]
+
+    matched = 0
+    for output_line in lines:
+        output_line = output_line.decode('utf-8')
+        for regex in regexes:
+            match = regex.search(output_line)
+            if match:
+                handler(*match.groups())
+                matched += 1
+    return matched
+
+
+def classified(lines):
+    c = classifier.LineClassifier()
+    for name, pattern, level in events():
+        c.register(name, pattern, handler, level)
+
+    matched = 0
+    dispatch = c.dispatch
+    for output_line in lines:
+        if dispatch(output_line):
+            matched += 1
+    return matched
+
+
+def bench(name, func, lines, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        matched = func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:12} {:>12.0f} lines/s  ({} matched)".format(
+        name, len(lines) / best, matched))
+
+
+def main_():
+    paths = sys.argv[1:]
+    if not paths:
+        paths = glob.glob("logs/*.log.gz") + glob.glob("logs/latest.log")
+
+    lines = load_corpus(paths)
+    if not lines:
+        print("No logs found, using a synthetic corpus")
+        lines = SYNTHETIC_LINES * 2000
+
+    print("{} lines".format(len(lines)))
+    bench("legacy", legacy, lines, 5)
+    bench("legacy-all", legacy_all, lines, 5)
+    bench("classifier", classified, lines, 5)
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import ircformat
+import random
+import string
+import sys
+import time
+
+
+CONTROL_CODES = ('\x00\x01\x02\x03\x04\x05\x06\x07'
+                 '\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F'
+                 '\x10\x11\x12\x13\x14\x15\x16\x17'
+                 '\x18\x19\x1A\x1B\x1C\x1D\x1E\x1F'
+                 '\x80\x81\x82\x83\x84\x85\x86\x87'
+                 '\x88\x89\x8A\x8B\x8C\x8D\x8E\x8F'
+                 '\x90\x91\x92\x93\x94\x95\x96\x97'
+                 '\x98\x99\x9A\x9B\x9C\x9D\x9E\x9F')
+
+
+# The character-at-a-time translation mc_send used to do, kept as the
+# reference for check()
+def legacy_tellraw(message):
+    fragments = []
+    fragment = ''
+    is_bold = False
+    is_italics = False
+    is_underline = False
+    color = None
+
+    def _append_now():
+        if not fragment:
+            return
+
+        fragment_struct = {
+            "text": fragment,
+            "bold": is_bold,
+            "underlined": is_underline,
+            "italic": is_italics
+        }
+
+        if color:
+            fragment_struct["color"] = color
+
+        fragments.append(fragment_struct)
+
+    i = 0
+    while i < len(message):
+        c = message[i]
+        if c not in CONTROL_CODES:
+            fragment += c
+
+        elif c == '\x02':
+            _append_now()
+            fragment = ''
+            is_bold = not is_bold
+        elif c == '\x1D':
+            _append_now()
+            fragment = ''
+            is_italics = not is_italics
+        elif c == '\x1F':
+            _append_now()
+            fragment = ''
+            is_underline = not is_underline
+
+        elif c == '\x03':
+            _append_now()
+            fragment = ''
+
+            # Color
+            tmp_color = ''
+            i += 1
+            while message[i] in string.digits:
+                tmp_color += message[i]
+                i += 1
+            # Skip bg if given
+            if message[i] == ',':
+                i += 1
+                while message[i] in string.digits:
+                    i += 1
+            i -= 1
+            tmp_color = int(tmp_color)
+            if tmp_color < 16:
+                color = ircformat.IRC_TO_MC_NAME_LUT[tmp_color]
+
+        elif c == '\x0F':
+            # Reset all
+            _append_now()
+            fragment = ''
+            is_bold = is_italics = is_underline = False
+            color = None
+
+        i += 1
+
+    # Lingering bit
+    _append_now()
+    return fragments
+
+
+def legacy_say(message):
+    colored_msg = ''
+    i = 0
+    while i < len(message):
+        c = message[i]
+        if c not in CONTROL_CODES:
+            colored_msg += c
+        elif c == '\x03':
+            # Color
+            color = ''
+            i += 1
+            while message[i] in string.digits:
+                color += message[i]
+                i += 1
+            # Skip bg if given
+            if message[i] == ',':
+                i += 1
+                while message[i] in string.digits:
+                    i += 1
+            i -= 1
+            color = int(color)
+            if color < 16:
+                colored_msg += ircformat.IRC_TO_MC_HEX_LUT[color]
+        elif c == '\x0F':
+            # Reset all
+            colored_msg += '§r'
+
+        i += 1
+    return colored_msg
+
+
+WORDS = ["hello", "world", "creeper", "aw", "man", "§", "ünïcödé", "1234",
+         "!", "  ", "<3", "\U0001F600"]
+
+
+# A random message using only what the old code understood: text, bold,
+# italics, underline, colors with one or two digits (and optional background)
+# that aren't followed by another digit or a stray comma, resets, and control
+# codes both versions drop.
+def legacy_message(rng):
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        kind = rng.random()
+        if kind < 0.45:
+            parts.append(rng.choice(WORDS))
+        elif kind < 0.7:
+            parts.append(rng.choice('\x02\x1D\x1F\x0F'))
+        elif kind < 0.9:
+            code = '\x03' + str(rng.randint(0, 20 if rng.random() < 0.2
+                                            else 15))
+            if rng.random() < 0.3:
+                code += ',' + str(rng.randint(0, 15))
+            parts.append(code + rng.choice("abc "))
+        else:
+            parts.append(rng.choice('\x01\x07\x16\x11\x85'))
+    return ''.join(parts)
+
+
+# A random message using every IRC formatting code
+def full_message(rng):
+    parts = []
+    for _ in range(rng.randint(0, 12)):
+        kind = rng.random()
+        if kind < 0.45:
+            parts.append(rng.choice(WORDS))
+        elif kind < 0.7:
+            parts.append(rng.choice('\x02\x1D\x1F\x1E\x16\x11\x0F'))
+        elif kind < 0.85:
+            parts.append('\x03' + rng.choice(['', '4', '04', '12,1', '99']))
+        else:
+            parts.append('\x04' + rng.choice(['', 'FF8800', 'ff8800,000000']))
+    return ''.join(parts)
+
+
+# Compare against the old translation on every message it could handle.
+# Returns the number of mismatches.
+def check(count):
+    rng = random.Random(1)
+    mismatches = 0
+    for _ in range(count):
+        message = legacy_message(rng)
+        expected = [legacy_tellraw(message)]
+        got = [list(ircformat.to_tellraw(message))]
+        # /say used to drop bold and friends, so only compare it when there
+        # were none
+        if not any(c in message for c in ircformat.FORMATS):
+            expected.append(legacy_say(message))
+            got.append(ircformat.to_legacy(message))
+        if expected != got:
+            mismatches += 1
+            if mismatches <= 10:
+                print("MISMATCH {!r}".format(message))
+                print("  old: {!r}".format(expected))
+                print("  new: {!r}".format(got))
+
+    # Things the old code crashed on or didn't know about must at least
+    # translate without errors and without leaking control codes
+    for _ in range(count):
+        message = full_message(rng) + rng.choice(['', '\x03', '\x034', '\x04'])
+        say = ircformat.to_legacy(message)
+        texts = [x["text"] for x in ircformat.to_tellraw(message)]
+        for text in texts + [say]:
+            if any(c in CONTROL_CODES for c in text):
+                mismatches += 1
+                print("CONTROL CODE LEAKED {!r}".format(message))
+                break
+
+    print("{} messages checked, {} problems".format(count * 2, mismatches))
+    return mismatches
+
+
+def bench(name, func, messages, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for message in messages:
+            func(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:24} {:>10.0f} messages/s".format(name, len(messages) / best))
+
+
+def run_bench(count):
+    rng = random.Random(2)
+    unique = [legacy_message(rng) for _ in range(count)]
+    # Bots and relays repeat themselves
+    repeated = [rng.choice(unique[:50]) for _ in range(count)]
+
+    def uncached(func):
+        return lambda message: func.__wrapped__(message)
+
+    bench("legacy tellraw", legacy_tellraw, unique)
+    bench("tellraw, uncached", uncached(ircformat.to_tellraw), unique)
+    bench("tellraw, repeated", ircformat.to_tellraw, repeated)
+    bench("legacy say", legacy_say, unique)
+    bench("say, uncached", uncached(ircformat.to_legacy), unique)
+    bench("say, repeated", ircformat.to_legacy, repeated)
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    if mode == "check":
+        sys.exit(1 if check(count) else 0)
+    elif mode == "bench":
+        run_bench(count)
+    else:
+        print("Usage: {} [check|bench] [count]".format(sys.argv[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import asyncio
+import random
+import rcon
+import sys
+import time
+
+
+PASSWORD = "bench"
+# The server splits responses into packets of up to this many bytes
+RESPONSE_PACKET_SIZE = 4096
+
+
+# Enough of the server's RCON for the client to talk to: logins, commands
+# (answered in order, long answers split over several packets) and
+# "Unknown request" for any other packet type. Writes can be cut into
+# random small pieces to make sure the client copes with packets arriving
+# a few bytes at a time.
+#
+# Commands: "echo text", "big n" (n bytes of output), "hang" (never
+# answered, nor is anything after it) and "drop" (closes the connection,
+# even after a hang).
+class FakeRconServer:
+    _loop = None
+    _rng = None
+    _server = None
+    # StreamWriters of the open connections
+    _writers = None
+    fragment = False
+    port = None
+
+    def __init__(self, loop, fragment=False):
+        self._loop = loop
+        self._rng = random.Random(3)
+        self._writers = set()
+        self.fragment = fragment
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self.handle, "127.0.0.1", 0, loop=self._loop)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    # Stop listening, and wait for every connection to be closed
+    async def close(self):
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        while self._writers:
+            await asyncio.sleep(0.01)
+
+    async def _send(self, writer, request_id, packet_type, payload):
+        data = rcon.encode_packet(request_id, packet_type, payload)
+        if not self.fragment:
+            writer.write(data)
+            return
+        while data:
+            n = self._rng.randint(1, 64)
+            writer.write(data[:n])
+            data = data[n:]
+            await writer.drain()
+            await asyncio.sleep(0)
+
+    async def _respond(self, writer, request_id, output):
+        payload = output.encode('utf-8')
+        # Always at least one packet, even if it's empty
+        for i in range(0, max(len(payload), 1), RESPONSE_PACKET_SIZE):
+            await self._send(writer, request_id, rcon.TYPE_RESPONSE,
+                             payload[i:i + RESPONSE_PACKET_SIZE])
+
+    async def handle(self, reader, writer):
+        self._writers.add(writer)
+        logged_in = False
+        hanging = False
+        try:
+            while True:
+                request_id, packet_type, body = await rcon.read_packet(
+                    reader)
+                if packet_type == rcon.TYPE_LOGIN:
+                    logged_in = body.decode('utf-8') == PASSWORD
+                    await self._send(writer, request_id if logged_in else -1,
+                                     rcon.TYPE_COMMAND, b"")
+                elif not logged_in or body == b"drop":
+                    break
+                elif hanging:
+                    # Stuck on a command; nothing more gets answered
+                    continue
+                elif packet_type == rcon.TYPE_COMMAND:
+                    command = body.decode('utf-8')
+                    if command == "hang":
+                        hanging = True
+                    elif command[:4] == "big ":
+                        await self._respond(writer, request_id,
+                                            big_output(int(command[4:])))
+                    elif command[:5] == "echo ":
+                        await self._respond(writer, request_id, command[5:])
+                    else:
+                        await self._respond(writer, request_id,
+                                            "Unknown command")
+                else:
+                    await self._respond(writer, request_id,
+                                        "Unknown request {:x}".format(
+                                            packet_type))
+        except (asyncio.IncompleteReadError, ConnectionError, rcon.RconError):
+            pass
+        finally:
+            writer.close()
+            self._writers.discard(writer)
+
+
+def big_output(size):
+    line = "".join(chr(ord("a") + i % 26) for i in range(99)) + "\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+async def start(loop, fragment=False, timeout=10):
+    fake = FakeRconServer(loop, fragment)
+    await fake.start()
+    client = rcon.RconClient(loop, "127.0.0.1", fake.port, PASSWORD, timeout)
+    return fake, client
+
+
+# What the client counts on: the answer to a packet of unknown type comes
+# after every packet of the answer to the command before it. Returns the
+# packets as (request ID, payload size).
+async def raw_marker_order(loop, port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port,
+                                                   loop=loop)
+    try:
+        writer.write(rcon.encode_packet(1, rcon.TYPE_LOGIN,
+                                        PASSWORD.encode('utf-8')))
+        await rcon.read_packet(reader)
+        writer.write(rcon.encode_packet(2, rcon.TYPE_COMMAND, b"big 10000") +
+                     rcon.encode_packet(3, rcon.TYPE_MARKER, b""))
+        packets = []
+        while not packets or packets[-1][0] != 3:
+            request_id, _, payload = await rcon.read_packet(reader)
+            packets.append((request_id, payload))
+        return packets
+    finally:
+        writer.close()
+
+
+async def check(loop, count):
+    problems = 0
+    checks = 0
+
+    def expect(name, ok):
+        nonlocal problems, checks
+        checks += 1
+        if not ok:
+            problems += 1
+            print("FAILED " + name)
+
+    for fragment in (False, True):
+        label = " (fragmented)" if fragment else ""
+        fake, client = await start(loop, fragment, timeout=2)
+        try:
+            packets = await raw_marker_order(loop, fake.port)
+            expect("marker answered last" + label,
+                   [x for x, _ in packets] == [2, 2, 2, 3] and
+                   sum(len(x) for _, x in packets[:-1]) == 10000 and
+                   packets[-1][1].startswith(b"Unknown request"))
+
+            # Bad login
+            bad = rcon.RconClient(loop, "127.0.0.1", fake.port, "wrong", 2)
+            try:
+                await bad.connect()
+                expect("bad password refused" + label, False)
+            except rcon.RconError:
+                expect("bad password refused" + label, True)
+            bad.close()
+
+            await client.ensure_connected()
+            expect("one command" + label,
+                   await client.command("echo hello") == "hello")
+            expect("empty answer" + label,
+                   await client.command("echo ") == "")
+            expect("multi-packet answer" + label,
+                   await client.command("big 20000") == big_output(20000))
+            expect("exactly one packet" + label,
+                   await client.command("big {}".format(
+                       RESPONSE_PACKET_SIZE)) ==
+                   big_output(RESPONSE_PACKET_SIZE))
+
+            # Many at once, with long and short answers mixed, must each
+            # get their own
+            rng = random.Random(4)
+            commands = []
+            for i in range(count):
+                if rng.random() < 0.2:
+                    commands.append(("big {}".format(rng.randint(1, 15000)),
+                                     None))
+                else:
+                    commands.append(("echo {}".format(i), str(i)))
+            results = await asyncio.gather(
+                *[client.command(x) for x, _ in commands], loop=loop)
+            expect("pipelined commands" + label, all(
+                result == (expected if expected is not None else
+                           big_output(int(command[4:])))
+                for (command, expected), result in zip(commands, results)))
+
+            try:
+                await client.command("x" * (rcon.MAX_PAYLOAD + 1))
+                expect("too long refused" + label, False)
+            except rcon.RconError:
+                expect("too long refused" + label, True)
+
+            # A command given up on is forgotten
+            given_up = loop.create_task(client.command("hang"))
+            await asyncio.sleep(0.1)
+            given_up.cancel()
+            await asyncio.sleep(0.01)
+            expect("cancelled command forgotten" + label,
+                   not client._markers and not client._responses)
+
+            # A dropped connection fails what's in flight, and the client
+            # can connect again
+            pending = loop.create_task(client.command("hang"))
+            await asyncio.sleep(0.1)
+            try:
+                await client.command("drop")
+                expect("drop fails the command" + label, False)
+            except rcon.RconError:
+                expect("drop fails the command" + label, True)
+            try:
+                await pending
+                expect("drop fails commands in flight" + label, False)
+            except rcon.RconError:
+                expect("drop fails commands in flight" + label, True)
+            expect("disconnect noticed" + label, not client.connected)
+            await client.ensure_connected()
+            expect("reconnect" + label,
+                   await client.command("echo again") == "again")
+
+            # A server that stops answering times out
+            try:
+                await client.command("hang")
+                expect("timeout" + label, False)
+            except rcon.RconError:
+                expect("timeout" + label, True)
+        finally:
+            client.close()
+            await fake.close()
+
+    print("{} checks, {} problems".format(checks, problems))
+    return problems
+
+
+async def bench(loop, count):
+    for size in (10, 10000):
+        fake, client = await start(loop)
+        await client.connect()
+        command = "echo " + "x" * size if size < 100 else "big {}".format(
+            size)
+        for name, pipelined in (("one at a time", False),
+                                ("pipelined", True)):
+            started = time.perf_counter()
+            if pipelined:
+                await asyncio.gather(*[client.command(command)
+                                       for _ in range(count)], loop=loop)
+            else:
+                for _ in range(count):
+                    await client.command(command)
+            elapsed = time.perf_counter() - started
+            print("{:>6} byte answers, {:14} {:>8.0f} commands/s".format(
+                size, name, count / elapsed))
+        client.close()
+        await fake.close()
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    loop = asyncio.get_event_loop()
+    if mode == "check":
+        problems = loop.run_until_complete(check(loop, count))
+        loop.close()
+        sys.exit(1 if problems else 0)
+    elif mode == "bench":
+        loop.run_until_complete(bench(loop, count * 10))
+        loop.close()
+    else:
+        print("Usage: {} [check|bench] [count]".format(sys.argv[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import regionstore
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+
+# A region file with count chunks, some of them identical (as empty POI
+# chunks are), padded out to whole sectors
+def make_region(rng, count=600):
+    same = zlib.compress(b"\x0a\x00\x00\x00")
+    locations = bytearray(regionstore.SECTOR_SIZE)
+    body = bytearray()
+    sector = regionstore.HEADER_SIZE // regionstore.SECTOR_SIZE
+    for i in rng.sample(range(regionstore.CHUNKS_PER_REGION), count):
+        if rng.random() < 0.3:
+            payload = same
+        else:
+            payload = zlib.compress(bytes(rng.getrandbits(8) for _ in
+                                          range(rng.randint(100, 6000))))
+        chunk = len(payload).to_bytes(4, 'big') + b"\x02" + payload
+        sectors = -(-len(chunk) // regionstore.SECTOR_SIZE)
+        chunk += bytes(sectors * regionstore.SECTOR_SIZE - len(chunk))
+        locations[i * 4:i * 4 + 4] = (sector.to_bytes(3, 'big') +
+                                      bytes([sectors]))
+        body += chunk
+        sector += sectors
+    timestamps = bytes(regionstore.SECTOR_SIZE)
+    return bytes(locations) + timestamps + bytes(body)
+
+
+# Several worker threads storing the same object at once must all succeed
+# and leave it intact. Returns the number of problems.
+def check_concurrent_put(rounds, threads=4):
+    problems = 0
+    data = os.urandom(64 * 1024)
+    digest = regionstore._hash(data)
+    for _ in range(rounds):
+        root = tempfile.mkdtemp()
+        try:
+            store = regionstore.ChunkStore(root)
+            barrier = threading.Barrier(threads)
+            errors = []
+
+            def put():
+                barrier.wait()
+                try:
+                    store._put(digest, data)
+                except Exception as e:
+                    errors.append(e)
+
+            workers = [threading.Thread(target=put) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            if errors:
+                problems += 1
+                print("PUT FAILED {!r}".format(errors[0]))
+            elif store._read_object(digest) != data:
+                problems += 1
+                print("OBJECT CORRUPT")
+            leftovers = [x for x in os.listdir(
+                os.path.dirname(store._object_path(digest)))
+                if x.endswith(".tmp")]
+            if leftovers:
+                problems += 1
+                print("TEMP FILES LEFT {}".format(leftovers))
+        finally:
+            shutil.rmtree(root)
+    return problems
+
+
+# Store a world of region files from several threads, then restore and
+# verify it. Returns the number of problems.
+def check_round_trip(rng, files=8):
+    problems = 0
+    root = tempfile.mkdtemp()
+    try:
+        world = os.path.join(root, "world", "region")
+        os.makedirs(world)
+        for i in range(files):
+            with open(os.path.join(world, "r.{}.0.mca".format(i)), "wb") as f:
+                f.write(make_region(rng))
+
+        store = regionstore.ChunkStore(os.path.join(root, "backups"))
+        entries = {}
+
+        def store_file(filename):
+            entries[filename] = store.store_file(
+                os.path.join(world, filename))[2]
+
+        workers = [threading.Thread(target=store_file, args=(x,))
+                   for x in os.listdir(world)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        store.write_manifest("1", {
+            "dirs": ["region"],
+            "files": {os.path.join("region", x): entry
+                      for x, entry in entries.items()}})
+        bad = store.verify("1")
+        if bad or len(entries) != files:
+            problems += 1
+            print("VERIFY FAILED {}".format(bad))
+
+        dst = os.path.join(root, "restored")
+        store.restore("1", dst)
+        for filename in os.listdir(world):
+            with open(os.path.join(world, filename), "rb") as f:
+                original = f.read()
+            with open(os.path.join(dst, "region", filename), "rb") as f:
+                if f.read() != original:
+                    problems += 1
+                    print("RESTORE DIFFERS {}".format(filename))
+    finally:
+        shutil.rmtree(root)
+    return problems
+
+
+def check(count):
+    rng = random.Random(1)
+    problems = check_concurrent_put(count)
+    problems += check_round_trip(rng)
+    print("{} concurrent puts and a round trip checked, {} problems".format(
+        count, problems))
+    return problems
+
+
+def run_bench(count):
+    rng = random.Random(2)
+    regions = [make_region(rng) for _ in range(count)]
+    root = tempfile.mkdtemp()
+    try:
+        store = regionstore.ChunkStore(root)
+        for name in ("first store", "unchanged"):
+            start = time.perf_counter()
+            written = 0
+            for data in regions:
+                written += store._store_data(data, True)[1]
+            elapsed = time.perf_counter() - start
+            size = sum(len(x) for x in regions)
+            print("{:12} {:>8.1f} MiB/s, {:>6.1f} MiB written".format(
+                name, size / elapsed / 1048576, written / 1048576))
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    if mode == "check":
+        sys.exit(1 if check(count) else 0)
+    elif mode == "bench":
+        run_bench(count // 20 or 1)
+    else:
+        print("Usage: {} [check|bench] [count]".format(sys.argv[0]))
+
+if __name__ == '__main__':
+    main()
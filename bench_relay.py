@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+import asyncio
+import bench_classifier
+import collections
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+# End-to-end load test of the chat bridge. We run a fake IRC server and
+# start main.py against it, with a fake Minecraft server (this script again,
+# in "fake-server" mode) as its cmdline. Then:
+#
+# - The fake server replays console logs at a given rate, with marker chat
+#   lines ("!bench-mc <seq> <time>") among them. The fake ircd times them
+#   from when they were printed to when the wrapper relays them.
+# - The fake ircd floods the channel with marker messages ("bench-rt <seq>
+#   <time>") and JOINs/PARTs. The fake server echoes the markers back as
+#   chat, so the ircd times the round trip IRC -> server -> IRC.
+#
+# Everything runs on one machine, so time.time() is the same clock on
+# both ends.
+
+MC_MARKER_RE = re.compile(rb"bench-mc (\d+) ([0-9.]+)")
+RT_MARKER_RE = re.compile(rb"bench-rt (\d+) ([0-9.]+)")
+
+# Marker chat lines the fake server prints per second, on top of the replay
+MC_MARKERS_PER_SECOND = 20
+
+# Flood limits for the wrapper's IRC queue. High enough that we measure
+# the wrapper, not the limits it sets for itself on a real network.
+IRC_FLOOD_RATE = 1000
+IRC_FLOOD_BURST = 1000
+
+CHANNEL = "#bench"
+NICK = "benchbot"
+
+
+def console_line(message, level="INFO"):
+    return "[{}] [Server thread/{}]: {}\n".format(
+        time.strftime("%H:%M:%S"), level, message).encode('utf-8')
+
+
+# Replies to the console commands the wrapper sends on its own
+FAKE_REPLIES = {
+    "save-off": "Automatic saving is now disabled",
+    "save-all flush": "Saved the game",
+    "save-all": "Saved the game",
+    "save-on": "Automatic saving is now enabled",
+    "list": "There are 0 of a max of 20 players online: ",
+}
+
+
+# The stand-in Minecraft server: replay lines at rate lines/s (cycling
+# through them), and answer/echo whatever comes in on stdin
+def fake_server(rate, lines):
+    out = sys.stdout.buffer
+    lock = threading.Lock()
+
+    def write(data):
+        with lock:
+            out.write(data)
+            out.flush()
+
+    def read_stdin():
+        for line in sys.stdin.buffer:
+            command = line.decode('utf-8', 'replace').strip()
+            if command == "stop":
+                break
+            reply = FAKE_REPLIES.get(command)
+            if reply:
+                write(console_line(reply))
+                continue
+            echoed = [console_line("<Echo> !" + match.group(0).decode())
+                      for match in RT_MARKER_RE.finditer(line)]
+            echoed.append(console_line("Echo: " + command[:200]))
+            write(b"".join(echoed))
+        # stdin closed (the wrapper went away) or "stop"
+        os._exit(0)
+
+    write(console_line("Done (1.000s)! For help, type \"help\""))
+    threading.Thread(target=read_stdin, daemon=True).start()
+
+    # Print in batches every 10ms, keeping to the rate over the long run
+    marker_every = max(1, rate // MC_MARKERS_PER_SECOND)
+    seq = 0
+    sent = 0
+    index = 0
+    start = time.monotonic()
+    while True:
+        due = int((time.monotonic() - start) * rate) - sent
+        batch = []
+        for _ in range(due):
+            batch.append(lines[index])
+            index = (index + 1) % len(lines)
+            sent += 1
+            if sent % marker_every == 0:
+                seq += 1
+                batch.append(console_line("<Bench> !bench-mc {} {:.6f}".format(
+                    seq, time.time())))
+        if batch:
+            write(b"".join(batch))
+        time.sleep(0.01)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# Just enough of an IRC server for the wrapper, which floods the channel
+# once the wrapper has joined it and times the markers it gets back
+class FakeIrcd:
+    _loop = None
+    _rate = None
+    _joins_rate = None
+    _writer = None
+    joined = None
+    flooding = False
+    # seq -> time sent, for markers not yet seen again
+    _rt_pending = None
+    rt_sent = 0
+    rt_latencies = None
+    mc_latencies = None
+    mc_seen = None
+    irc_lines = 0
+
+    def __init__(self, loop, rate, joins_rate):
+        self._loop = loop
+        self._rate = rate
+        self._joins_rate = joins_rate
+        self.joined = asyncio.Event(loop=loop)
+        self._rt_pending = {}
+        self.rt_latencies = []
+        self.mc_latencies = []
+        self.mc_seen = set()
+
+    async def handle(self, reader, writer):
+        nick = NICK
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            now = time.time()
+            self.irc_lines += 1
+            parts = line.split(b" ", 2)
+            command = parts[0]
+            if command == b"NICK":
+                nick = parts[1].strip().decode()
+                writer.write(":bench 001 {0} :Welcome\r\n"
+                             ":bench 376 {0} :End of MOTD\r\n".format(
+                                 nick).encode())
+            elif command == b"JOIN":
+                self._writer = writer
+                writer.write(":{}!bench@localhost JOIN {}\r\n".format(
+                    nick, CHANNEL).encode())
+                self.joined.set()
+            elif command in (b"PRIVMSG", b"NOTICE"):
+                for match in MC_MARKER_RE.finditer(line):
+                    self.mc_seen.add(int(match.group(1)))
+                    self.mc_latencies.append(now - float(match.group(2)))
+                for match in RT_MARKER_RE.finditer(line):
+                    sent_at = self._rt_pending.pop(int(match.group(1)), None)
+                    if sent_at is not None:
+                        self.rt_latencies.append(now - sent_at)
+            elif command == b"PING":
+                writer.write(b"PONG " + parts[1])
+
+    def _send(self, line):
+        if self._writer and not self._writer.transport.is_closing():
+            self._writer.write(line.encode('utf-8') + b"\r\n")
+
+    # PRIVMSGs at rate/s, and a JOIN and a PART every 1/joins_rate s
+    async def flood(self):
+        self.flooding = True
+        start = time.monotonic()
+        sent = 0
+        joins = 0
+        users = ["user{}".format(i) for i in range(20)]
+        while self.flooding:
+            elapsed = time.monotonic() - start
+            for _ in range(int(elapsed * self._rate) - sent):
+                sent += 1
+                self.rt_sent += 1
+                now = time.time()
+                self._rt_pending[self.rt_sent] = now
+                self._send(":{0}!{0}@localhost PRIVMSG {1} :"
+                           "bench-rt {2} {3:.6f}".format(
+                               random.choice(users), CHANNEL,
+                               self.rt_sent, now))
+            for _ in range(int(elapsed * self._joins_rate) - joins):
+                joins += 1
+                user = "lurker{}".format(joins % 50)
+                self._send(":{0}!{0}@localhost JOIN {1}".format(
+                    user, CHANNEL))
+                self._send(":{0}!{0}@localhost PART {1} :bye".format(
+                    user, CHANNEL))
+            await asyncio.sleep(0.01)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def memory(pid):
+    result = {}
+    try:
+        with open("/proc/{}/status".format(pid), "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    result[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return result
+
+
+async def scrape(loop, port):
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port,
+                                                       loop=loop)
+    except OSError:
+        return {}
+    writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+    body = await reader.read()
+    writer.close()
+
+    values = collections.defaultdict(float)
+    for line in body.decode('utf-8').splitlines():
+        if line.startswith("mcwrapper_") and "_bucket" not in line:
+            name, _, value = line.rpartition(" ")
+            values[name.split("{")[0]] += float(value)
+    return values
+
+
+async def run(loop, seconds, mc_rate, irc_rate, joins_rate, backup_interval,
+              logs):
+    workdir = tempfile.mkdtemp(prefix="bench-relay-")
+    ircd = FakeIrcd(loop, irc_rate, joins_rate)
+    server = await asyncio.start_server(ircd.handle, "127.0.0.1", 0,
+                                        loop=loop)
+    irc_port = server.sockets[0].getsockname()[1]
+    metrics_port = free_port()
+
+    if backup_interval:
+        # Something for the backups to copy
+        os.makedirs(os.path.join(workdir, "world", "region"))
+        for i in range(64):
+            with open(os.path.join(workdir, "world", "region",
+                                   "r.{}.0.mca".format(i)), "wb") as f:
+                f.write(os.urandom(256 * 1024))
+
+    config = {
+        "irc_server": "127.0.0.1",
+        "irc_port": irc_port,
+        "irc_nick": NICK,
+        "irc_password": "bench",
+        "irc_channel": CHANNEL,
+        "irc_flood_rate": IRC_FLOOD_RATE,
+        "irc_flood_burst": IRC_FLOOD_BURST,
+        "users": {},
+        "enable_sig_verify": True,
+        "enable_irc_bridge": True,
+        "use_tellraw": True,
+        "backup_interval": backup_interval,
+        "num_backups": 2,
+        "directory": workdir,
+        "metrics_port": metrics_port,
+        # Replayed logs are full of "Can't keep up!"; don't let the
+        # watchdog kill the fake server over them
+        "watchdog_lag_warnings": 0,
+        "cmdline": [sys.executable, os.path.abspath(__file__),
+                    "fake-server", str(mc_rate)] + logs,
+    }
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(workdir, "wrapper.log"), "wb") as log:
+        wrapper = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(here, "main.py"), config_path,
+            stdout=log, stderr=log, cwd=here, loop=loop)
+
+    try:
+        await asyncio.wait_for(ircd.joined.wait(), 30, loop=loop)
+        print("Wrapper up (PID {}), flooding for {}s".format(wrapper.pid,
+                                                             seconds))
+        before = await scrape(loop, metrics_port)
+        flood = loop.create_task(ircd.flood())
+        start = time.monotonic()
+        peak_rss = 0
+        while time.monotonic() - start < seconds:
+            await asyncio.sleep(1)
+            if backup_interval:
+                # The world keeps changing, so no backup is skipped as idle
+                os.utime(os.path.join(workdir, "world", "region",
+                                      "r.0.0.mca"))
+            peak_rss = max(peak_rss, memory(wrapper.pid).get("VmRSS", 0))
+        ircd.flooding = False
+        await flood
+        elapsed = time.monotonic() - start
+        after = await scrape(loop, metrics_port)
+        # Stragglers
+        await asyncio.sleep(2)
+        mem = memory(wrapper.pid)
+    finally:
+        if wrapper.returncode is None:
+            wrapper.terminate()
+            await wrapper.wait()
+        server.close()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    print()
+    print("Server -> wrapper: {:.0f} lines/s (asked for {} + markers)".format(
+        delta("mcwrapper_stdout_lines_total") / elapsed, mc_rate))
+    print("Wrapper -> IRC:    {:.0f} messages/s".format(
+        delta("mcwrapper_irc_sent_total") / elapsed))
+    print("IRC -> wrapper:    {:.0f} lines/s".format(
+        ircd.irc_lines / elapsed))
+    print()
+    print("{:24} {:>8} {:>8} {:>10} {:>10}".format(
+        "latency", "samples", "lost", "p50", "p99"))
+    mc_sent = max(ircd.mc_seen) if ircd.mc_seen else 0
+    for name, latencies, lost in [
+            ("server -> IRC", ircd.mc_latencies, mc_sent - len(ircd.mc_seen)),
+            ("IRC -> server -> IRC", ircd.rt_latencies,
+             ircd.rt_sent - len(ircd.rt_latencies))]:
+        print("{:24} {:>8} {:>8} {:>9.1f}ms {:>9.1f}ms".format(
+            name, len(latencies), lost, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000))
+    print()
+    print("Wrapper memory: {:.1f} MiB now, {:.1f} MiB peak RSS".format(
+        mem.get("VmRSS", 0) / 2 ** 20,
+        max(peak_rss, mem.get("VmHWM", 0)) / 2 ** 20))
+    print("IRC queue: {:.0f} dropped, {:.0f} still queued".format(
+        delta("mcwrapper_irc_dropped_total"),
+        after.get("mcwrapper_irc_queue_depth", 0)))
+    if backup_interval:
+        backups = delta("mcwrapper_backup_duration_seconds_count")
+        print("Backups: {:.0f}, {:.1f}s total".format(
+            backups, delta("mcwrapper_backup_duration_seconds_sum")))
+        # Backups that stop happening would make the numbers above look
+        # better than they are
+        expected = int(elapsed // backup_interval)
+        if expected >= 2 and backups < expected / 2:
+            print("ERROR: Only {:.0f} backups, expected about {}. See {}"
+                  .format(backups, expected,
+                          os.path.join(workdir, "wrapper.log")))
+            return False
+
+    shutil.rmtree(workdir, ignore_errors=True)
+    return True
+
+
+def usage():
+    print("Usage: {} [seconds] [server lines/s] [IRC messages/s] "
+          "[IRC joins/s] [backup interval] [log ...]".format(sys.argv[0]))
+    print("       {} fake-server lines/s [log ...]".format(sys.argv[0]))
+
+
+def main():
+    if sys.argv[1:2] == ["fake-server"]:
+        if len(sys.argv) < 3:
+            usage()
+            return
+        lines = bench_classifier.load_corpus(sys.argv[3:])
+        if not lines:
+            lines = bench_classifier.SYNTHETIC_LINES
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        fake_server(int(sys.argv[2]), lines)
+        return
+
+    # Numbers, then the logs to replay
+    args = sys.argv[1:]
+    numbers = []
+    while args and len(numbers) < 5:
+        try:
+            numbers.append(float(args[0]))
+        except ValueError:
+            break
+        args.pop(0)
+    seconds, mc_rate, irc_rate, joins_rate, backup_interval = (
+        numbers + [30, 500, 20, 1, 0][len(numbers):])
+    if args[:1] in (["-h"], ["--help"]):
+        usage()
+        return
+
+    logs = args
+    if not logs:
+        logs = glob.glob("logs/*.log.gz") + glob.glob("logs/latest.log")
+    logs = [os.path.abspath(x) for x in logs]
+    for path in logs:
+        if not os.path.isfile(path):
+            print("ERROR: No such log: " + path)
+            return
+    print("Replaying {}".format(", ".join(logs) if logs else
+                                "a synthetic corpus"))
+
+    loop = asyncio.get_event_loop()
+    ok = loop.run_until_complete(run(loop, seconds, int(mc_rate), irc_rate,
+                                     joins_rate, backup_interval, logs))
+    loop.close()
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
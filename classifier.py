@@ -0,0 +1,113 @@
+import re
+
+
+# Patterns that start with this are about a player. They get merged so that
+# the name is only scanned once per line, however many of them there are.
+PLAYER = rb"([A-Za-z0-9_]+)"
+
+LEVEL_END = b"]: "
+
+
+# Picks out the server log lines we care about with one pass per line.
+#
+# Every event is a bytes regex that is matched right after the log level
+# marker (e.g. b"INFO]: "), so a line costs one bytes.find() plus at most
+# one anchored match against the alternation of all patterns for its level.
+# Lines are never decoded unless they match, and then only the captured
+# groups are.
+class LineClassifier:
+    _levels = None
+    _compiled = None
+
+    def __init__(self):
+        # level -> [(name, pattern, handler)]
+        self._levels = {}
+        self._compiled = None
+
+    # Call handler(*groups) for lines from the given level that match
+    # pattern (a bytes regex, matched from just after the level marker).
+    # Patterns registered first win if more than one would match.
+    def register(self, name, pattern, handler, level="INFO"):
+        level = level.encode('ascii')
+        self._levels.setdefault(level, []).append((name, pattern, handler))
+        self._compiled = None
+
+    @staticmethod
+    def _compile_level(events):
+        alternatives = []
+        player_alternatives = []
+        # Index of the last group to close when an alternative matches ->
+        # (name, handler, indexes of the groups to pass to the handler)
+        dispatch = {}
+
+        group = 1
+        for name, pattern, handler in events:
+            if pattern.startswith(PLAYER):
+                continue
+            groups = re.compile(pattern).groups
+            alternatives.append(b"(" + pattern + b")")
+            dispatch[group] = (name, handler,
+                               tuple(range(group + 1, group + 1 + groups)))
+            group += groups + 1
+
+        player_group = group
+        group += 1
+        for name, pattern, handler in events:
+            if not pattern.startswith(PLAYER):
+                continue
+            rest = pattern[len(PLAYER):]
+            groups = re.compile(rest).groups
+            player_alternatives.append(b"(" + rest + b")")
+            # The player's name goes first, then the rest's own groups
+            dispatch[group] = (name, handler, (player_group,) +
+                               tuple(range(group + 1, group + 1 + groups)))
+            group += groups + 1
+
+        if player_alternatives:
+            alternatives.append(
+                PLAYER + b"(?:" + b"|".join(player_alternatives) + b")")
+
+        return re.compile(b"|".join(alternatives)), dispatch
+
+    def _compile(self):
+        self._compiled = []
+        for level, events in self._levels.items():
+            regex, dispatch = self._compile_level(events)
+            self._compiled.append((level, len(level), regex, dispatch))
+
+    # Classify one raw line. Returns the name of the event it matched, or
+    # None.
+    def dispatch(self, line):
+        if self._compiled is None:
+            self._compile()
+
+        pos = line.find(LEVEL_END)
+        if pos < 0:
+            return None
+
+        for level, level_len, regex, dispatch in self._compiled:
+            if not line.startswith(level, pos - level_len):
+                continue
+
+            match = regex.match(line, pos + len(LEVEL_END))
+            if not match:
+                return None
+
+            # The outer group of the alternative that matched is the last
+            # one to close
+            name, handler, indexes = dispatch[match.lastindex]
+            if not indexes:
+                handler()
+            elif len(indexes) == 1:
+                handler(_decode(match.group(indexes[0])))
+            else:
+                handler(*[_decode(x) for x in match.group(*indexes)])
+            return name
+
+        return None
+
+
+def _decode(group):
+    if group is None:
+        return None
+    return group.decode('utf-8', 'replace')
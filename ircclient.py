@@ -0,0 +1,36 @@
+import bottom
+import bottom.protocol
+
+
+# Replies bottom doesn't parse (and so drops) that we need to see. They're
+# triggered as events with the nick they're about.
+NICK_ERRORS = {
+    "432": "ERR_ERRONEUSNICKNAME",
+    "433": "ERR_NICKNAMEINUSE",
+    "436": "ERR_NICKCOLLISION",
+    "437": "ERR_UNAVAILRESOURCE",
+}
+
+
+class _Protocol(bottom.protocol.Protocol):
+    def data_received(self, data):
+        # Peek at the complete lines before bottom splits them up itself
+        for line in (self.buffer + data).split(b"\n")[:-1]:
+            # ":server 433 <our nick or *> <nick> :Nickname is already in use"
+            parts = line.decode(self.client.encoding, "ignore").split()
+            if (len(parts) >= 4 and parts[0][:1] == ":" and
+                    parts[1] in NICK_ERRORS):
+                self.client.trigger(NICK_ERRORS[parts[1]], nick=parts[3])
+        super().data_received(data)
+
+
+# bottom.Client, but with the events above
+class Client(bottom.Client):
+    async def connect(self):
+        transport, protocol = await self.loop.create_connection(
+            _Protocol, host=self.host, port=self.port, ssl=self.ssl)
+        if self.protocol:
+            self.protocol.close()
+        self.protocol = protocol
+        protocol.client = self
+        self.trigger("client_connect")
@@ -0,0 +1,198 @@
+import functools
+import re
+
+
+IRC_TO_MC_HEX_LUT = [
+    "§f",   # White
+    "§0",   # Black
+    "§1",   # Dark blue
+    "§2",   # Dark green
+    "§c",   # Red
+    "§4",   # Dark red
+    "§5",   # Dark purple
+    "§6",   # Gold
+    "§e",   # Yellow
+    "§a",   # Green
+    "§3",   # Dark aqua
+    "§b",   # Aqua
+    "§9",   # Blue
+    "§d",   # Light purple
+    "§8",   # Dark gray
+    "§7",   # Gray
+]
+
+IRC_TO_MC_NAME_LUT = [
+    "white",
+    "black",
+    "dark_blue",
+    "dark_green",
+    "red",
+    "dark_red",
+    "dark_purple",
+    "gold",
+    "yellow",
+    "green",
+    "dark_aqua",
+    "aqua",
+    "blue",
+    "light_purple",
+    "dark_gray",
+    "gray"
+]
+
+BOLD = '\x02'
+COLOR = '\x03'
+HEX_COLOR = '\x04'
+RESET = '\x0F'
+MONOSPACE = '\x11'
+REVERSE = '\x16'
+ITALIC = '\x1D'
+STRIKETHROUGH = '\x1E'
+UNDERLINE = '\x1F'
+
+# IRC formatting -> legacy formatting code. There's nothing in Minecraft for
+# reverse or monospace, so those are dropped.
+FORMATS = {
+    BOLD: "§l",
+    ITALIC: "§o",
+    UNDERLINE: "§n",
+    STRIKETHROUGH: "§m",
+}
+
+# Codes that change the formatting of the text after them
+HANDLED = frozenset(list(FORMATS) + [COLOR, HEX_COLOR, RESET])
+
+# Splits a message around formatting codes: re.split() gives text, code,
+# text, code, ..., text. Colors are one or two digits, optionally followed by
+# a background color (which we ignore); a bare \x03 resets the color.
+CODE_RE = re.compile(
+    "(\x03(?:[0-9]{1,2}(?:,[0-9]{1,2})?)?|"
+    "\x04(?:[0-9A-Fa-f]{6}(?:,[0-9A-Fa-f]{6})?)?|"
+    "[\x00-\x1F\x80-\x9F])")
+
+CACHE_SIZE = 256
+
+
+def _fragment(text, bold, underlined, italic, strikethrough, color):
+    fragment = {
+        "text": text,
+        "bold": bold,
+        "underlined": underlined,
+        "italic": italic,
+    }
+    if strikethrough:
+        fragment["strikethrough"] = True
+    if color:
+        fragment["color"] = color
+    return fragment
+
+
+# IRC color code -> index into the LUTs, or None for a bare \x03
+def _color_index(code):
+    digits = code[1:].partition(',')[0]
+    return int(digits) if digits else None
+
+
+# Translate IRC formatting to a tuple of tellraw text fragments. Cached since
+# bots and relays tend to send the same thing over and over; callers must not
+# modify the result.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def to_tellraw(message):
+    parts = CODE_RE.split(message)
+    if len(parts) == 1:
+        if not message:
+            return ()
+        return (_fragment(message, False, False, False, False, None),)
+
+    fragments = []
+    text = parts[0]
+    bold = underlined = italic = strikethrough = False
+    color = None
+
+    for i in range(1, len(parts), 2):
+        c = parts[i][0]
+        if c not in HANDLED:
+            # Some other control code; drop it
+            text += parts[i + 1]
+            continue
+
+        # Anything that may change the formatting ends the current fragment
+        if text:
+            fragments.append(_fragment(text, bold, underlined, italic,
+                                       strikethrough, color))
+        text = parts[i + 1]
+
+        if c == BOLD:
+            bold = not bold
+        elif c == UNDERLINE:
+            underlined = not underlined
+        elif c == ITALIC:
+            italic = not italic
+        elif c == STRIKETHROUGH:
+            strikethrough = not strikethrough
+        elif c == COLOR:
+            index = _color_index(parts[i])
+            if index is None:
+                color = None
+            elif index < 16:
+                color = IRC_TO_MC_NAME_LUT[index]
+        elif c == HEX_COLOR:
+            color = "#" + parts[i][1:7].lower() if len(parts[i]) > 1 else None
+        else:
+            bold = underlined = italic = strikethrough = False
+            color = None
+
+    if text:
+        fragments.append(_fragment(text, bold, underlined, italic,
+                                   strikethrough, color))
+
+    return tuple(fragments)
+
+
+# Translate IRC formatting to Minecraft's legacy § codes, for /say.
+# A color code turns off bold and friends in Minecraft, and the only way to
+# turn one of those off is §r, so the active formats get repeated after
+# either.
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def to_legacy(message):
+    parts = CODE_RE.split(message)
+    if len(parts) == 1:
+        return message
+
+    out = [parts[0]]
+    formats = []
+    color = None
+
+    for i in range(1, len(parts), 2):
+        code = parts[i]
+        c = code[0]
+        if c in FORMATS:
+            if c in formats:
+                formats.remove(c)
+                out.append("§r")
+                if color:
+                    out.append(color)
+                out.extend(FORMATS[x] for x in formats)
+            else:
+                formats.append(c)
+                out.append(FORMATS[c])
+        elif c == COLOR:
+            index = _color_index(code)
+            if index is None:
+                color = None
+                out.append("§r")
+                out.extend(FORMATS[x] for x in formats)
+            elif index < 16:
+                color = IRC_TO_MC_HEX_LUT[index]
+                out.append(color)
+                out.extend(FORMATS[x] for x in formats)
+        elif c == RESET:
+            formats = []
+            color = None
+            out.append("§r")
+        # Hex colors can't be done with § codes, and the rest don't exist in
+        # Minecraft
+
+        out.append(parts[i + 1])
+
+    return ''.join(out)
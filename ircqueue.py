@@ -0,0 +1,215 @@
+import asyncio
+import collections
+import time
+
+
+PRIORITY_ADMIN = 0
+PRIORITY_CHAT = 1
+PRIORITY_EVENT = 2
+
+# Keep this far under the 512 byte limit on a whole IRC line, since the
+# server adds our prefix and the command when relaying it
+MAX_LINE = 400
+
+LATENCY_SAMPLES = 200
+
+
+class _Item:
+    __slots__ = ("queued_at", "priority", "command", "target", "message",
+                 "coalesce", "on_sent", "merged")
+
+    def __init__(self, priority, command, target, message, coalesce,
+                 on_sent):
+        self.queued_at = time.monotonic()
+        self.priority = priority
+        self.command = command
+        self.target = target
+        self.message = message
+        self.coalesce = coalesce
+        self.on_sent = on_sent
+        # (queued_at, on_sent) of the items coalesced into this one
+        self.merged = []
+
+
+# Outbound IRC messages, sent no faster than a token bucket allows so that
+# we don't get kicked for flooding. Lower priorities go first. Messages put
+# with the same coalesce key (e.g. join/leave notices) are held for a moment
+# and then sent as one line.
+class OutboundQueue:
+    _loop = None
+    _send = None
+    _rate = None
+    _burst = None
+    _max_depth = None
+    _coalesce_delay = None
+    _queues = None
+    _wakeup = None
+    _tokens = None
+    _last_refill = None
+    _latencies = None
+    _held = False
+
+    sent = 0
+    dropped = 0
+    # Of those, how many were dropped while held
+    dropped_while_held = 0
+    coalesced = 0
+
+    # send(command, target, message) actually sends a message. rate is in
+    # messages per second, with bursts of up to burst messages.
+    def __init__(self, loop, send, rate=0.5, burst=5, max_depth=100,
+                 coalesce_delay=1.0):
+        self._loop = loop
+        self._send = send
+        self._rate = rate
+        self._burst = burst
+        self._max_depth = max_depth
+        self._coalesce_delay = coalesce_delay
+        self._queues = [collections.deque()
+                        for _ in range(PRIORITY_EVENT + 1)]
+        self._wakeup = asyncio.Event(loop=loop)
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    # on_sent(seconds), if given, is called with how long the message waited
+    # once it has been sent
+    def put(self, command, target, message, priority=PRIORITY_CHAT,
+            coalesce=None, on_sent=None):
+        queue = self._queues[priority]
+        if len(queue) >= self._max_depth:
+            # Old chat is worth less than new chat
+            queue.popleft()
+            self.dropped += 1
+            if self._held:
+                self.dropped_while_held += 1
+        queue.append(_Item(priority, command, target, message, coalesce,
+                           on_sent))
+        self._wakeup.set()
+
+    # While held, messages are queued (dropping the oldest once it fills up)
+    # but not sent, e.g. until we've joined our channels or while we're
+    # disconnected
+    @property
+    def held(self):
+        return self._held
+
+    def hold(self):
+        self._held = True
+
+    def release(self):
+        self._held = False
+        self._wakeup.set()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last_refill) *
+                           self._rate)
+        self._last_refill = now
+
+    # Seconds until the first message can go out, ignoring the bucket, or
+    # None if there's nothing queued
+    def _time_until_ready(self):
+        now = time.monotonic()
+        wait = None
+        for queue in self._queues:
+            if not queue:
+                continue
+            item = queue[0]
+            if item.coalesce is None:
+                return 0
+            left = item.queued_at + self._coalesce_delay - now
+            if left <= 0:
+                return 0
+            wait = left if wait is None else min(wait, left)
+        return wait
+
+    def _pop_ready(self):
+        now = time.monotonic()
+        for queue in self._queues:
+            if not queue:
+                continue
+            item = queue[0]
+            if (item.coalesce is not None and
+                    item.queued_at + self._coalesce_delay > now):
+                continue
+            queue.popleft()
+            if item.coalesce is not None:
+                self._merge(queue, item)
+            return item
+        return None
+
+    # Fold queued messages with the same coalesce key and destination into
+    # item, as long as the result fits on one line
+    def _merge(self, queue, item):
+        remaining = collections.deque()
+        for other in queue:
+            if (other.coalesce == item.coalesce and
+                    other.command == item.command and
+                    other.target == item.target and
+                    len(item.message) + len(other.message) + 2 <= MAX_LINE):
+                item.message += ", " + other.message
+                item.merged.append((other.queued_at, other.on_sent))
+                self.coalesced += 1
+            else:
+                remaining.append(other)
+        queue.clear()
+        queue.extend(remaining)
+
+    async def run(self):
+        while True:
+            wait = self._time_until_ready()
+            if self._held:
+                wait = None
+            if wait is None or wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait,
+                                           loop=self._loop)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+                continue
+
+            # Picked only now so that anything more important that came in
+            # while we waited for a token goes first
+            item = self._pop_ready()
+            if item is None:
+                continue
+            self._tokens -= 1
+
+            try:
+                self._send(item.command, item.target, item.message)
+            except RuntimeError:
+                # Not connected. Put it back and wait until we are.
+                self._queues[item.priority].appendleft(item)
+                self._tokens += 1
+                self.hold()
+                continue
+            self.sent += 1
+            now = time.monotonic()
+            self._latencies.append(now - item.queued_at)
+            waited = [(item.queued_at, item.on_sent)] + item.merged
+            for queued_at, on_sent in waited:
+                if on_sent:
+                    on_sent(now - queued_at)
+
+    def depth(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            "depth": [len(queue) for queue in self._queues],
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "latency_p50": latencies[len(latencies) // 2]
+            if latencies else 0,
+            "latency_max": latencies[-1] if latencies else 0,
+        }
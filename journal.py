@@ -0,0 +1,386 @@
+import json
+import os
+import threading
+import time
+
+
+# Kinds of event
+CHAT = "chat"
+JOIN = "join"
+LEAVE = "leave"
+DEATH = "death"
+# A player running a command in game
+COMMAND = "command"
+# An admin command from IRC
+ADMIN = "admin"
+
+FORMATS = {
+    CHAT: "<{player}> {text}",
+    JOIN: "{player} joined",
+    LEAVE: "{player} left",
+    DEATH: "{player} {text}",
+    COMMAND: "{player} ran /{text}",
+    ADMIN: "{player} (IRC) ran {text}",
+}
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx.json"
+# A merged segment and its index are written under these names first
+MERGE_SUFFIX = ".merge"
+# Segments a merge is replacing, so that a restart can finish it
+PLAN_SUFFIX = ".merge.json"
+
+
+def _encode_offsets(offsets):
+    # Deltas keep the index small; offsets only ever go up
+    deltas = []
+    last = 0
+    for offset in offsets:
+        deltas.append(offset - last)
+        last = offset
+    return deltas
+
+
+def _decode_offsets(deltas):
+    offsets = []
+    last = 0
+    for delta in deltas:
+        last += delta
+        offsets.append(last)
+    return offsets
+
+
+def format_event(kind, player, text):
+    return FORMATS.get(kind, "{player} {kind} {text}").format(
+        kind=kind, player=player, text=text).strip()
+
+
+def _parse_line(line):
+    try:
+        when, kind, player, text = line.decode('utf-8').rstrip(
+            "\n").split(" ", 3)
+        return float(when), kind, player, text
+    except ValueError:
+        return None
+
+
+# One file of events, "time kind player text" per line, oldest first. Once
+# sealed it is never written again and its index (the time span it covers
+# and the offset of each player's events) is saved next to it.
+class _Segment:
+    path = None
+    start = None
+    end = None
+    size = 0
+    sealed = False
+    # player name lowercased -> [offset of each of their events]
+    players = None
+
+    def __init__(self, path):
+        self.path = path
+        self.players = {}
+
+    @property
+    def index_path(self):
+        return self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+    # Read the index, or failing that rebuild it from the events
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            self.start = index["start"]
+            self.end = index["end"]
+            self.size = index["size"]
+            self.players = {player: _decode_offsets(deltas)
+                            for player, deltas in index["players"].items()}
+            self.sealed = True
+            return
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.players = {}
+        self.size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn write; the next append starts a fresh line
+                    break
+                event = _parse_line(line)
+                if event:
+                    self.add(self.size, event[0], event[2])
+                self.size += len(line)
+
+    def add(self, offset, when, player):
+        if self.start is None:
+            self.start = when
+        self.end = when
+        if player != "-":
+            self.players.setdefault(player.lower(), []).append(offset)
+
+    # Write the index, to index_path unless told otherwise
+    def seal(self, index_path=None):
+        index_path = index_path or self.index_path
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"start": self.start, "end": self.end,
+                       "size": self.size,
+                       "players": {player: _encode_offsets(offsets)
+                                   for player, offsets in
+                                   self.players.items()}}, f)
+        os.replace(tmp_path, index_path)
+        self.sealed = True
+
+    def remove(self):
+        for path in (self.index_path, self.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # This player's events at or after since, newest first
+    def events(self, f, player, since):
+        for offset in reversed(self.players.get(player.lower(), [])):
+            f.seek(offset)
+            event = _parse_line(f.readline())
+            if event is None:
+                continue
+            if event[0] < since:
+                return
+            yield event
+
+
+# Append-only journal of what happened on the server (chat, joins and
+# leaves, deaths, commands), kept as a series of segments in directory.
+#
+# The newest segment is appended to until it reaches segment_bytes or
+# covers segment_seconds, and is then sealed and a new one started.
+# Segments are named after when they start, so the time index is just the
+# sorted file names plus each segment's span. Looking up a player reads the
+# indexes of the segments in range and then only that player's lines.
+#
+# Small sealed segments (from quiet days) older than a day are merged into
+# bigger ones, and segments that ended more than retention_days ago are
+# deleted. That happens on an executor thread whenever a segment is sealed,
+# so that appending stays cheap. Lookups block, so run them in an executor
+# too.
+class Journal:
+    _loop = None
+    _directory = None
+    _segment_bytes = None
+    _segment_seconds = None
+    _retention = None
+    # Oldest first; the last one is the one being written
+    _segments = None
+    _file = None
+    # Held while changing _segments
+    _lock = None
+    # Held by maintenance and lookups, so that a lookup never reads a
+    # segment that is being merged away
+    _maintain_lock = None
+    _maintaining = False
+    # Asked for again while it was running
+    _maintain_again = False
+
+    def __init__(self, loop, directory, segment_bytes=4 * 1024 * 1024,
+                 segment_seconds=86400, retention_days=90):
+        self._loop = loop
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._segment_seconds = segment_seconds
+        self._retention = retention_days * 86400
+        self._lock = threading.Lock()
+        self._maintain_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        for filename in os.listdir(directory):
+            if filename.endswith(PLAN_SUFFIX):
+                self._recover_merge(os.path.join(directory, filename))
+        # Left by a merge that died before saving its plan
+        for filename in os.listdir(directory):
+            if MERGE_SUFFIX in filename:
+                os.remove(os.path.join(directory, filename))
+
+        self._segments = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(SEGMENT_SUFFIX):
+                segment = _Segment(os.path.join(directory, filename))
+                segment.load()
+                self._segments.append(segment)
+        # Only the newest segment is ever left unsealed, but make sure
+        for segment in self._segments[:-1]:
+            if not segment.sealed:
+                segment.seal()
+        self._start_maintenance()
+
+    def _new_segment(self, now):
+        name = "{:013d}{}".format(int(now * 1000), SEGMENT_SUFFIX)
+        segment = _Segment(os.path.join(self._directory, name))
+        with self._lock:
+            self._segments.append(segment)
+        return segment
+
+    # Run maintain() on an executor thread, or again once it's done if it's
+    # running already
+    def _start_maintenance(self):
+        if self._maintaining:
+            self._maintain_again = True
+            return
+        self._maintaining = True
+        self._maintain_again = False
+        future = self._loop.run_in_executor(None, self.maintain)
+        future.add_done_callback(self._maintenance_done)
+
+    def _maintenance_done(self, future):
+        self._maintaining = False
+        if not future.cancelled() and future.exception() is not None:
+            print("Journal maintenance failed: {!r}".format(
+                future.exception()))
+        if self._maintain_again:
+            self._start_maintenance()
+
+    def _active(self, now):
+        segment = self._segments[-1] if self._segments else None
+        if segment and not segment.sealed and (
+                segment.size >= self._segment_bytes or
+                (segment.start is not None and
+                 now - segment.start >= self._segment_seconds)):
+            self.close()
+            segment.seal()
+            self._start_maintenance()
+            segment = None
+        if segment is None or segment.sealed:
+            segment = self._new_segment(now)
+        return segment
+
+    def append(self, kind, player, text="", now=None):
+        now = now or time.time()
+        segment = self._active(now)
+        line = "{:.3f} {} {} {}\n".format(
+            now, kind, player or "-",
+            text.replace("\r", " ").replace("\n", " ")).encode('utf-8')
+
+        if self._file is None:
+            self._file = open(segment.path, "ab")
+            if self._file.tell() != segment.size:
+                # Something after a torn write; keep our lines whole
+                line = b"\n" + line
+                segment.size = self._file.tell()
+        self._file.write(line)
+        self._file.flush()
+
+        offset = segment.size + (1 if line[:1] == b"\n" else 0)
+        segment.add(offset, now, player or "-")
+        segment.size += len(line)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # Merge small old segments and drop expired ones. Blocking, and only
+    # touches sealed segments, so it can run alongside append().
+    def maintain(self, now=None):
+        now = now or time.time()
+        with self._maintain_lock:
+            with self._lock:
+                sealed = [x for x in self._segments if x.sealed]
+
+            expired = [x for x in sealed if x.end is None or
+                       x.end < now - self._retention]
+            for segment in expired:
+                segment.remove()
+            with self._lock:
+                for segment in expired:
+                    self._segments.remove(segment)
+                segments = list(self._segments)
+
+            # Merge runs of adjacent sealed segments over a day old into
+            # ones of up to segment_bytes
+            run = []
+            for segment in segments + [None]:
+                old = (segment is not None and segment.sealed and
+                       segment.end < now - 86400)
+                if old and (sum(x.size for x in run) + segment.size <=
+                            self._segment_bytes):
+                    run.append(segment)
+                    continue
+                if len(run) > 1:
+                    self._merge(run)
+                run = [segment] if old else []
+
+    # Merge a run of sealed segments into the first one. Everything is
+    # written under temporary names first, and the plan saved, so that if
+    # we die part way a restart either finishes the merge or forgets it
+    # (see _recover_merge) and no event is lost.
+    def _merge(self, run):
+        first = run[0]
+        base = first.path[:-len(SEGMENT_SUFFIX)]
+        merged = _Segment(first.path)
+        with open(first.path + MERGE_SUFFIX, "wb") as out:
+            for segment in run:
+                with open(segment.path, "rb") as f:
+                    data = f.read(segment.size)
+                base_offset = merged.size
+                for player, offsets in segment.players.items():
+                    merged.players.setdefault(player, []).extend(
+                        base_offset + offset for offset in offsets)
+                merged.size += len(data)
+                out.write(data)
+        merged.start = first.start
+        merged.end = run[-1].end
+        merged.seal(first.index_path + MERGE_SUFFIX)
+
+        with open(base + PLAN_SUFFIX, "w") as f:
+            json.dump([os.path.basename(x.path) for x in run[1:]], f)
+        # From here on a restart finishes the merge
+        os.replace(first.path + MERGE_SUFFIX, first.path)
+        os.replace(first.index_path + MERGE_SUFFIX, first.index_path)
+        for segment in run[1:]:
+            segment.remove()
+        os.remove(base + PLAN_SUFFIX)
+
+        with self._lock:
+            position = self._segments.index(first)
+            self._segments[position:position + len(run)] = [merged]
+
+    # Deal with a merge that was interrupted. If the merged segment didn't
+    # make it into place, the segments are all still there as they were;
+    # otherwise put its index in place too and delete the rest of the run.
+    def _recover_merge(self, plan_path):
+        base = plan_path[:-len(PLAN_SUFFIX)]
+        merged_path = base + SEGMENT_SUFFIX + MERGE_SUFFIX
+        merged_index_path = base + INDEX_SUFFIX + MERGE_SUFFIX
+        if os.path.exists(merged_path):
+            for path in (merged_path, merged_index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        else:
+            if os.path.exists(merged_index_path):
+                os.replace(merged_index_path, base + INDEX_SUFFIX)
+            with open(plan_path, "r") as f:
+                names = json.load(f)
+            for name in names:
+                _Segment(os.path.join(self._directory, name)).remove()
+        os.remove(plan_path)
+
+    # [(time, kind, player, text)] for a player (any case) since a unix
+    # time, newest first, at most limit of them
+    def history(self, player, since=0, limit=10):
+        results = []
+        with self._maintain_lock:
+            with self._lock:
+                segments = list(self._segments)
+            for segment in reversed(segments):
+                if segment.end is not None and segment.end < since:
+                    break
+                if player.lower() not in segment.players:
+                    continue
+                with open(segment.path, "rb") as f:
+                    for event in segment.events(f, player, since):
+                        results.append(event)
+                        if len(results) >= limit:
+                            return results
+        return results
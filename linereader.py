@@ -0,0 +1,128 @@
+import os
+
+
+# Raw copy of everything the server prints, in files of up to max_bytes:
+# path, then path.1 (the previous one) up to path.<backups>. Written a chunk
+# at a time, not a line at a time, so it keeps up with anything the server
+# can print.
+class RotatingCapture:
+    _path = None
+    _max_bytes = None
+    _backups = None
+    _file = None
+    _size = 0
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, backups=3):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+
+    def _open(self):
+        # Unbuffered: each write is already a whole chunk
+        self._file = open(self._path, "ab", buffering=0)
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self._backups - 1, 0, -1):
+            src = "{}.{}".format(self._path, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self._path, i + 1))
+        try:
+            if self._backups > 0:
+                os.replace(self._path, self._path + ".1")
+            else:
+                os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        if self._size and self._size + len(data) > self._max_bytes:
+            self._rotate()
+            self._open()
+        self._file.write(data)
+        self._size += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Splits the server's output into lines as it arrives, in whatever chunks
+# the pipe gives us, rather than with readline(), which gives up on lines
+# longer than the stream's limit. Lines longer than max_line are cut short:
+# on_line gets the first max_line bytes and the rest is skipped up to the
+# next newline. Lines are passed on as bytes, with their newline, and it's
+# up to on_line to decode what it needs.
+class LineReader:
+    _on_line = None
+    _max_line = None
+    _capture = None
+    # The start of a line that didn't end in the chunk it started in
+    _partial = None
+    # In the rest of a line that was too long
+    _skipping = False
+    # Lines cut short
+    truncated = 0
+
+    # partial is the start of a line that a previous reader had read when
+    # it stopped
+    def __init__(self, on_line, max_line=64 * 1024, capture=None,
+                 partial=b""):
+        self._on_line = on_line
+        self._max_line = max_line
+        self._capture = capture
+        self._partial = bytearray(partial)
+
+    # What's been read of a line that hasn't ended yet
+    @property
+    def partial(self):
+        return bytes(self._partial)
+
+    def feed(self, chunk):
+        if self._capture:
+            self._capture.write(chunk)
+
+        on_line = self._on_line
+        max_line = self._max_line
+        partial = self._partial
+
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start) + 1
+            if not end:
+                break
+            if self._skipping:
+                self._skipping = False
+            elif partial:
+                partial += chunk[start:end]
+                self._emit(bytes(partial))
+                del partial[:]
+            elif end - start > max_line:
+                self._emit(chunk[start:end])
+            else:
+                on_line(chunk[start:end])
+            start = end
+
+        if start < len(chunk) and not self._skipping:
+            partial += chunk[start:]
+            if len(partial) > max_line:
+                self._emit(bytes(partial))
+                del partial[:]
+                self._skipping = True
+
+    # The output has ended; pass on whatever's left as a last line
+    def eof(self):
+        if self._partial:
+            self._on_line(bytes(self._partial))
+            del self._partial[:]
+
+    def _emit(self, line):
+        if len(line) > self._max_line:
+            line = line[:self._max_line]
+            self.truncated += 1
+        self._on_line(line)
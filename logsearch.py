@@ -0,0 +1,237 @@
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+
+TAIL_BLOCK_SIZE = 8192
+
+# Rotated logs are named like 2016-05-21-3.log.gz. The server rolls the log
+# over at midnight, so every line in one of them is from that date.
+ROTATED_LOG_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})-(\d+)\.log\.gz$")
+LINE_TIME_RE = re.compile(r"^\[(\d{2}):(\d{2}):(\d{2})")
+# The same, for scanning a block of lines at once. "HH:MM:SS" sorts in time
+# order, so the stamps can be compared as they are.
+LINE_STAMP_RE = re.compile(rb"^\[(\d{2}:\d{2}:\d{2})", re.MULTILINE)
+SCAN_BLOCK_SIZE = 1 << 20
+
+SINCE_RE = re.compile(r"^(\d+)([smhd])$")
+SINCE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+INDEX_NAME = ".logindex.json"
+
+
+# Return the last n lines of a file, reading backwards from the end so that
+# it costs about as much as the lines asked for rather than the whole file
+def tail_lines(path, n):
+    if n <= 0:
+        return []
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        # One extra newline since the file normally ends with one
+        while pos > 0 and data.count(b'\n') <= n:
+            step = min(TAIL_BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+
+    lines = data.decode('utf-8', 'replace').splitlines()
+    return lines[-n:]
+
+
+# Parse "30m", "2h", "7d" (ago) or "2016-05-21" into a unix time, or None
+def parse_since(text, now=None):
+    if now is None:
+        now = time.time()
+
+    match = SINCE_RE.match(text)
+    if match:
+        return now - int(match.group(1)) * SINCE_UNITS[match.group(2)]
+
+    try:
+        return time.mktime(time.strptime(text, "%Y-%m-%d"))
+    except ValueError:
+        return None
+
+
+def _day_start(date):
+    return time.mktime(time.strptime(date, "%Y-%m-%d"))
+
+
+# Yield (unix time, line) for every line of a log whose lines are from the
+# day starting at day_start. Lines without a timestamp (stack traces) get the
+# time of the line before them.
+def _timed_lines(lines, day_start):
+    line_time = day_start
+    last_seconds = 0
+    for line in lines:
+        match = LINE_TIME_RE.match(line)
+        if match:
+            seconds = (int(match.group(1)) * 3600 +
+                       int(match.group(2)) * 60 + int(match.group(3)))
+            if seconds < last_seconds:
+                # Went past midnight without rolling over
+                day_start += 86400
+            last_seconds = seconds
+            line_time = day_start + seconds
+        yield line_time, line
+
+
+# How many times the clock goes past midnight in a log. Only the timestamps
+# matter, so it goes through the file a block at a time rather than a line
+# at a time.
+def _midnights(f):
+    count = 0
+    last = b""
+    partial = b""
+    while True:
+        block = f.read(SCAN_BLOCK_SIZE)
+        data = partial + block
+        if block:
+            # Leave any unfinished line for the next block
+            end = data.rfind(b"\n") + 1
+            partial = data[end:]
+        else:
+            end = len(data)
+        for stamp in LINE_STAMP_RE.findall(data, 0, end):
+            if stamp < last:
+                count += 1
+            last = stamp
+        if not block:
+            return count
+
+
+class LogSearch:
+    _log_dir = None
+    _index = None
+    _index_dirty = False
+    # Held while using _index, since several searches can run at once on
+    # different executor threads
+    _index_lock = None
+
+    def __init__(self, log_dir="logs"):
+        self._log_dir = log_dir
+        self._index = {}
+        self._index_lock = threading.Lock()
+        try:
+            with open(os.path.join(log_dir, INDEX_NAME), "r") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    # Call with _index_lock held
+    def _save_index(self):
+        tmp_path = os.path.join(self._log_dir, INDEX_NAME + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, os.path.join(self._log_dir, INDEX_NAME))
+
+    # Time span (first, last line) of a rotated log, from the index if it is
+    # up to date. Only decompresses logs that we haven't seen before.
+    def _span(self, filename, date):
+        path = os.path.join(self._log_dir, filename)
+        st = os.stat(path)
+        with self._index_lock:
+            entry = self._index.get(filename)
+        if (entry and entry["size"] == st.st_size and
+                entry["mtime"] == st.st_mtime):
+            return entry["start"], entry["end"]
+
+        start = end = None
+        with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+            for line_time, _ in _timed_lines(f, _day_start(date)):
+                if start is None:
+                    start = line_time
+                end = line_time
+        if start is None:
+            start = end = _day_start(date)
+
+        with self._index_lock:
+            self._index_dirty = True
+            self._index[filename] = {
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "start": start,
+                "end": end,
+            }
+        return start, end
+
+    # Rotated logs as (date, sequence, filename), oldest first
+    def _rotated_logs(self):
+        logs = []
+        for filename in os.listdir(self._log_dir):
+            match = ROTATED_LOG_RE.match(filename)
+            if match:
+                logs.append((match.group(1), int(match.group(2)), filename))
+        return sorted(logs)
+
+    # Find lines matching pattern (a compiled regex) logged at or after since
+    # (a unix time, or None for everything), oldest first. Only the newest
+    # max_results are returned. Blocking, so run it in an executor.
+    def grep(self, pattern, since=None, max_results=10):
+        results = []
+
+        def _search(timed_lines):
+            for line_time, line in timed_lines:
+                if since is not None and line_time < since:
+                    continue
+                if pattern.search(line):
+                    results.append(line.rstrip("\n"))
+                    if len(results) > max_results:
+                        del results[0]
+
+        for date, _, filename in self._rotated_logs():
+            # Anything from two days before since can't match even if it
+            # didn't roll over at midnight, so don't even index it
+            if since is not None and _day_start(date) + 86400 * 2 < since:
+                continue
+
+            try:
+                start, end = self._span(filename, date)
+                if since is not None and end < since:
+                    continue
+
+                path = os.path.join(self._log_dir, filename)
+                with gzip.open(path, "rt", encoding="utf-8",
+                               errors="replace") as f:
+                    _search(_timed_lines(f, _day_start(date)))
+            except FileNotFoundError:
+                # Deleted since we listed the directory
+                continue
+
+        with self._index_lock:
+            # Forget logs that have been deleted
+            for filename in list(self._index):
+                if not os.path.exists(os.path.join(self._log_dir, filename)):
+                    del self._index[filename]
+                    self._index_dirty = True
+            if self._index_dirty:
+                self._save_index()
+                self._index_dirty = False
+
+        latest = os.path.join(self._log_dir, "latest.log")
+        try:
+            mtime = os.stat(latest).st_mtime
+        except FileNotFoundError:
+            return results
+        if since is not None and mtime < since:
+            return results
+
+        # The last line was written on the day of the file's mtime. Work
+        # backwards from that in case the server has been up since before
+        # midnight. That takes a first pass over the file, but a cheap one,
+        # and neither pass holds more than a block of it in memory.
+        with open(latest, "rb") as f:
+            days = _midnights(f)
+        day_start = (_day_start(time.strftime("%Y-%m-%d",
+                                              time.localtime(mtime))) -
+                     days * 86400)
+        with open(latest, "r", encoding="utf-8", errors="replace") as f:
+            _search(_timed_lines(f, day_start))
+
+        return results
@@ -1,203 +1,878 @@
 #!/usr/bin/env python3
 
+import archive
 import asyncio
-import asyncio.subprocess
+import auth
+import backup
+import base64
 import binascii
-import bottom
+import classifier
+import collections
 import ed25519
 import errno
+import functools
+import ircclient
+import ircformat
+import ircqueue
+import journal
 import json
+import linereader
+import logsearch
+import metrics
 import os
+import presence
+import rcon
 import re
+import regionstore
+import serverprocess
 import shutil
-import string
+import signal
+import stdinqueue
+import supervisor
 import sys
+import tempfile
 import time
-
-
-IRC_TO_MC_HEX_LUT = [
-    "§f",   # White
-    "§0",   # Black
-    "§1",   # Dark blue
-    "§2",   # Dark green
-    "§c",   # Red
-    "§4",   # Dark red
-    "§5",   # Dark purple
-    "§6",   # Gold
-    "§e",   # Yellow
-    "§a",   # Green
-    "§3",   # Dark aqua
-    "§b",   # Aqua
-    "§9",   # Blue
-    "§d",   # Light purple
-    "§8",   # Dark gray
-    "§7",   # Gray
-]
-
-IRC_TO_MC_NAME_LUT = [
-    "white",
-    "black",
-    "dark_blue",
-    "dark_green",
-    "red",
-    "dark_red",
-    "dark_purple",
-    "gold",
-    "yellow",
-    "green",
-    "dark_aqua",
-    "aqua",
-    "blue",
-    "light_purple",
-    "dark_gray",
-    "gray"
-]
-
-CONTROL_CODES = ('\x00\x01\x02\x03\x04\x05\x06\x07'
-                 '\x08\x09\x0A\x0B\x0C\x0D\x0E\x0F'
-                 '\x10\x11\x12\x13\x14\x15\x16\x17'
-                 '\x18\x19\x1A\x1B\x1C\x1D\x1E\x1F'
-                 '\x80\x81\x82\x83\x84\x85\x86\x87'
-                 '\x88\x89\x8A\x8B\x8C\x8D\x8E\x8F'
-                 '\x90\x91\x92\x93\x94\x95\x96\x97'
-                 '\x98\x99\x9A\x9B\x9C\x9D\x9E\x9F')
-
-
+import traceback
+
+
+# Server log events, matched from just after the "INFO]: " or "WARN]: "
+# marker. See classifier.LineClassifier.
+SERVER_CHAT_RE = rb"<([A-Za-z0-9_]+)> (.*)$"
+SERVER_JOIN_RE = rb"([A-Za-z0-9_]+) ?\[.*\] logged in"
+SERVER_LEAVE_RE = rb"([A-Za-z0-9_]+) lost connection"
+SERVER_DEATH_RE = (rb"([A-Za-z0-9_]+) ((?:was |blew up|burned to death|"
+                   rb"died|didn't want to live|discovered the floor|"
+                   rb"drowned|experienced kinetic|fell |froze to death|"
+                   rb"hit the ground|left the confines|starved|suffocated|"
+                   rb"tried to swim in lava|walked into|went off with|"
+                   rb"went up in flames|withered away).*)$")
+SERVER_ADVANCEMENT_RE = (rb"([A-Za-z0-9_]+) ((?:has made the advancement|"
+                         rb"has completed the challenge|has reached the goal|"
+                         rb"has just earned the achievement) .*)$")
+SERVER_LAG_RE = rb"Can't keep up! .*Running (\d+)ms or (\d+) ticks behind"
+SERVER_DONE_RE = rb"Done \([0-9.]+s\)!"
+SERVER_COMMAND_RE = rb"([A-Za-z0-9_]+) issued server command: /?(.*)$"
+# Answer to "list"
+SERVER_LIST_RE = rb"There are \d+ of a max(?: of)? \d+ players online:(.*)$"
+
+# Backups are made under <timestamp> plus this, until they're complete
+PARTIAL_BACKUP_SUFFIX = ".tmp"
+
+# Seconds
+BACKUP_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Color and formatting codes in command output
+MC_FORMAT_RE = re.compile("§.")
+
+# Set to the path of the handover state when a wrapper re-execs itself to
+# hand its servers over
+HANDOVER_ENV = "MCWRAPPER_HANDOVER"
+
+
+# One Minecraft server: its process, console, backups and logs. IRC is shared
+# between all of them through an InstanceManager.
 class MinecraftServerWrapper:
+    _name = None
+    _log_prefix = ""
     _config = None
     _loop = None
-    _bottom = None
+    _directory = None
+    _irc_queue = None
     _subprocess = None
+    _stdin_queue = None
+    _stdin_task = None
+    _rcon = None
     _backup_task = None
-    _backup_event = None
-    _random = None
-    _nonce = None
-
-    def __init__(self, config, loop):
+    _backup_failures = 0
+    _backup_engine = None
+    _save_coordinator = None
+    _backup_scheduler = None
+    _chunk_store = None
+    _log_search = None
+    _classifier = None
+    _backup_limit = None
+    _lag_warnings = 0
+    _supervisor_task = None
+    _watchdog_task = None
+    _presence_task = None
+    _presence = None
+    _journal = None
+    _watchdog = None
+    _backoff = None
+    # Set when the server is being stopped on purpose
+    _stopping = False
+    # Set while handing the server over to a new wrapper
+    _detaching = False
+    # When the server last went down unexpectedly, if it's not back up yet
+    _down_since = None
+    # (what happened, seconds of downtime or None while still down)
+    _last_incident = None
+    _hang_reason = None
+    _started_at = None
+    # Counters exported as metrics
+    _restarts = 0
+    _skipped_ticks = 0
+    _lag_ms = 0
+    _stdout_lines = 0
+    _stdout_truncated = 0
+    _stdout_reader = None
+    _irc_to_mc_latency = None
+    _mc_to_irc_latency = None
+    _backup_duration = None
+    _backup_bytes = None
+
+    # The backup engine and backup_limit (a semaphore held while backing
+    # up) are shared between instances so that they don't all hit the disk
+    # at once
+    def __init__(self, name, config, loop, irc_queue, backup_engine,
+                 backup_limit, registry):
+        self._name = name
         self._config = config
         self._loop = loop
+        self._directory = config.get("directory", ".")
+        self._irc_queue = irc_queue
+        self._backup_engine = backup_engine
+        self._backup_limit = backup_limit
+
+        # Ensure backup directory exists
+        try:
+            os.mkdir(self.path("backups"))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+        self._save_coordinator = backup.SaveCoordinator(
+            loop, self.mc_command, config.get("backup_save_timeout", 60))
+        self._chunk_store = regionstore.ChunkStore(self.path("backups"))
+        if config.get("backup_mode", "copy") == "archive":
+            archive.check_compression(
+                config.get("backup_compression", "gzip"))
+        self._backup_scheduler = backup.BackupScheduler(
+            config["backup_interval"],
+            config.get("backup_busy_interval"),
+            config.get("backup_busy_players", 4))
+
+        self._watchdog = supervisor.Watchdog(
+            config.get("watchdog_silence", 300),
+            config.get("watchdog_probe_timeout", 30),
+            config.get("watchdog_lag_warnings", 10),
+            config.get("watchdog_lag_window", 300))
+        self._backoff = supervisor.RestartBackoff(
+            config.get("restart_backoff_initial", 5),
+            config.get("restart_backoff_max", 300),
+            config.get("restart_backoff_reset", 600))
+
+        self._log_search = logsearch.LogSearch(self.path("logs"))
+        self._presence = presence.PresenceIndex(
+            self.path("sessions.log"), self.path("sessions.idx.json"))
+        self._journal = journal.Journal(
+            loop, self.path("journal"),
+            config.get("journal_segment_bytes", 4 * 1024 * 1024),
+            config.get("journal_segment_seconds", 86400),
+            config.get("journal_retention_days", 90))
+        self.register_metrics(registry)
+        self._stdin_queue = stdinqueue.StdinQueue(
+            loop, config.get("stdin_queue_depth", 200),
+            self._irc_to_mc_latency)
+
+        if config.get("use_rcon", False):
+            self._rcon = rcon.RconClient(
+                loop, config.get("rcon_host", "127.0.0.1"),
+                config.get("rcon_port", 25575), config["rcon_password"])
+
+        self._classifier = classifier.LineClassifier()
+        self.register_events()
+
+    @property
+    def channel(self):
+        return self._config["irc_channel"]
+
+    # Whether to launch the server as soon as IRC is up
+    @property
+    def autostart(self):
+        return self._config.get("autostart", True)
+
+    def register_metrics(self, registry):
+        labels = {"instance": self._name}
+        registry.gauge(
+            "mcwrapper_server_up", "Whether the server is running"
+        ).set_function(lambda: int(self._subprocess is not None), **labels)
+        registry.gauge(
+            "mcwrapper_server_uptime_seconds", "Time since the server started"
+        ).set_function(lambda: time.monotonic() - self._started_at
+                       if self._subprocess else 0, **labels)
+        registry.counter(
+            "mcwrapper_server_restarts_total",
+            "Automatic restarts after a crash or hang"
+        ).set_function(lambda: self._restarts, **labels)
+        registry.counter(
+            "mcwrapper_lag_warnings_total", "\"Can't keep up!\" warnings"
+        ).set_function(lambda: self._lag_warnings, **labels)
+        registry.counter(
+            "mcwrapper_skipped_ticks_total", "Ticks skipped to catch up"
+        ).set_function(lambda: self._skipped_ticks, **labels)
+        registry.counter(
+            "mcwrapper_lag_milliseconds_total", "Time the server fell behind"
+        ).set_function(lambda: self._lag_ms, **labels)
+        registry.gauge(
+            "mcwrapper_players_online", "Players online"
+        ).set_function(lambda: len(self._presence.online()), **labels)
+        registry.counter(
+            "mcwrapper_stdout_lines_total", "Lines of server output"
+        ).set_function(lambda: self._stdout_lines, **labels)
+        registry.counter(
+            "mcwrapper_stdout_truncated_lines_total",
+            "Lines of server output too long to handle whole"
+        ).set_function(lambda: self._stdout_truncated + (
+            self._stdout_reader.truncated if self._stdout_reader else 0),
+            **labels)
+        registry.gauge(
+            "mcwrapper_stdin_queue_depth", "Commands waiting for stdin"
+        ).set_function(lambda: self._stdin_queue.depth(), **labels)
+
+        self._irc_to_mc_latency = functools.partial(
+            registry.histogram(
+                "mcwrapper_relay_irc_to_mc_seconds",
+                "Time from IRC message to server stdin").observe,
+            **labels)
+        self._mc_to_irc_latency = functools.partial(
+            registry.histogram(
+                "mcwrapper_relay_mc_to_irc_seconds",
+                "Time from server output to IRC").observe,
+            **labels)
+        self._backup_duration = functools.partial(
+            registry.histogram(
+                "mcwrapper_backup_duration_seconds",
+                "Time taken by backups, with autosave off",
+                BACKUP_DURATION_BUCKETS).observe,
+            **labels)
+        registry.counter(
+            "mcwrapper_backup_failures_total", "Scheduled backups that failed"
+        ).set_function(lambda: self._backup_failures, **labels)
+        self._backup_bytes = functools.partial(
+            registry.counter(
+                "mcwrapper_backup_written_bytes_total",
+                "Bytes written by backups").inc,
+            **labels)
+
+    # Path to something in the server's directory
+    def path(self, *parts):
+        return os.path.join(self._directory, *parts)
+
+    # Messages from this instance are tagged with its name when there's more
+    # than one
+    def set_log_prefix(self, prefix):
+        self._log_prefix = prefix
+
+    def log(self, message):
+        print(self._log_prefix + message)
+
+    # Send a console command to the server, if it is running
+    def mc_command(self, command):
+        if self._subprocess:
+            self._stdin_queue.put(command)
+
+    # Run a console command an admin sent. Over RCON, its output goes back
+    # to them; without it, all we can do is write it to stdin. Replies start
+    # with label. Returns False if the command may not have run.
+    async def forward_command(self, nick, command, label=""):
+        if not self._rcon or not self._subprocess:
+            self.mc_command(command)
+            if label:
+                self.irc_reply(label + "Sent to console", nick)
+            return True
+
+        try:
+            await self._rcon.ensure_connected()
+        except (OSError, asyncio.TimeoutError, rcon.RconError) as exception:
+            # Probably still starting up and not listening yet
+            self.log("RCON unavailable: " + str(exception))
+            self.mc_command(command)
+            self.irc_reply(label + "RCON unavailable, sent to console", nick)
+            return True
+
+        try:
+            output = await self._rcon.command(command)
+        except rcon.RconError as exception:
+            # It may well have run, so don't send it again
+            self.irc_reply(label + str(exception), nick)
+            return False
+
+        lines = [line for line in MC_FORMAT_RE.sub("", output).splitlines()
+                 if line.strip()]
+        if not lines:
+            self.irc_reply(label + "Done, no output", nick)
+        max_lines = self._config.get("rcon_max_lines", 10)
+        for line in lines[:max_lines]:
+            self.irc_reply(label + line, nick)
+        if len(lines) > max_lines:
+            self.irc_reply("{}({} more lines)".format(
+                label, len(lines) - max_lines), nick)
+        return True
+
+    # Run a batch of console commands, a JSON list signed as one command,
+    # in order. Stops at the first one that may not have run.
+    async def run_batch(self, nick, batch):
+        try:
+            commands = json.loads(batch)
+        except ValueError:
+            commands = None
+        if (not isinstance(commands, list) or not commands or
+                not all(isinstance(x, str) and x.strip() and "\n" not in x
+                        for x in commands)):
+            self.irc_reply("Bad batch, expected a JSON list of commands",
+                           nick)
+            return
+        if not self._subprocess:
+            self.irc_reply(self._log_prefix + "Server not running", nick)
+            return
 
-        self._backup_event = asyncio.Event(loop=loop)
-
-        self._random = open("/dev/urandom", "rb")
-        self.new_nonce()
+        for i, command in enumerate(commands):
+            label = "{}[{}/{}] ".format(self._log_prefix, i + 1,
+                                        len(commands))
+            if not await self.forward_command(nick, command.strip(), label):
+                self.irc_reply("{}Batch stopped, {} commands not run".format(
+                    self._log_prefix, len(commands) - i - 1), nick)
+                return
+        self.irc_reply("{}Batch done, {} commands".format(
+            self._log_prefix, len(commands)), nick)
 
-    def new_nonce(self):
-        self._nonce = self._random.read(16)
+    def backup_progress(self, files_done, files_total, bytes_done,
+                        bytes_total):
+        percent = 100 * bytes_done // bytes_total if bytes_total else 100
+        self.log("Backup progress: {}% ({}/{} files, {}/{} MiB)".format(
+            percent, files_done, files_total,
+            bytes_done >> 20, bytes_total >> 20))
 
     async def backup_task(self):
+        scheduler = self._backup_scheduler
+        scheduler.reset()
+
         while True:
-            await asyncio.sleep(self._config["backup_interval"])
-            print("Backup...")
+            # Wake up at least once a minute so that a burst of activity can
+            # bring the next backup forward
+            time_left = scheduler.time_left()
+            if time_left > 0:
+                await asyncio.sleep(min(time_left, 60))
+                continue
+
+            try:
+                await self.backup_once(scheduler)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                # Keep to the schedule; the next one may well work
+                self.log("Backup failed:")
+                traceback.print_exc()
+                self._backup_failures += 1
+                self.irc_send("{}Backup failed: {}: {}".format(
+                    self._log_prefix, type(exception).__name__, exception),
+                    priority=ircqueue.PRIORITY_ADMIN)
+                scheduler.reset()
+
+    # One scheduled backup, unless it would be a waste
+    async def backup_once(self, scheduler):
+        index = await self._backup_engine.run(
+            backup.region_index, self.path("world"))
+        if scheduler.is_idle(index):
+            self.log("Backup skipped: nobody online and nothing changed")
+            scheduler.reset()
+            return
 
-            self._subprocess.stdin.write(b'save-all\n')
+        # Only so many instances back up at once. Waiting for our turn
+        # happens before autosave is turned off.
+        async with self._backup_limit:
+            self.log("Backup...")
+
+            # Autosave stays off from here until the copy is done so that
+            # the server can't modify the world files under us
+            try:
+                await self._save_coordinator.pause()
+                self.log("Save done...")
+                # Taken after the flush so that it matches the backup
+                index = await self._backup_engine.run(
+                    backup.region_index, self.path("world"))
+                await self.do_backup()
+            except backup.SaveTimeout as exception:
+                self.log("Backup skipped: " + str(exception))
+                scheduler.reset()
+                return
+            except BaseException:
+                # Cancelled because the server went away, or the copy
+                # failed. Don't wait around, but don't leave autosave off.
+                self._save_coordinator.abort()
+                raise
+            finally:
+                if not self._save_coordinator.idle:
+                    try:
+                        paused = await self._save_coordinator.resume()
+                        self.log("Autosave was paused for {:.1f}s".format(
+                            paused))
+                    except backup.SaveTimeout as exception:
+                        self.log("WARNING: " + str(exception))
+
+            scheduler.reset(index)
+            await self.prune_backups()
+
+    def list_backups(self):
+        existing_backups = os.listdir(self.path("backups"))
+        # Filter out bogus (wrong length or not numbers)
+        existing_backups = [
+            x for x in existing_backups if len(x) == 14 and x.isdigit()]
+
+        # We can sort them by converting them to numbers because we
+        # purposely ordered the fields correctly
+        return sorted(existing_backups, key=int)
+
+    # Delete what's left of backups that didn't finish
+    async def remove_partial_backups(self):
+        for name in os.listdir(self.path("backups")):
+            if name.endswith(PARTIAL_BACKUP_SUFFIX):
+                await self._backup_engine.run(
+                    shutil.rmtree, self.path("backups", name), True)
+
+    async def do_backup(self):
+        await self.remove_partial_backups()
+        existing_backups = self.list_backups()
+        backup_mode = self._config.get("backup_mode", "copy")
+        prev_backup = existing_backups[-1] if existing_backups else None
+
+        # Do this backup. It's made under a name that list_backups()
+        # ignores and only renamed to its timestamp once it's complete, so
+        # that a failed one is never linked from, restored or kept instead
+        # of a good one.
+        now_time = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        partial_name = now_time + PARTIAL_BACKUP_SUFFIX
+        partial_path = self.path("backups", partial_name)
+        started = time.monotonic()
+        # The copy runs on the engine's worker pool so that we keep
+        # draining server stdout and answering IRC while it runs
+        try:
+            if backup_mode == "chunks":
+                # Chunk-level dedup into backups/objects, with only a
+                # manifest in backups/<timestamp>
+                bytes_written = await self._backup_engine.chunk_snapshot(
+                    self._chunk_store, self.path("world"), partial_name,
+                    self.backup_progress, prev_backup)
+            elif backup_mode == "archive":
+                # Compressed tarball plus index in backups/<timestamp>
+                bytes_written = await self._backup_engine.archive_tree(
+                    self.path("world"), partial_path,
+                    self.backup_progress,
+                    self._config.get("backup_compression", "gzip"),
+                    self._config.get("backup_compression_level", 6),
+                    self._config.get("backup_compression_threads",
+                                     self._config.get("backup_threads", 4)))
+            else:
+                # In "link" mode, unchanged files are hard-linked from the
+                # most recent backup instead of being copied again
+                link_dest = None
+                if backup_mode == "link" and prev_backup:
+                    link_dest = self.path("backups", prev_backup)
+                bytes_written = await self._backup_engine.copy_tree(
+                    self.path("world"), partial_path,
+                    self.backup_progress,
+                    link_dest)
+        except BaseException:
+            # Workers may still be finishing off files in there, so this
+            # doesn't wait; anything they leave is removed next time
+            self._backup_engine.run(shutil.rmtree, partial_path, True)
+            raise
+        os.rename(partial_path, self.path("backups", now_time))
+        self._backup_duration(time.monotonic() - started)
+        self._backup_bytes(bytes_written)
+        self.log("Backup OK! ({} MiB written)".format(bytes_written >> 20))
+
+    async def prune_backups(self):
+        existing_backups = self.list_backups()
+        retention = self._config.get("backup_retention")
+        if retention:
+            # Tiered, e.g. {"hourly": 24, "daily": 7, "weekly": 4}
+            backups_to_keep = backup.backups_to_keep(
+                existing_backups, retention)
+            backups_to_delete = [
+                x for x in existing_backups if x not in backups_to_keep]
+        else:
+            # Keep only the specified number of backups
+            backups_to_delete = existing_backups[
+                :-self._config["num_backups"]]
+        if not backups_to_delete:
+            return
 
-            await self._backup_event.wait()
-            print("Save done...")
+        # Now delete the old backups
+        for old_backup in backups_to_delete:
+            self.log("Deleting old backup " + old_backup)
+            await self._backup_engine.remove_tree(
+                self.path("backups", old_backup))
+
+        if self._config.get("backup_mode", "copy") == "chunks":
+            remaining_backups = [
+                x for x in existing_backups if x not in backups_to_delete]
+            freed = await self._backup_engine.run(
+                self._chunk_store.collect_garbage, remaining_backups)
+            self.log("Freed {} MiB of unused chunks".format(freed >> 20))
+
+    def register_events(self):
+        events = [
+            ("chat", SERVER_CHAT_RE, self.on_chat),
+            ("join", SERVER_JOIN_RE, self.on_join),
+            ("leave", SERVER_LEAVE_RE, self.on_leave),
+            ("death", SERVER_DEATH_RE, self.on_death),
+            ("advancement", SERVER_ADVANCEMENT_RE, self.on_advancement),
+            ("command", SERVER_COMMAND_RE, self.on_command),
+        ]
+        for name, pattern in backup.SaveCoordinator.EVENTS.items():
+            self._classifier.register(
+                name, pattern,
+                functools.partial(self._save_coordinator.feed, name))
+
+        for name, pattern, handler in events:
+            self._classifier.register(name, pattern, handler)
+
+        self._classifier.register("lag", SERVER_LAG_RE, self.on_lag,
+                                  level="WARN")
+        self._classifier.register("done", SERVER_DONE_RE, self.on_done)
+        self._classifier.register("list", SERVER_LIST_RE, self.on_list)
+
+    def on_chat(self, player, message):
+        self._journal.append(journal.CHAT, player, message)
+        if not self._config["enable_irc_bridge"]:
+            return
 
-            existing_backups = os.listdir("backups")
-            # Filter out bogus (wrong length or not numbers)
-            existing_backups = [
-                x for x in existing_backups if len(x) == 14 and x.isdigit()]
+        # Only send to IRC if message starts with a !
+        if message[:1] == "!":
+            self.irc_send("<{}> {}".format(player, message[1:]))
+
+    def on_join(self, player):
+        self._journal.append(journal.JOIN, player)
+        self._backup_scheduler.player_joined(player)
+        self._presence.joined(player)
+        if self._config["enable_irc_bridge"]:
+            message = "{} has joined Minecraft".format(player)
+            self.irc_send(message, True, ircqueue.PRIORITY_EVENT, "presence")
+
+    def on_leave(self, player):
+        self._journal.append(journal.LEAVE, player)
+        self._backup_scheduler.player_left(player)
+        self._presence.left(player)
+        if self._config["enable_irc_bridge"]:
+            message = "{} has left Minecraft".format(player)
+            self.irc_send(message, True, ircqueue.PRIORITY_EVENT, "presence")
+
+    def on_death(self, player, message):
+        self._journal.append(journal.DEATH, player, message)
+        if (self._config["enable_irc_bridge"] and
+                self._config.get("relay_game_events", False)):
+            self.irc_send("{} {}".format(player, message), True,
+                          ircqueue.PRIORITY_EVENT)
+
+    def on_advancement(self, player, message):
+        if (self._config["enable_irc_bridge"] and
+                self._config.get("relay_game_events", False)):
+            self.irc_send("{} {}".format(player, message), True,
+                          ircqueue.PRIORITY_EVENT)
+
+    def on_command(self, player, command):
+        self._journal.append(journal.COMMAND, player, command)
+
+    def on_lag(self, ms, ticks):
+        self._lag_warnings += 1
+        self._lag_ms += int(ms)
+        self._skipped_ticks += int(ticks)
+        self._watchdog.lag_warning()
+
+    def on_list(self, players):
+        self._presence.reconcile(
+            [x.strip() for x in players.split(",") if x.strip()])
+
+    # Every so often, ask the server who's online in case we missed a join
+    # or leave line. The answer is picked up by on_list.
+    async def presence_task(self):
+        interval = self._config.get("presence_reconcile_interval", 300)
+        while True:
+            await asyncio.sleep(interval)
+            self.mc_command("list")
 
-            # We can sort them by converting them to numbers because we
-            # purposely ordered the fields correctly
-            existing_backups = sorted(existing_backups, key=int)
-            # Keep only the specified number of backups
-            # Delete one extra because we're just about to make one
-            backups_to_delete = existing_backups[
-                :-self._config["num_backups"] + 1]
-
-            # Do this backup
-            now_time = time.strftime("%Y%m%d%H%M%S", time.gmtime())
-            shutil.copytree("world", "backups/" + now_time)
-            print("Backup OK!")
-
-            # Now delete the old backups
-            for old_backup in backups_to_delete:
-                print("Deleting old backup " + old_backup)
-                shutil.rmtree("backups/" + old_backup)
-
-    # Create the subprocess
-    async def subprocess_create(self):
-        self._subprocess = await asyncio.create_subprocess_exec(
-            *self._config["cmdline"],
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE)
-
-        server_chat_re = re.compile(
-            "INFO\]: <([A-Za-z0-9_]+)> (.*)$")
-        server_join_re = re.compile(
-            "INFO\]: ([A-Za-z0-9_]+) ?\[.*\] logged in")
-        server_leave_re = re.compile(
-            "INFO\]: ([A-Za-z0-9_]+) lost connection")
-
-        saving_re_1 = re.compile("Save complete.")
-        saving_re_2 = re.compile("Saved the world")
+    # Server finished starting up
+    def on_done(self):
+        if self._down_since is None:
+            return
+
+        downtime = time.monotonic() - self._down_since
+        self._down_since = None
+        self._last_incident = (self._last_incident[0], downtime)
+        self.irc_send("{}Server back up after {:.0f}s of downtime".format(
+            self._log_prefix, downtime), priority=ircqueue.PRIORITY_ADMIN)
+
+    def launch(self):
+        if self._supervisor_task and not self._supervisor_task.done():
+            if self._subprocess:
+                return
+            # Waiting to restart after a crash; don't wait any longer
+            self._supervisor_task.cancel()
+
+        self._stopping = False
+        self._supervisor_task = self._loop.create_task(self.supervise())
+
+    # Carry on with a server that was running before a handover: process
+    # is a ServerProcess and state what detach() returned
+    def resume(self, process, state):
+        self._stopping = False
+        self._supervisor_task = self._loop.create_task(
+            self.supervise((process, state)))
+
+    # Why the server can't be handed over right now, or None
+    def handover_blocker(self):
+        if not self._save_coordinator.idle:
+            return "backing up"
+        if self._stopping and self._subprocess:
+            return "stopping"
+        if self._subprocess and not self._subprocess.reading:
+            return "starting"
+        return None
+
+    # Let go of the server so that a new wrapper can take it over. Returns
+    # what the new wrapper needs to resume() it (JSON-friendly, with the
+    # ServerProcess under "process"), {} if it should just be launched, or
+    # None if it should stay stopped.
+    async def detach(self):
+        if not self._supervisor_task or self._supervisor_task.done():
+            return None
+        if not self._subprocess:
+            # Waiting to restart after a crash
+            self._supervisor_task.cancel()
+            return {}
+
+        # Give commands already queued a moment to reach the server. Any
+        # still queued after that are handed over with it.
+        process = self._subprocess
+        deadline = time.monotonic() + self._config.get(
+            "handover_stdin_timeout", 5)
+        while ((self._stdin_queue.depth() or
+                process.stdin.transport.get_write_buffer_size()) and
+               time.monotonic() < deadline):
+            await asyncio.sleep(0.05)
+
+        self._detaching = True
+        try:
+            reader = self._stdout_reader
+            online = self._presence.online()
+            stdin_fd, stdout_fd = process.detach()
+            queued = self._stdin_queue.save()
+            if queued:
+                self.log("Handing over {} queued console commands".format(
+                    len(queued)))
+            await self._supervisor_task
+        finally:
+            self._detaching = False
+
+        return {
+            "process": process,
+            "pid": process.pid,
+            "stdin_fd": stdin_fd,
+            "stdout_fd": stdout_fd,
+            "started_at": self._started_at,
+            "partial": base64.b64encode(reader.partial).decode('ascii'),
+            "online": online,
+            "stdin_queue": queued,
+        }
+
+    # Run the server, and start it again whenever it goes down by itself,
+    # backing off if it keeps crashing. resume is (process, state) to carry
+    # on with a server that's already running.
+    async def supervise(self, resume=None):
+        while True:
+            started = time.monotonic()
+            if resume:
+                started = resume[1]["started_at"]
+            returncode, reason = await self.subprocess_create(resume)
+            resume = None
+            if self._detaching:
+                # Handed over; it's someone else's now
+                return
+
+            if returncode is None:
+                message = "\x02\x0304{}Server failed to start".format(
+                    self._log_prefix)
+            else:
+                message = "\x02\x0304{}Server exited with code {}".format(
+                    self._log_prefix, returncode)
+            if reason:
+                message += " ({})".format(reason)
+
+            # A clean exit means someone ran "stop"
+            if (self._stopping or (returncode == 0 and not reason) or
+                    not self._config.get("auto_restart", True)):
+                self.irc_send(message, priority=ircqueue.PRIORITY_ADMIN)
+                return
+
+            if self._down_since is None:
+                self._down_since = time.monotonic()
+                self._last_incident = (reason or "exit code {}".format(
+                    returncode), None)
+            delay = self._backoff.next_delay(time.monotonic() - started)
+            self.irc_send(message + ", restarting in {}s".format(delay),
+                          priority=ircqueue.PRIORITY_ADMIN)
+            await asyncio.sleep(delay)
+            self._restarts += 1
+
+    async def watchdog_task(self):
+        interval = self._config.get("watchdog_interval", 10)
+        while True:
+            await asyncio.sleep(interval)
+            reason = self._watchdog.check(self.mc_command)
+            if reason:
+                break
+
+        self.log("Server looks hung: " + reason)
+        self.irc_send("{}Server looks hung ({}), stopping it".format(
+            self._log_prefix, reason), priority=ircqueue.PRIORITY_ADMIN)
+        self._hang_reason = reason
+        await self.stop_subprocess()
+
+    # Stop the server: "stop", then SIGTERM, then SIGKILL
+    async def stop_subprocess(self):
+        if not self._subprocess:
+            return
+        await supervisor.stop_process(
+            self._loop, self._subprocess, self.mc_command, "stop",
+            self._config.get("stop_timeout", 60),
+            self._config.get("stop_term_timeout", 30))
+
+    def on_output_line(self, line):
+        self._stdout_lines += 1
+        self._watchdog.output_seen()
+        self._classifier.dispatch(line)
+
+    # Run the server until it exits, or until it's detached for a
+    # handover. Returns (exit code, why the watchdog stopped it or None), or
+    # (None, why) if it couldn't be started.
+    async def subprocess_create(self, resume=None):
+        partial = b""
+        if resume:
+            self._subprocess, state = resume
+            self._started_at = state["started_at"]
+            partial = base64.b64decode(state["partial"])
+            for player, since in state["online"]:
+                self._presence.joined(player, since)
+                self._backup_scheduler.player_joined(player)
+            # Missing if handed over by an older wrapper
+            self._stdin_queue.restore(state.get("stdin_queue", []))
+        else:
+            try:
+                self._subprocess = await serverprocess.ServerProcess.spawn(
+                    self._loop, self._config["cmdline"], self._directory)
+            except OSError as exception:
+                # Say, java isn't there. Retried like a crash, since it may
+                # be back by then.
+                self.log("Couldn't start the server: {}".format(exception))
+                return None, str(exception)
+            self._started_at = time.monotonic()
+        self._stdin_task = self._loop.create_task(
+            self._stdin_queue.run(self._subprocess.stdin))
 
         if self._config["backup_interval"] > 0:
             self._backup_task = self._loop.create_task(self.backup_task())
 
-        while True:
-            # Read from the process
-            output_line = await self._subprocess.stdout.readline()
-
-            if output_line:
-                output_line = output_line.decode('utf-8')
-
-                if (saving_re_1.search(output_line) or
-                        saving_re_2.search(output_line)):
-                    self._backup_event.set()
-                    self._backup_event.clear()
-
-                if self._config["enable_irc_bridge"]:
-                    chat_match = server_chat_re.search(output_line)
-                    if chat_match:
-                        # Only send to IRC if message starts with a !
-                        the_message = chat_match.group(2)
-                        if the_message[0] == "!":
-                            message = "<{}> {}".format(
-                                chat_match.group(1), the_message[1:])
-                            self.irc_send(message)
-
-                    join_match = server_join_re.search(output_line)
-                    if join_match:
-                        message = "{} has joined Minecraft".format(
-                            join_match.group(1))
-                        self.irc_send(message, True)
-
-                    leave_match = server_leave_re.search(output_line)
-                    if leave_match:
-                        message = "{} has left Minecraft".format(
-                            leave_match.group(1))
-                        self.irc_send(message, True)
+        self._hang_reason = None
+        self._watchdog.reset()
+        self._watchdog_task = self._loop.create_task(self.watchdog_task())
+        self._presence_task = self._loop.create_task(self.presence_task())
+
+        capture = None
+        if self._config.get("console_capture"):
+            capture = linereader.RotatingCapture(
+                self.path(self._config["console_capture"]),
+                self._config.get("console_capture_max_bytes",
+                                 16 * 1024 * 1024),
+                self._config.get("console_capture_backups", 3))
+        self._stdout_reader = linereader.LineReader(
+            self.on_output_line,
+            self._config.get("stdout_max_line", 64 * 1024),
+            capture, partial)
+
+        returncode = None
+        try:
+            await self._subprocess.read_stdout(self._stdout_reader.feed)
+
+            if not self._detaching:
+                self._stdout_reader.eof()
+                # stdout closes a moment before the process is reaped
+                returncode = await self._subprocess.wait()
+        finally:
+            self._stdout_truncated += self._stdout_reader.truncated
+            self._stdout_reader = None
+            if capture:
+                capture.close()
+            self._journal.close()
+
+            if self._backup_task:
+                self._backup_task.cancel()
+                self._backup_task = None
+            self._backup_scheduler.server_stopped()
+
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
+            self._presence_task.cancel()
+            self._presence_task = None
+            if self._detaching:
+                # Still online, as far as the next wrapper is concerned
+                self._presence.save_index()
             else:
-                # Killed?
-                # FIXME: This doesn't work half the time
-                message = "\x02\x0304Server exited with code {}".format(
-                    self._subprocess.returncode)
-                self.irc_send(message)
+                self._presence.all_left()
 
-                if self._backup_task:
-                    self._backup_task.cancel()
-                    self._backup_task = None
+            self._stdin_task.cancel()
+            self._stdin_task = None
+            self._stdin_queue.clear()
+            if self._rcon:
+                self._rcon.close()
 
-                self._subprocess = None
-                return
+            if not self._detaching:
+                self._subprocess.close()
+            self._subprocess = None
+
+        return returncode, self._hang_reason
 
     def subprocess_kill(self):
+        self._stopping = True
+
         if self._backup_task:
             self._backup_task.cancel()
             self._backup_task = None
 
         if self._subprocess:
             self._subprocess.kill()
+        elif self._supervisor_task:
+            # Waiting to restart
+            self._supervisor_task.cancel()
 
-    def irc_send(self, message, notice=False):
+    def irc_send(self, message, notice=False,
+                 priority=ircqueue.PRIORITY_CHAT, coalesce=None):
         cmd = 'PRIVMSG' if not notice else 'NOTICE'
-        self._bottom.send(cmd,
-                          target=self._config["irc_channel"],
-                          message=message)
+        # Anything but admin messages is relayed from the server
+        on_sent = None
+        if priority != ircqueue.PRIORITY_ADMIN:
+            on_sent = self._mc_to_irc_latency
+        self._irc_queue.put(cmd, self._config["irc_channel"], message,
+                            priority, coalesce, on_sent)
+
+    # Replies to admin commands go ahead of everything else
+    def irc_reply(self, message, target=None):
+        self._irc_queue.put('PRIVMSG', target or self._config["irc_channel"],
+                            message, ircqueue.PRIORITY_ADMIN)
+
+    # Bridge an IRC event (join, part) to chat
+    def mc_notice(self, message):
+        if not self._config["enable_irc_bridge"]:
+            return
+        if not self._subprocess:
+            return
+
+        if self._config["use_tellraw"]:
+            self._stdin_queue.put_tellraw(["* " + message])
+        else:
+            self._stdin_queue.put("/say " + message,
+                                  stdinqueue.PRIORITY_CHAT)
 
     def mc_send(self, irc_user, message):
         if not self._config["enable_irc_bridge"]:
@@ -206,142 +881,442 @@ class MinecraftServerWrapper:
             return
 
         if self._config["use_tellraw"]:
-            fragments = []
-            fragment = ''
-            is_bold = False
-            is_italics = False
-            is_underline = False
-            color = None
-
-            def _append_now():
-                if not fragment:
+            fragments = ["[IRC] <{}> ".format(irc_user)]
+            fragments.extend(ircformat.to_tellraw(message))
+            self._stdin_queue.put_tellraw(fragments)
+        else:
+            formatted_message = "/say <{}> {}".format(
+                irc_user, ircformat.to_legacy(message))
+            self._stdin_queue.put(formatted_message,
+                                  stdinqueue.PRIORITY_CHAT)
+
+    # Stop the server, if it's running, and wait for it to exit
+    async def shutdown(self):
+        self._stopping = True
+
+        if self._backup_task:
+            self._backup_task.cancel()
+            self._backup_task = None
+
+        if self._subprocess:
+            await self.stop_subprocess()
+        elif self._supervisor_task:
+            self._supervisor_task.cancel()
+
+    # A verified admin command for this instance. is_special_cmd is True
+    # for our own commands ("!!") and False for console commands ("!"),
+    # which may be a batch: 'batch ["command", ...]'.
+    async def handle_command(self, nick, command, is_special_cmd):
+        self._journal.append(journal.ADMIN, nick,
+                             ("!!" if is_special_cmd else "!") + command)
+
+        if not is_special_cmd:
+            # Command to forward to server
+            if command[:6] == "batch ":
+                await self.run_batch(nick, command[6:])
+            else:
+                await self.forward_command(nick, command)
+            return
+
+        # Command for us
+        if command == "kill":
+            self.subprocess_kill()
+        elif command == "launch":
+            self.launch()
+        elif command == "status":
+            if not self._subprocess:
+                message = "Server not running"
+            else:
+                message = "Server running, PID {}, {} online".format(
+                    self._subprocess.pid, len(self._presence.online()))
+            irc_stats = self._irc_queue.stats()
+            message += ", IRC queue {} (p50 {:.1f}s)".format(
+                sum(irc_stats["depth"]), irc_stats["latency_p50"])
+            if self._lag_warnings:
+                message += ", {} lag warnings".format(self._lag_warnings)
+            if self._save_coordinator.last_pause is not None:
+                message += (", autosave paused {:.1f}s for last "
+                            "backup").format(self._save_coordinator.last_pause)
+            if self._last_incident:
+                what, downtime = self._last_incident
+                if downtime is None:
+                    message += ", down for {:.0f}s so far ({})".format(
+                        time.monotonic() - self._down_since, what)
+                else:
+                    message += ", last down for {:.0f}s ({})".format(
+                        downtime, what)
+
+            self.irc_reply(self._log_prefix + message)
+        elif command == "who":
+            now = time.time()
+            online = ["{} ({})".format(player,
+                                       presence.format_duration(now - since))
+                      for player, since in self._presence.online()]
+            if not online:
+                self.irc_reply(self._log_prefix + "Nobody online")
+            else:
+                self.irc_reply("{}Online ({}): {}".format(
+                    self._log_prefix, len(online), ", ".join(online)))
+        elif command[:5] == "seen ":
+            seen = self._presence.seen(command[5:].strip())
+            if not seen:
+                message = "Never seen " + command[5:].strip()
+            else:
+                player, since, last_seen, sessions, total = seen
+                if since is not None:
+                    message = "{} is online (for {})".format(
+                        player, presence.format_duration(time.time() - since))
+                else:
+                    message = "{} was last seen {} ago".format(
+                        player,
+                        presence.format_duration(time.time() - last_seen))
+                message += ", {} sessions, {} in total".format(
+                    sessions, presence.format_duration(total))
+            self.irc_reply(self._log_prefix + message)
+        elif command[:8] == "history ":
+            # history <player> [since]
+            args = command[8:].split()
+            since = 0
+            if len(args) > 1:
+                since = logsearch.parse_since(args[1])
+                if since is None:
+                    self.irc_reply(self._log_prefix + "Bad time: " + args[1])
                     return
 
-                fragment_struct = {
-                    "text": fragment,
-                    "bold": is_bold,
-                    "underlined": is_underline,
-                    "italic": is_italics
-                }
-
-                if color:
-                    fragment_struct["color"] = color
-
-                fragments.append(fragment_struct)
-
-            i = 0
-            while i < len(message):
-                c = message[i]
-                if c not in CONTROL_CODES:
-                    fragment += c
-
-                elif c == '\x02':
-                    _append_now()
-                    fragment = ''
-                    is_bold = not is_bold
-                elif c == '\x1D':
-                    _append_now()
-                    fragment = ''
-                    is_italics = not is_italics
-                elif c == '\x1F':
-                    _append_now()
-                    fragment = ''
-                    is_underline = not is_underline
-
-                elif c == '\x03':
-                    _append_now()
-                    fragment = ''
-
-                    # Color
-                    tmp_color = ''
-                    i += 1
-                    while message[i] in string.digits:
-                        tmp_color += message[i]
-                        i += 1
-                    # Skip bg if given
-                    if message[i] == ',':
-                        i += 1
-                        while message[i] in string.digits:
-                            i += 1
-                    i -= 1
-                    tmp_color = int(tmp_color)
-                    if tmp_color < 16:
-                        color = IRC_TO_MC_NAME_LUT[tmp_color]
-
-                elif c == '\x0F':
-                    # Reset all
-                    _append_now()
-                    fragment = ''
-                    is_bold = is_italics = is_underline = False
-                    color = None
-
-                i += 1
-
-            # Lingering bit
-            _append_now()
-
-            # Prefix
-            fragments.insert(0, "[IRC] <{}> ".format(irc_user))
-
-            json_str = json.dumps(fragments)
-            formatted_message = "/tellraw @a " + json_str
+            events = await self._loop.run_in_executor(
+                None, self._journal.history, args[0], since,
+                self._config.get("history_max_results", 10))
+            if not events:
+                self.irc_reply("{}Nothing from {}".format(self._log_prefix,
+                                                          args[0]))
+            for when, kind, player, text in reversed(events):
+                self.irc_reply("{}{} {}".format(
+                    self._log_prefix,
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(when)),
+                    journal.format_event(kind, player, text)))
+        elif command[:7] == "taillog":
+            lines = 10
+            try:
+                lines = int(command[8:])
+            except ValueError:
+                pass
+
+            for line in logsearch.tail_lines(self.path("logs", "latest.log"),
+                                             lines):
+                self.irc_reply(line)
+        elif command[:5] == "grep ":
+            # grep <pattern> [since]
+            pattern = command[5:].strip()
+            since = logsearch.parse_since(
+                self._config.get("grep_default_since", "1d"))
+            args = pattern.rsplit(maxsplit=1)
+            if len(args) == 2:
+                arg_since = logsearch.parse_since(args[1])
+                if arg_since is not None:
+                    pattern, since = args[0], arg_since
+
+            try:
+                pattern = re.compile(pattern)
+            except re.error as exception:
+                self.irc_reply("Bad pattern: " + str(exception))
+                return
+
+            # Reading rotated logs is slow, keep it off the loop
+            lines = await self._loop.run_in_executor(
+                None, self._log_search.grep, pattern, since,
+                self._config.get("grep_max_results", 10))
+            if not lines:
+                self.irc_reply("No matches")
+            for line in lines:
+                self.irc_reply(line)
         else:
-            # Because of laziness, we don't translate formatting but do handle
-            # colors
-            colored_msg = ''
-            i = 0
-            while i < len(message):
-                c = message[i]
-                if c not in CONTROL_CODES:
-                    colored_msg += c
-                elif c == '\x03':
-                    # Color
-                    color = ''
-                    i += 1
-                    while message[i] in string.digits:
-                        color += message[i]
-                        i += 1
-                    # Skip bg if given
-                    if message[i] == ',':
-                        i += 1
-                        while message[i] in string.digits:
-                            i += 1
-                    i -= 1
-                    color = int(color)
-                    if color < 16:
-                        colored_msg += IRC_TO_MC_HEX_LUT[color]
-                elif c == '\x0F':
-                    # Reset all
-                    colored_msg += '§r'
-
-                i += 1
-            formatted_message = "/say <{}> {}".format(irc_user, colored_msg)
-
-        formatted_message = (formatted_message + "\n").encode('utf-8')
-        self._subprocess.stdin.write(formatted_message)
-
-    # Actual work starts here
-    async def start_wrapper(self):
-        print("Attempting to connect to IRC...")
+            # Bad command
+            message = "Unrecognized command: " + command
+            self.irc_reply(message)
+
+
+# Owns the IRC connection and hands commands and chat to the server
+# instances. Commands go to "@name command", or otherwise to the only
+# instance bridged to the channel they were sent in.
+class InstanceManager:
+    _config = None
+    _loop = None
+    _bottom = None
+    _irc_queue = None
+    _backup_engine = None
+    _instances = None
+    _registry = None
+    _metrics_server = None
+    _joined = None
+    # Our current nick, which may not be the one we asked for
+    _nick = None
+    _registered = False
+    _disconnected = None
+    _join_timer = None
+    _irc_backoff = None
+    _dropped_reported = 0
+    _handing_over = False
+    _random = None
+    _keys = None
+    _nonces = None
+
+    def __init__(self, config, loop, config_path=None):
+        self._config = config
+        self._loop = loop
 
         # Create bottom IRC client
-        self._bottom = bottom.Client(host=self._config["irc_server"],
-                                     port=self._config["irc_port"],
-                                     ssl=False)
+        self._bottom = ircclient.Client(host=config["irc_server"],
+                                        port=config["irc_port"],
+                                        ssl=False)
+        self._disconnected = asyncio.Event(loop=loop)
+        self._irc_backoff = supervisor.RestartBackoff(
+            config.get("irc_reconnect_initial", 5),
+            config.get("irc_reconnect_max", 300),
+            config.get("irc_reconnect_reset", 300))
+
+        # Everything but the handshake and PONGs goes through here so that
+        # we stay within the server's flood limits
+        self._irc_queue = ircqueue.OutboundQueue(
+            loop,
+            lambda cmd, target, message: self._bottom.send(
+                cmd, target=target, message=message),
+            config.get("irc_flood_rate", 0.5),
+            config.get("irc_flood_burst", 5))
+        # Until we're in our channels
+        self._irc_queue.hold()
+        self._joined = set()
+        self._nick = config["irc_nick"]
+
+        self._registry = metrics.Registry()
+        self._registry.gauge(
+            "mcwrapper_irc_queue_depth", "Messages waiting to go to IRC"
+        ).set_function(self._irc_queue.depth)
+        self._registry.counter(
+            "mcwrapper_irc_sent_total", "Messages sent to IRC"
+        ).set_function(lambda: self._irc_queue.sent)
+        self._registry.counter(
+            "mcwrapper_irc_dropped_total",
+            "Messages to IRC dropped because the queue was full"
+        ).set_function(lambda: self._irc_queue.dropped)
+        self._registry.counter(
+            "mcwrapper_irc_dropped_while_disconnected_total",
+            "Messages to IRC dropped while waiting to (re)join"
+        ).set_function(lambda: self._irc_queue.dropped_while_held)
+        self._registry.gauge(
+            "mcwrapper_irc_connected", "Whether we're in our IRC channels"
+        ).set_function(lambda: int(not self._irc_queue.held))
+
+        self._backup_engine = backup.BackupEngine(
+            loop,
+            config.get("backup_threads", 4),
+            config.get("backup_progress_interval", 10))
+        backup_limit = asyncio.Semaphore(config.get("backup_concurrency", 1),
+                                         loop=loop)
+
+        # Without "instances", the whole config is the one instance.
+        # Otherwise each entry overrides the top-level settings for that
+        # instance, e.g. {"survival": {"directory": "survival", ...}}
+        instance_configs = config.get("instances")
+        if instance_configs is None:
+            instance_configs = {config.get("name", "default"): {}}
+        self._instances = collections.OrderedDict()
+        for name in sorted(instance_configs):
+            instance_config = dict(config)
+            instance_config.pop("instances", None)
+            instance_config.update(instance_configs[name])
+            instance = MinecraftServerWrapper(
+                name, instance_config, loop, self._irc_queue,
+                self._backup_engine, backup_limit, self._registry)
+            if len(instance_configs) > 1:
+                instance.set_log_prefix("[{}] ".format(name))
+            self._instances[name] = instance
+
+        self._keys = auth.KeyCache(config["users"], config_path)
+        self._random = open("/dev/urandom", "rb")
+        self._nonces = auth.NoncePool(self._random,
+                                      config.get("nonce_pool_size", 8),
+                                      config.get("nonce_ttl", 300))
+
+    def channels(self):
+        return sorted(set(x.channel for x in self._instances.values()))
+
+    # Instances bridged to an IRC channel
+    def instances_for(self, channel):
+        if len(self._instances) == 1:
+            return list(self._instances.values())
+        return [x for x in self._instances.values()
+                if x.channel.lower() == channel.lower()]
+
+    # Pick the instance a command is for. Returns (instance, command), with
+    # instance None if there's no telling.
+    def route(self, target, command):
+        if command[:1] == "@":
+            name, _, command = command[1:].partition(" ")
+            return self._instances.get(name), command.strip()
+
+        instances = self.instances_for(target)
+        if len(instances) == 1:
+            return instances[0], command
+        return None, command
+
+    async def shutdown(self):
+        print("Shutting down!")
+
+        await asyncio.gather(*[x.shutdown()
+                               for x in self._instances.values()],
+                             loop=self._loop)
+        if self._metrics_server:
+            self._metrics_server.close()
+        self._bottom.send('QUIT', message=":( :( :( ")
+        self._loop.stop()
+
+    # Replace this wrapper with a fresh copy of itself (picking up code and
+    # config changes) without stopping the servers: let go of them, then
+    # exec() with their PIDs and console pipes in HANDOVER_ENV's file.
+    # The servers are our children and stay so across exec(), and the
+    # pipes are inherited, so the new wrapper carries on where we stopped.
+    async def handover(self, nick=None):
+        if self._handing_over:
+            return
+        for name, instance in self._instances.items():
+            blocker = instance.handover_blocker()
+            if blocker:
+                message = "Can't hand over now, {} is {}".format(name,
+                                                                blocker)
+                print(message)
+                if nick:
+                    self.irc_reply(message, nick)
+                return
 
-        # Basic IRC handlers
-        @self._bottom.on('NOTICE')
-        def irc_notice(message, **kwargs):
-            print(message)
+        self._handing_over = True
+        print("Handing over to a new wrapper...")
+        states = collections.OrderedDict()
+        for name, instance in self._instances.items():
+            states[name] = await instance.detach()
+
+        fd, path = tempfile.mkstemp(prefix="mcwrapper-handover-",
+                                    suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"instances": {
+                name: state and {k: v for k, v in state.items()
+                                 if k != "process"}
+                for name, state in states.items()}}, f)
+
+        try:
+            self._bottom.send('QUIT', message="Restarting")
+        except RuntimeError:
+            pass
+        sys.stdout.flush()
+        os.environ[HANDOVER_ENV] = path
+        try:
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except OSError as exception:
+            print("Handover failed: " + str(exception))
+
+        # Still us; carry on as before
+        del os.environ[HANDOVER_ENV]
+        os.remove(path)
+        self._handing_over = False
+        for name, state in states.items():
+            if state and "process" in state:
+                await state["process"].reattach()
+                self._instances[name].resume(state["process"], state)
+            elif state is not None:
+                self._instances[name].launch()
+
+    # Pick up the servers a previous wrapper handed over (see handover)
+    async def take_over(self, handover):
+        for name, state in handover["instances"].items():
+            instance = self._instances.get(name)
+            if state is None:
+                continue
+            if "pid" not in state:
+                if instance:
+                    instance.launch()
+                continue
+
+            process = await serverprocess.ServerProcess.attach(
+                self._loop, state["pid"], state["stdin_fd"],
+                state["stdout_fd"])
+            if instance:
+                print("Took over {} (PID {})".format(name, state["pid"]))
+                instance.resume(process, state)
+                continue
+
+            # No longer in the config
+            print("{} is no longer configured, stopping it".format(name))
+            self._loop.create_task(self.stop_orphan(process))
+
+    async def stop_orphan(self, process):
+        await supervisor.stop_process(
+            self._loop, process,
+            lambda command: process.stdin.write(
+                (command + "\n").encode('utf-8')),
+            "stop", self._config.get("stop_timeout", 60),
+            self._config.get("stop_term_timeout", 30))
+        process.close()
+
+    # Actual work starts here. handover is the state a previous wrapper
+    # handed over, if any.
+    async def start(self, handover=None):
+        if self._config.get("metrics_port"):
+            self._metrics_server = metrics.MetricsServer(self._loop,
+                                                         self._registry)
+            await self._metrics_server.start(
+                self._config.get("metrics_host", "127.0.0.1"),
+                self._config["metrics_port"])
+
+        # The servers don't need IRC, so don't make them wait for it.
+        # Whatever they want to say is held in the IRC queue until we've
+        # joined our channels.
+        if handover:
+            await self.take_over(handover)
+        for name, instance in self._instances.items():
+            if instance.autostart and not (
+                    handover and name in handover["instances"]):
+                instance.launch()
+
+        self.register_irc_handlers()
+        self._loop.create_task(self._irc_queue.run())
+        await self.irc_task()
+
+    # Stay connected to IRC, reconnecting with backoff whenever the
+    # connection drops or can't be made. Messages queue up in the meantime.
+    async def irc_task(self):
+        while True:
+            connected_at = time.monotonic()
+            try:
+                await self.irc_connect()
+                await self._disconnected.wait()
+                print("Lost IRC connection")
+            except (OSError, RuntimeError, asyncio.TimeoutError) as exception:
+                # RuntimeError is bottom's "Not connected"
+                print("Couldn't connect to IRC: {!r}".format(exception))
+                await self._bottom.disconnect()
+
+            self._irc_queue.hold()
+            delay = self._irc_backoff.next_delay(
+                time.monotonic() - connected_at)
+            print("Reconnecting to IRC in {}s".format(delay))
+            await asyncio.sleep(delay)
+
+    async def irc_connect(self):
+        print("Attempting to connect to IRC...")
 
-        @self._bottom.on('PING')
-        def keepalive(message, **kwargs):
-            self._bottom.send('PONG', message=message)
+        self._registered = False
+        self._joined.clear()
+        self._disconnected.clear()
+        if self._join_timer:
+            self._join_timer.cancel()
+            self._join_timer = None
 
         # Connect and then send username
-        await self._bottom.connect()
+        self._nick = self._config["irc_nick"]
+        await asyncio.wait_for(self._bottom.connect(),
+                               self._config.get("irc_connect_timeout", 30),
+                               loop=self._loop)
         self._bottom.send('PASS', password=self._config["irc_password"])
-        self._bottom.send('NICK', nick=self._config["irc_nick"])
+        self._bottom.send('NICK', nick=self._nick)
         self._bottom.send('USER', user=self._config["irc_nick"],
                           realname=self._config["irc_nick"])
 
@@ -350,8 +1325,10 @@ class MinecraftServerWrapper:
         # Wait on MOTD
         done, pending = await asyncio.wait(
             [self._bottom.wait("RPL_ENDOFMOTD"),
-             self._bottom.wait("ERR_NOMOTD")],
+             self._bottom.wait("ERR_NOMOTD"),
+             self._disconnected.wait()],
             loop=self._loop,
+            timeout=self._config.get("irc_register_timeout", 60),
             return_when=asyncio.FIRST_COMPLETED
         )
 
@@ -359,30 +1336,91 @@ class MinecraftServerWrapper:
         for future in pending:
             future.cancel()
 
+        if not done:
+            raise asyncio.TimeoutError("No MOTD")
+        if self._disconnected.is_set():
+            raise ConnectionError("Disconnected while registering")
+        self._registered = True
+
         print("Joining channel...")
 
-        self._bottom.send('JOIN', channel=self._config["irc_channel"])
+        for channel in self.channels():
+            self._bottom.send('JOIN', channel=channel)
+        # In case we can't get into one of them
+        self._join_timer = self._loop.call_later(
+            self._config.get("irc_join_timeout", 30), self.irc_ready)
+
+    # In our channels, so send whatever's been waiting
+    def irc_ready(self):
+        if self._join_timer:
+            self._join_timer.cancel()
+            self._join_timer = None
+        if not self._irc_queue.held:
+            return
+
+        print("IRC ready!")
+        dropped = self._irc_queue.dropped_while_held - self._dropped_reported
+        self._dropped_reported = self._irc_queue.dropped_while_held
+        if self._irc_queue.depth() or dropped:
+            print("Sending {} held IRC messages ({} dropped)".format(
+                self._irc_queue.depth(), dropped))
+        self._irc_queue.release()
+
+    def register_irc_handlers(self):
+        # Basic IRC handlers
+        @self._bottom.on('NOTICE')
+        def irc_notice(message, **kwargs):
+            print(message)
+
+        @self._bottom.on('PING')
+        def keepalive(message, **kwargs):
+            self._bottom.send('PONG', message=message)
+
+            # Try to get our nick back
+            if self._registered and self._nick != self._config["irc_nick"]:
+                self._bottom.send('NICK', nick=self._config["irc_nick"])
+
+        @self._bottom.on('CLIENT_DISCONNECT')
+        def irc_disconnect(**kwargs):
+            self._irc_queue.hold()
+            self._disconnected.set()
+
+        @self._bottom.on('ERR_NICKNAMEINUSE')
+        @self._bottom.on('ERR_NICKCOLLISION')
+        @self._bottom.on('ERR_UNAVAILRESOURCE')
+        def irc_nick_taken(nick, **kwargs):
+            if self._registered:
+                # Still can't have our own nick back; keep this one
+                return
+            self._nick += "_"
+            print("Nick taken, trying " + self._nick)
+            self._bottom.send('NICK', nick=self._nick)
+
+        @self._bottom.on('NICK')
+        def irc_nick(nick, new_nick, **kwargs):
+            if nick == self._nick:
+                self._nick = new_nick
 
-        # Register message handler
         @self._bottom.on('PRIVMSG')
         async def privmsg(nick, target, message, **kwargs):
             # User must be authorized
-            if nick not in self._config["users"]:
+            self._keys.maybe_reload()
+            if nick not in self._keys:
                 # Not a command, send to MC
-                self.mc_send(nick, message)
+                self.mc_send(nick, target, message)
                 return
 
             fragments = message.strip().split(maxsplit=2)
             if len(fragments) != 3:
                 # Not a command, send to MC
-                self.mc_send(nick, message)
+                self.mc_send(nick, target, message)
                 return
 
             # Command must start with "!<nick>" or "!!<nick>"
             if ((fragments[0] != ("!" + self._config["irc_nick"])) and
                     (fragments[0] != ("!!" + self._config["irc_nick"]))):
                 # Forward to minecraft, not a command
-                self.mc_send(nick, message)
+                self.mc_send(nick, target, message)
                 return
 
             is_special_cmd = fragments[0][:2] == "!!"
@@ -391,115 +1429,71 @@ class MinecraftServerWrapper:
             real_command = fragments[2]
 
             if real_command == "nonce":
-                nonce_text = binascii.hexlify(self._nonce).decode('ascii')
-                self._bottom.send('PRIVMSG', message=nonce_text, target=nick)
+                nonce = self._nonces.issue(nick)
+                nonce_text = binascii.hexlify(nonce).decode('ascii')
+                self.irc_reply(nonce_text, nick)
                 return
 
-            # Sigcheck command
+            # Sigcheck command. The signature covers the "@instance" too, so
+            # it can't be pointed at another server.
             if self._config["enable_sig_verify"]:
                 # Signature must be this length
                 if len(fragments[1]) != 86:
                     print("Signature invalid!")
                     return
 
-                vk_enc = self._config["users"][nick]
-                vk = ed25519.VerifyingKey(vk_enc, encoding='base64')
-
-                bytes_to_sign = b'\x00' if not is_special_cmd else b'\x01'
-                bytes_to_sign += self._nonce
-                bytes_to_sign += real_command.encode('utf-8')
-
-                try:
-                    vk.verify(fragments[1], bytes_to_sign, encoding='base64')
-                except ed25519.BadSignatureError:
+                # Any of the user's outstanding nonces will do; whichever
+                # one the signature is over is used up
+                vk = self._keys.get(nick)
+                prefix = b'\x00' if not is_special_cmd else b'\x01'
+                command_bytes = real_command.encode('utf-8')
+                nonces = self._nonces.outstanding(nick) if vk else []
+                for nonce in nonces:
+                    try:
+                        vk.verify(fragments[1], prefix + nonce + command_bytes,
+                                  encoding='base64')
+                    except ed25519.BadSignatureError:
+                        continue
+                    self._nonces.consume(nick, nonce)
+                    break
+                else:
                     print("Signature invalid!")
                     return
 
-            self.new_nonce()
-
-            if not is_special_cmd:
-                # Command to forward to server
-                if self._subprocess:
-                    real_command = (real_command + "\n").encode('utf-8')
-                    self._subprocess.stdin.write(real_command)
-            else:
-                # Command for us
-                if real_command == "kill":
-                    self.subprocess_kill()
-                elif real_command == "launch":
-                    if self._subprocess:
-                        return
-                    self._loop.create_task(self.subprocess_create())
-                elif real_command == "status":
-                    if not self._subprocess:
-                        message = "Server not running"
-                    else:
-                        message = "Server running, PID {}".format(
-                            self._subprocess.pid)
-
-                    self.irc_send(message)
-                elif real_command == "all-shutdown":
-                    print("Shutting down!")
-
-                    if self._backup_task:
-                        self._backup_task.cancel()
-                        self._backup_task = None
-
-                    if self._subprocess:
-                        self._subprocess.stdin.write(b"stop\n")
-                        await self._subprocess.wait()
-                    self._bottom.send('QUIT', message=":( :( :( ")
-                    self._loop.stop()
-                    return
-                elif real_command[:7] == "taillog":
-                    lines = 10
-                    try:
-                        lines = int(real_command[8:])
-                    except ValueError:
-                        pass
+            if is_special_cmd and real_command == "all-shutdown":
+                await self.shutdown()
+                return
+            if is_special_cmd and real_command == "handover":
+                await self.handover(nick)
+                return
 
-                    with open("logs/latest.log", "r") as f:
-                        # FIXME: Ugly
-                        lines = f.readlines()[-lines:]
+            instance, real_command = self.route(target, real_command)
+            if not instance:
+                self.irc_reply("Which server? Use @name, one of: " +
+                               ", ".join(self._instances), nick)
+                return
 
-                        for line in lines:
-                            self.irc_send(line)
-                else:
-                    # Bad command
-                    message = "Unrecognized command: " + real_command
-                    self.irc_send(message)
+            await instance.handle_command(nick, real_command, is_special_cmd)
 
         @self._bottom.on('JOIN')
-        def irc_join(nick, user, host, **kwargs):
-            if not self._config["enable_irc_bridge"]:
-                return
-            if not self._subprocess:
-                return
-
-            if nick == self._config["irc_nick"]:
-                # Ourselves
+        def irc_join(nick, user, host, channel, **kwargs):
+            if nick == self._nick:
+                # Ourselves. Send what's been held back once we're in every
+                # channel.
+                self._joined.add(channel.lower())
+                if self._joined >= set(x.lower() for x in self.channels()):
+                    self.irc_ready()
                 return
 
             message = "{} has joined IRC ({}!{}@{})".format(
                 nick, nick, user, host)
 
-            if self._config["use_tellraw"]:
-                json_msg = json.dumps(["* " + message])
-                formatted_message = "/tellraw @a " + json_msg
-            else:
-                formatted_message = "/say " + message
-
-            formatted_message = (formatted_message + "\n").encode('utf-8')
-            self._subprocess.stdin.write(formatted_message)
+            for instance in self.instances_for(channel):
+                instance.mc_notice(message)
 
         @self._bottom.on('PART')
-        def irc_part(nick, user, host, message, **kwargs):
-            if not self._config["enable_irc_bridge"]:
-                return
-            if not self._subprocess:
-                return
-
-            if nick == self._config["irc_nick"]:
+        def irc_part(nick, user, host, channel, message, **kwargs):
+            if nick == self._nick:
                 # Ourselves
                 return
 
@@ -509,20 +1503,18 @@ class MinecraftServerWrapper:
                 message += " (" + part_message + ")"
             print(message)
 
-            if self._config["use_tellraw"]:
-                json_msg = json.dumps(["* " + message])
-                formatted_message = "/tellraw @a " + json_msg
-            else:
-                formatted_message = "/say " + message
+            for instance in self.instances_for(channel):
+                instance.mc_notice(message)
 
-            formatted_message = (formatted_message + "\n").encode('utf-8')
-            self._subprocess.stdin.write(formatted_message)
-            print(formatted_message)
 
-        print("IRC ready!")
+    # Replies to admin commands go ahead of everything else
+    def irc_reply(self, message, target):
+        self._irc_queue.put('PRIVMSG', target, message,
+                            ircqueue.PRIORITY_ADMIN)
 
-        # Launch subprocess
-        self._loop.create_task(self.subprocess_create())
+    def mc_send(self, nick, target, message):
+        for instance in self.instances_for(target):
+            instance.mc_send(nick, message)
 
 
 def main():
@@ -534,17 +1526,21 @@ def main():
     with open(sys.argv[1], 'r') as f:
         config = json.load(f)
 
-    # Ensure backup directory exists
-    try:
-        os.mkdir("backups")
-    except OSError as exception:
-        if exception.errno != errno.EEXIST:
-            raise
+    # Left by the wrapper we're taking over from
+    handover = None
+    handover_path = os.environ.pop(HANDOVER_ENV, None)
+    if handover_path:
+        with open(handover_path, 'r') as f:
+            handover = json.load(f)
+        os.remove(handover_path)
 
     # Start event loop
     loop = asyncio.get_event_loop()
-    serv = MinecraftServerWrapper(config, loop)
-    loop.create_task(serv.start_wrapper())
+    manager = InstanceManager(config, loop, sys.argv[1])
+    # SIGHUP hands over to a new wrapper, e.g. after an upgrade
+    loop.add_signal_handler(signal.SIGHUP,
+                            lambda: loop.create_task(manager.handover()))
+    loop.create_task(manager.start(handover))
     loop.run_forever()
     loop.close()
 
@@ -0,0 +1,192 @@
+import asyncio
+import bisect
+
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in key) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# Counters and gauges are either updated here or, with set_function, read
+# from somewhere else when scraped. The latter keeps things like the count
+# of stdout lines down to a plain "+= 1" where they happen.
+class _Metric:
+    TYPE = None
+
+    name = None
+    documentation = None
+    _values = None
+    _functions = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._functions = {}
+
+    def set_function(self, func, **labels):
+        self._functions[_label_key(labels)] = func
+
+    def samples(self):
+        values = dict(self._values)
+        for key, func in self._functions.items():
+            values[key] = func()
+        for key, value in sorted(values.items()):
+            yield self.name, key, value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        for name, key, value in self.samples():
+            lines.append("{}{} {}".format(name, _format_labels(key),
+                                          _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        self._values[_label_key(labels)] = value
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    _buckets = None
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self._buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # Per-bucket (not cumulative) counts, then the sum
+            counts = self._values[key] = [0] * len(self._buckets) + [0]
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for key, counts in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self._buckets, counts):
+                total += count
+                yield (self.name + "_bucket",
+                       key + (("le", _format_value(float(bound))),), total)
+            yield self.name + "_sum", key, counts[-1]
+            yield self.name + "_count", key, total
+
+
+# Every metric we export. Asking for one that already exists returns it, so
+# each server instance can look up the same metrics and tell its own apart
+# with labels.
+class Registry:
+    _metrics = None
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, cls, name, documentation, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, documentation, *args)
+        elif not isinstance(metric, cls):
+            raise ValueError("{} is already a {}".format(name, metric.TYPE))
+        return metric
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets)
+
+    # The Prometheus text exposition format
+    def render(self):
+        return "\n".join(metric.render() for _, metric in
+                         sorted(self._metrics.items())) + "\n"
+
+
+# Serves the registry over HTTP at /metrics. Scrapes are tiny, so this runs
+# on the wrapper's own event loop.
+class MetricsServer:
+    _loop = None
+    _registry = None
+    _server = None
+
+    def __init__(self, loop, registry):
+        self._loop = loop
+        self._registry = registry
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(
+            self._handle, host, port, loop=self._loop)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10,
+                                             loop=self._loop)
+            # Skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10,
+                                              loop=self._loop)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = request.split()
+            if len(parts) < 2 or parts[0] != b"GET":
+                status, body = "405 Method Not Allowed", ""
+            elif parts[1].split(b"?")[0] not in (b"/", b"/metrics"):
+                status, body = "404 Not Found", ""
+            else:
+                status, body = "200 OK", self._registry.render()
+
+            body = body.encode('utf-8')
+            writer.write((
+                "HTTP/1.0 {}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                "Content-Length: {}\r\n"
+                "\r\n").format(status, len(body)).encode('ascii') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+
+# Save the index after this many sessions have been appended
+INDEX_EVERY = 20
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return "{}s".format(seconds)
+    minutes = seconds // 60
+    if minutes < 60:
+        return "{}m".format(minutes)
+    hours, minutes = divmod(minutes, 60)
+    if hours < 48:
+        return "{}h {}m".format(hours, minutes)
+    days, hours = divmod(hours, 24)
+    return "{}d {}h".format(days, hours)
+
+
+# Who's online and since when, kept up to date from join/leave lines, plus
+# everyone's session history.
+#
+# Finished sessions are appended to history_path as "start end player" lines
+# (unix times). A per-player summary (last seen, number of sessions, total
+# time) is kept in memory and saved every so often to index_path along with
+# how far into the history it covers, so loading it only has to read the
+# sessions appended since.
+class PresenceIndex:
+    _history_path = None
+    _index_path = None
+    # player -> session start (unix time)
+    _online = None
+    # player name lowercased -> [player, last seen, sessions, total seconds]
+    _players = None
+    _history_size = 0
+    _unindexed = 0
+
+    def __init__(self, history_path, index_path):
+        self._history_path = history_path
+        self._index_path = index_path
+        self._online = {}
+        self._players = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+            self._players = index["players"]
+            self._history_size = index["size"]
+        except (OSError, ValueError, KeyError):
+            self._players = {}
+            self._history_size = 0
+
+        try:
+            size = os.path.getsize(self._history_path)
+        except OSError:
+            size = 0
+        if size < self._history_size:
+            # History was truncated or replaced; start over
+            self._players = {}
+            self._history_size = 0
+        if size == self._history_size:
+            return
+
+        with open(self._history_path, "rb") as f:
+            f.seek(self._history_size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn write; the next append starts a fresh line
+                    break
+                self._history_size += len(line)
+                try:
+                    start, end, player = line.decode('utf-8').split()
+                    self._add_session(player, int(start), int(end))
+                except ValueError:
+                    continue
+        self.save_index()
+
+    def save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self._history_size, "players": self._players},
+                      f)
+        os.replace(tmp_path, self._index_path)
+        self._unindexed = 0
+
+    def _add_session(self, player, start, end):
+        entry = self._players.setdefault(player.lower(), [player, 0, 0, 0])
+        entry[0] = player
+        entry[1] = max(entry[1], end)
+        entry[2] += 1
+        entry[3] += end - start
+
+    def _end_session(self, player, now):
+        start = self._online.pop(player)
+        start, end = int(start), int(now)
+        self._add_session(player, start, end)
+
+        line = "{} {} {}\n".format(start, end, player).encode('utf-8')
+        with open(self._history_path, "ab") as f:
+            if f.tell() != self._history_size:
+                # Something after a torn write; keep our lines whole
+                line = b"\n" + line
+                self._history_size = f.tell()
+            f.write(line)
+        self._history_size += len(line)
+
+        self._unindexed += 1
+        if self._unindexed >= INDEX_EVERY:
+            self.save_index()
+
+    def joined(self, player, now=None):
+        if player not in self._online:
+            self._online[player] = now or time.time()
+
+    def left(self, player, now=None):
+        if player in self._online:
+            self._end_session(player, now or time.time())
+
+    # Everyone's gone (the server stopped)
+    def all_left(self, now=None):
+        now = now or time.time()
+        for player in list(self._online):
+            self._end_session(player, now)
+        self.save_index()
+
+    # Make the online set match players (e.g. from "list"), in case we missed
+    # a join or leave line
+    def reconcile(self, players, now=None):
+        now = now or time.time()
+        players = set(players)
+        for player in list(self._online):
+            if player not in players:
+                self._end_session(player, now)
+        for player in players:
+            self.joined(player, now)
+
+    # [(player, online since)], longest online first
+    def online(self):
+        return sorted(self._online.items(), key=lambda x: (x[1], x[0]))
+
+    # (player, online since or None, last seen, sessions, total seconds)
+    # for a player (any case), or None if we've never seen them
+    def seen(self, name):
+        now = time.time()
+        for player, since in self._online.items():
+            if player.lower() == name.lower():
+                entry = self._players.get(name.lower(), [player, 0, 0, 0])
+                return (player, since, now, entry[2] + 1,
+                        entry[3] + now - since)
+
+        entry = self._players.get(name.lower())
+        if entry is None:
+            return None
+        return entry[0], None, entry[1], entry[2], entry[3]
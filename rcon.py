@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import struct
+import sys
+
+
+TYPE_RESPONSE = 0
+TYPE_COMMAND = 2
+TYPE_LOGIN = 3
+# Any type the server doesn't know. It answers these with an error message,
+# but only after it is done with everything sent before, which tells us
+# where a long (multi-packet) response ends.
+TYPE_MARKER = 200
+
+HEADER = struct.Struct("<iii")
+
+# The server won't take a request longer than this
+MAX_PAYLOAD = 1446
+
+
+class RconError(Exception):
+    pass
+
+
+def encode_packet(request_id, packet_type, payload):
+    return (HEADER.pack(len(payload) + 10, request_id, packet_type) +
+            payload + b"\x00\x00")
+
+
+async def read_packet(reader):
+    header = await reader.readexactly(HEADER.size)
+    length, request_id, packet_type = HEADER.unpack(header)
+    if length < 10:
+        raise RconError("Bad packet length {}".format(length))
+    body = await reader.readexactly(length - 8)
+    return request_id, packet_type, body[:-2]
+
+
+def _retrieve_exception(future):
+    if not future.cancelled():
+        future.exception()
+
+
+# Client for the server's RCON port. Any number of commands may be in flight
+# at once; replies are matched up with their command by request ID.
+class RconClient:
+    _loop = None
+    _host = None
+    _port = None
+    _password = None
+    _timeout = None
+    _reader = None
+    _writer = None
+    _read_task = None
+    _connect_lock = None
+    _ids = None
+    # request ID -> list of response payloads so far
+    _responses = None
+    # marker request ID -> (command request ID, future)
+    _markers = None
+
+    def __init__(self, loop, host, port, password, timeout=10):
+        self._loop = loop
+        self._host = host
+        self._port = port
+        self._password = password
+        self._timeout = timeout
+        self._connect_lock = asyncio.Lock(loop=loop)
+        self._ids = itertools.count(1)
+        self._responses = {}
+        self._markers = {}
+
+    @property
+    def connected(self):
+        return self._read_task is not None and not self._read_task.done()
+
+    def _next_id(self):
+        # Stay positive, the server answers a bad login with -1
+        request_id = next(self._ids)
+        if request_id >= 2 ** 31 - 1:
+            self._ids = itertools.count(1)
+            request_id = next(self._ids)
+        return request_id
+
+    # Connect and log in. Raises OSError if nothing's listening and
+    # RconError if the password is wrong.
+    async def connect(self):
+        self.close()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self._host, self._port, loop=self._loop),
+            self._timeout, loop=self._loop)
+
+        try:
+            request_id = self._next_id()
+            self._writer.write(encode_packet(
+                request_id, TYPE_LOGIN, self._password.encode('utf-8')))
+            while True:
+                response_id, packet_type, _ = await asyncio.wait_for(
+                    read_packet(self._reader), self._timeout,
+                    loop=self._loop)
+                if response_id == -1:
+                    raise RconError("RCON login failed")
+                if response_id == request_id:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.close()
+            raise RconError("RCON login failed")
+        except BaseException:
+            self.close()
+            raise
+
+        self._read_task = self._loop.create_task(self._read())
+
+    # Connect unless already connected. Safe to call from several tasks at
+    # once.
+    async def ensure_connected(self):
+        async with self._connect_lock:
+            if not self.connected:
+                await self.connect()
+
+    def close(self):
+        if self._read_task:
+            self._read_task.cancel()
+            self._read_task = None
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(RconError("RCON connection closed"))
+
+    def _fail_pending(self, exception):
+        for _, future in self._markers.values():
+            if not future.done():
+                future.set_exception(exception)
+        self._markers.clear()
+        self._responses.clear()
+
+    async def _read(self):
+        try:
+            while True:
+                request_id, _, payload = await read_packet(self._reader)
+                if request_id in self._responses:
+                    self._responses[request_id].append(payload)
+                elif request_id in self._markers:
+                    command_id, future = self._markers.pop(request_id)
+                    payloads = self._responses.pop(command_id)
+                    if not future.done():
+                        future.set_result(
+                            b"".join(payloads).decode('utf-8', 'replace'))
+        except (asyncio.IncompleteReadError, ConnectionError, RconError):
+            pass
+        finally:
+            self._fail_pending(RconError("RCON connection lost"))
+
+    # Run a console command and return its output
+    async def command(self, command):
+        if not self.connected:
+            raise RconError("RCON not connected")
+
+        payload = command.encode('utf-8')
+        if len(payload) > MAX_PAYLOAD:
+            raise RconError("Command too long for RCON")
+
+        command_id = self._next_id()
+        marker_id = self._next_id()
+        future = self._loop.create_future()
+        # Nobody may be left waiting for it when it fails (we timed out or
+        # were cancelled), so don't have asyncio complain about that
+        future.add_done_callback(_retrieve_exception)
+        self._responses[command_id] = []
+        self._markers[marker_id] = (command_id, future)
+
+        self._writer.write(encode_packet(command_id, TYPE_COMMAND, payload) +
+                           encode_packet(marker_id, TYPE_MARKER, b""))
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          self._timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            raise RconError("RCON command timed out")
+        finally:
+            # Answered, or no longer wanted
+            self._markers.pop(marker_id, None)
+            self._responses.pop(command_id, None)
+            future.cancel()
+
+
+def usage():
+    print("Usage: {} host port password command...".format(sys.argv[0]))
+
+
+def main():
+    if len(sys.argv) < 5:
+        usage()
+        return
+
+    loop = asyncio.get_event_loop()
+    client = RconClient(loop, sys.argv[1], int(sys.argv[2]), sys.argv[3])
+    loop.run_until_complete(client.connect())
+    print(loop.run_until_complete(client.command(" ".join(sys.argv[4:]))))
+    client.close()
+    loop.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+
+
+# Anvil region files start with a 4 KiB table of chunk locations (3 byte
+# sector offset, 1 byte sector count) followed by a 4 KiB table of chunk
+# timestamps. Each chunk is stored as a 4 byte length, a 1 byte compression
+# type and the compressed data, padded out to a whole number of sectors.
+SECTOR_SIZE = 4096
+HEADER_SIZE = 2 * SECTOR_SIZE
+CHUNKS_PER_REGION = 1024
+
+REGION_EXTENSIONS = (".mca", ".mcr")
+
+MANIFEST_NAME = "manifest.json.gz"
+
+
+# Split a region file into (start, end) spans that together cover the whole
+# file: the two header tables, then for every chunk its payload and its
+# padding, with anything not referenced by the location table as gaps in
+# between. Unchanged chunks produce identical spans from one save to the
+# next, which is what makes them dedup.
+def region_spans(data):
+    if len(data) < HEADER_SIZE:
+        return [(0, len(data))]
+
+    chunks = []
+    for i in range(CHUNKS_PER_REGION):
+        entry = data[i * 4:i * 4 + 4]
+        sector = int.from_bytes(entry[:3], 'big')
+        count = entry[3]
+        if sector == 0 or count == 0:
+            continue
+
+        start = sector * SECTOR_SIZE
+        if start < HEADER_SIZE or start + 5 > len(data):
+            # Bogus entry; whatever is there gets stored as a gap
+            continue
+        end = min(start + count * SECTOR_SIZE, len(data))
+        length, = struct.unpack_from(">I", data, start)
+        payload_end = min(start + 4 + length, end)
+        chunks.append((start, payload_end, end))
+
+    spans = [(0, SECTOR_SIZE), (SECTOR_SIZE, HEADER_SIZE)]
+    pos = HEADER_SIZE
+    for start, payload_end, end in sorted(chunks):
+        if start < pos:
+            # Overlaps the previous chunk, so this file is corrupt. Let the
+            # previous spans and gaps cover it.
+            continue
+        if start > pos:
+            spans.append((pos, start))
+        spans.append((start, payload_end))
+        if end > payload_end:
+            spans.append((payload_end, end))
+        pos = end
+
+    if pos < len(data):
+        spans.append((pos, len(data)))
+
+    return spans
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChunkStore:
+    _root = None
+    _objects = None
+
+    def __init__(self, root):
+        self._root = root
+        self._objects = os.path.join(root, "objects")
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    # Returns the number of bytes written (0 if we already had it)
+    def _put(self, digest, data):
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first so that a crash never leaves a
+        # truncated object behind. The name is our own, as other worker
+        # threads may be storing the same object; whichever replace comes
+        # last wins, with the same contents.
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    # Turn a file into a list of segments, storing any new objects. A segment
+    # is either an object hash or an int meaning that many zero bytes.
+    # Returns (segments, bytes written)
+    def _store_data(self, data, is_region):
+        if is_region:
+            spans = region_spans(data)
+        else:
+            spans = [(0, len(data))]
+
+        segments = []
+        written = 0
+        for start, end in spans:
+            if start == end:
+                continue
+            piece = data[start:end]
+            if not piece.lstrip(b'\x00'):
+                segments.append(len(piece))
+            else:
+                digest = _hash(piece)
+                written += self._put(digest, piece)
+                segments.append(digest)
+
+        return segments, written
+
+    # Store one file. If it looks unchanged compared to its entry in the
+    # previous manifest, reuse that entry without reading the file.
+    # Returns (size, bytes written, manifest entry)
+    def store_file(self, path, prev_entry=None):
+        st = os.stat(path)
+        if (prev_entry and prev_entry["size"] == st.st_size and
+                prev_entry["mtime"] == st.st_mtime_ns):
+            return st.st_size, 0, prev_entry
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        is_region = path.endswith(REGION_EXTENSIONS)
+        segments, written = self._store_data(data, is_region)
+        entry = {
+            "size": len(data),
+            "mtime": st.st_mtime_ns,
+            "segments": segments,
+        }
+        return len(data), written, entry
+
+    def manifest_path(self, name):
+        return os.path.join(self._root, name, MANIFEST_NAME)
+
+    def write_manifest(self, name, manifest):
+        os.makedirs(os.path.join(self._root, name))
+        with gzip.open(self.manifest_path(name), "wt") as f:
+            json.dump(manifest, f, separators=(',', ':'))
+
+    def load_manifest(self, name):
+        try:
+            with gzip.open(self.manifest_path(name), "rt") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # Delete every object not referenced by any of the given snapshots
+    def collect_garbage(self, names):
+        live = set()
+        for name in names:
+            manifest = self.load_manifest(name)
+            if not manifest:
+                continue
+            for entry in manifest["files"].values():
+                live.update(x for x in entry["segments"]
+                            if isinstance(x, str))
+
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self._objects):
+            prefix = os.path.basename(dirpath)
+            for filename in filenames:
+                if prefix + filename in live:
+                    continue
+                path = os.path.join(dirpath, filename)
+                freed += os.path.getsize(path)
+                os.remove(path)
+        return freed
+
+    def _read_object(self, digest):
+        with open(self._object_path(digest), "rb") as f:
+            return f.read()
+
+    # Rebuild the files of snapshot name under dst. If paths is given, only
+    # files at or below those paths (relative to the world) are restored.
+    def restore(self, name, dst, paths=None):
+        manifest = self.load_manifest(name)
+        if manifest is None:
+            raise FileNotFoundError(self.manifest_path(name))
+
+        if paths:
+            paths = [os.path.normpath(x) for x in paths]
+
+        restored = 0
+        for rel_dir in manifest["dirs"]:
+            os.makedirs(os.path.join(dst, rel_dir), exist_ok=True)
+
+        for rel_path, entry in manifest["files"].items():
+            if paths and not any(rel_path == x or
+                                 rel_path.startswith(x + os.sep)
+                                 for x in paths):
+                continue
+
+            out_path = os.path.join(dst, rel_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path, "wb") as f:
+                for segment in entry["segments"]:
+                    if isinstance(segment, int):
+                        f.write(bytes(segment))
+                    else:
+                        f.write(self._read_object(segment))
+            os.utime(out_path, ns=(entry["mtime"], entry["mtime"]))
+            restored += 1
+
+        return restored
+
+    # Check that every object of a snapshot is present and intact
+    def verify(self, name):
+        manifest = self.load_manifest(name)
+        if manifest is None:
+            raise FileNotFoundError(self.manifest_path(name))
+
+        bad = []
+        for rel_path, entry in manifest["files"].items():
+            size = 0
+            for segment in entry["segments"]:
+                if isinstance(segment, int):
+                    size += segment
+                    continue
+                try:
+                    data = self._read_object(segment)
+                except FileNotFoundError:
+                    bad.append(rel_path)
+                    break
+                if _hash(data) != segment:
+                    bad.append(rel_path)
+                    break
+                size += len(data)
+            else:
+                if size != entry["size"]:
+                    bad.append(rel_path)
+        return bad
+
+
+def usage():
+    print("Usage: {} restore backups timestamp dest [path ...]".format(
+        sys.argv[0]))
+    print("       {} verify backups timestamp".format(sys.argv[0]))
+
+
+def main():
+    if len(sys.argv) < 4:
+        usage()
+        return
+
+    store = ChunkStore(sys.argv[2])
+
+    if sys.argv[1] == "restore":
+        if len(sys.argv) < 5:
+            usage()
+            return
+        restored = store.restore(sys.argv[3], sys.argv[4], sys.argv[5:])
+        print("Restored {} files".format(restored))
+
+    elif sys.argv[1] == "verify":
+        bad = store.verify(sys.argv[3])
+        for rel_path in bad:
+            print("BAD: " + rel_path)
+        if not bad:
+            print("Snapshot OK!")
+
+    else:
+        usage()
+
+if __name__ == '__main__':
+    main()
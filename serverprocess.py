@@ -0,0 +1,172 @@
+import asyncio
+import asyncio.streams
+import os
+import signal
+
+
+class _OutputProtocol(asyncio.Protocol):
+    _on_output = None
+    _done = None
+
+    def __init__(self, on_output, done):
+        self._on_output = on_output
+        self._done = done
+
+    def data_received(self, data):
+        self._on_output(data)
+
+    def connection_lost(self, exception):
+        if self._done.done():
+            return
+        if exception:
+            self._done.set_exception(exception)
+        else:
+            self._done.set_result(None)
+
+
+# A server process and its console. We make the console pipes ourselves,
+# rather than have asyncio do it, so that they can be handed over to a new
+# wrapper across exec(): the server stays our child, and the new wrapper
+# attaches to it with the same PID and pipes.
+class ServerProcess:
+    pid = None
+    returncode = None
+    # StreamWriter for the server's console
+    stdin = None
+
+    _loop = None
+    # The asyncio Process, if we started the server
+    _process = None
+    _stdin_fd = None
+    _stdout_fd = None
+    _stdout_transport = None
+    _stdout_done = None
+    _exited = None
+
+    def __init__(self, loop, pid, stdin_fd, stdout_fd):
+        self._loop = loop
+        self.pid = pid
+        self._stdin_fd = stdin_fd
+        self._stdout_fd = stdout_fd
+        self._exited = asyncio.Future(loop=loop)
+
+    @classmethod
+    async def spawn(cls, loop, cmdline, cwd):
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmdline, stdin=stdin_r, stdout=stdout_w, cwd=cwd)
+        except BaseException:
+            os.close(stdin_w)
+            os.close(stdout_r)
+            raise
+        finally:
+            # The server has its own copies of these
+            os.close(stdin_r)
+            os.close(stdout_w)
+
+        self = cls(loop, process.pid, stdin_w, stdout_r)
+        self._process = process
+        loop.create_task(self._wait_process())
+        await self._connect_stdin()
+        return self
+
+    # Take over a server that a previous wrapper started, given the PID and
+    # the console pipe FDs it handed over
+    @classmethod
+    async def attach(cls, loop, pid, stdin_fd, stdout_fd):
+        self = cls(loop, pid, stdin_fd, stdout_fd)
+        asyncio.get_child_watcher().add_child_handler(pid, self._child_exited)
+        await self._connect_stdin()
+        return self
+
+    async def _connect_stdin(self):
+        os.set_inheritable(self._stdin_fd, False)
+        transport, protocol = await self._loop.connect_write_pipe(
+            lambda: asyncio.streams.FlowControlMixin(loop=self._loop),
+            open(self._stdin_fd, "wb", buffering=0, closefd=False))
+        self.stdin = asyncio.StreamWriter(transport, protocol, None,
+                                          self._loop)
+
+    async def _wait_process(self):
+        self._set_returncode(await self._process.wait())
+
+    # Called by the child watcher, possibly from another thread
+    def _child_exited(self, pid, returncode):
+        self._loop.call_soon_threadsafe(self._set_returncode, returncode)
+
+    def _set_returncode(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+            self._exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._exited, loop=self._loop)
+
+    def send_signal(self, sig):
+        if self.returncode is not None:
+            raise ProcessLookupError()
+        if self._process:
+            self._process.send_signal(sig)
+        else:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    # Whether read_stdout() is running
+    @property
+    def reading(self):
+        return self._stdout_transport is not None
+
+    # Pass everything the server prints to on_output(data) as it arrives,
+    # until its stdout closes or detach() is called. Nothing is buffered
+    # between the pipe and on_output, so there is nothing to lose when the
+    # pipe is handed over.
+    async def read_stdout(self, on_output):
+        os.set_inheritable(self._stdout_fd, False)
+        self._stdout_done = asyncio.Future(loop=self._loop)
+        self._stdout_transport, _ = await self._loop.connect_read_pipe(
+            lambda: _OutputProtocol(on_output, self._stdout_done),
+            open(self._stdout_fd, "rb", buffering=0, closefd=False))
+        try:
+            await self._stdout_done
+        finally:
+            self._stdout_transport.close()
+            self._stdout_transport = None
+
+    # Stop using the console so that it can be handed over. Anything still
+    # to be written to stdin should have been flushed first. Returns the
+    # (stdin, stdout) FDs, now inheritable across exec().
+    def detach(self):
+        if self._stdout_transport:
+            self._stdout_transport.pause_reading()
+        if self._stdout_done and not self._stdout_done.done():
+            self._stdout_done.set_result(None)
+        if self.stdin:
+            self.stdin.transport.abort()
+            self.stdin = None
+
+        os.set_inheritable(self._stdin_fd, True)
+        os.set_inheritable(self._stdout_fd, True)
+        return self._stdin_fd, self._stdout_fd
+
+    # Go back to using the console after detach(), e.g. if the handover
+    # failed
+    async def reattach(self):
+        await self._connect_stdin()
+
+    # Once the server has exited
+    def close(self):
+        if self.stdin:
+            self.stdin.transport.close()
+            self.stdin = None
+        for fd in (self._stdin_fd, self._stdout_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
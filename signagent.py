@@ -0,0 +1,410 @@
+import asyncio
+import binascii
+import collections
+import json
+import os
+import re
+import time
+
+import ircclient
+
+
+# Don't use a nonce we've had this long (seconds); the wrapper forgets them
+# after nonce_ttl, 300 by default
+NONCE_MAX_AGE = 240
+# Most nonces to ask for ahead of time. The wrapper keeps nonce_pool_size (8
+# by default) per user and drops the oldest, so leave room for other
+# sessions.
+NONCE_PREFETCH = 4
+NONCE_RE = re.compile("^[0-9a-f]{32}$")
+
+# IRC lines are at most 512 bytes, including the "!nick" and the server's
+# prefix when relayed, and anything past that is cut off. Keep signed
+# messages ("<signature> <command>") well short of it.
+MAX_MESSAGE = 400
+# Base64, without padding
+SIGNATURE_LENGTH = 86
+
+
+# What gets signed for a command: "!" or "!!", the nonce, then the command
+# as sent (including any "@server")
+def signed_bytes(is_special, nonce, command):
+    prefix = b'\x00' if not is_special else b'\x01'
+    return prefix + nonce + command.encode('utf-8')
+
+
+# The command that runs console commands (lines, blank ones and "#"
+# comments skipped) one after the other, or None if there are none.
+# ValueError if it wouldn't fit on an IRC line once signed; it can't be
+# split up, since batches sent separately might run at the same time.
+def batch_command(lines, server=None):
+    commands = [line.strip() for line in lines
+                if line.strip() and line.strip()[:1] != "#"]
+    if not commands:
+        return None
+
+    command = "batch " + json.dumps(commands, ensure_ascii=False,
+                                    separators=(",", ":"))
+    if server:
+        command = server + " " + command
+    size = SIGNATURE_LENGTH + 1 + len(command.encode('utf-8'))
+    if size > MAX_MESSAGE:
+        raise ValueError("Batch of {} commands is {} bytes signed, more than "
+                         "the {} allowed on one IRC line; split it "
+                         "up".format(len(commands), size, MAX_MESSAGE))
+    return command
+
+
+# Holds the signing key so that signing a command doesn't mean starting
+# signtool and reading the secret again. Listens on a Unix socket that only
+# we can use. Each request is a line, "!|!! <nonce hex> <command>", and the
+# answer is a line with the base64 signature or "ERROR <why>". "vk" asks for
+# the verifying key.
+class SigningAgent:
+    _sk = None
+    _loop = None
+    _path = None
+    _server = None
+
+    def __init__(self, sk, loop, path):
+        self._sk = sk
+        self._loop = loop
+        self._path = path
+
+    async def start(self):
+        if os.path.exists(self._path):
+            try:
+                _, writer = await asyncio.open_unix_connection(
+                    self._path, loop=self._loop)
+                writer.close()
+                raise RuntimeError("An agent is already running on " +
+                                   self._path)
+            except ConnectionError:
+                # Left over from an agent that's gone
+                os.remove(self._path)
+
+        # Only for us
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._client_connected, self._path, loop=self._loop)
+        finally:
+            os.umask(umask)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+            os.remove(self._path)
+
+    def handle(self, request):
+        if request == "vk":
+            return self._sk.get_verifying_key().to_ascii(
+                encoding='base64').decode('ascii')
+
+        parts = request.split(" ", 2)
+        if len(parts) != 3 or parts[0] not in ("!", "!!"):
+            return "ERROR Bad request"
+        try:
+            nonce = binascii.unhexlify(parts[1])
+        except (binascii.Error, ValueError):
+            return "ERROR Bad nonce"
+
+        return self._sk.sign(signed_bytes(parts[0] == "!!", nonce, parts[2]),
+                             encoding='base64').decode('ascii')
+
+    async def _client_connected(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                answer = self.handle(line.decode('utf-8', 'replace')
+                                     .rstrip("\r\n"))
+                writer.write(answer.encode('utf-8') + b"\n")
+        except (ConnectionError, ValueError):
+            # ValueError: a line too long to be a request
+            pass
+        finally:
+            writer.close()
+
+
+# Talks to a SigningAgent, one request at a time
+class AgentClient:
+    _loop = None
+    _path = None
+    _reader = None
+    _writer = None
+
+    def __init__(self, loop, path):
+        self._loop = loop
+        self._path = path
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self._path, loop=self._loop)
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _request(self, request):
+        self._writer.write(request.encode('utf-8') + b"\n")
+        answer = (await self._reader.readline()).decode('utf-8')
+        if not answer:
+            raise ConnectionError("Signing agent went away")
+        answer = answer.rstrip("\n")
+        if answer[:6] == "ERROR ":
+            raise ValueError(answer[6:])
+        return answer
+
+    async def verifying_key(self):
+        return await self._request("vk")
+
+    async def sign(self, is_special, nonce, command):
+        if "\n" in command or "\r" in command:
+            raise ValueError("Command can't have line breaks")
+        return await self._request("{} {} {}".format(
+            "!!" if is_special else "!",
+            binascii.hexlify(nonce).decode('ascii'), command))
+
+
+# An IRC client for running commands on the wrapper. It asks the bot for
+# nonces (a few ahead, from the pool each user gets), has the agent sign
+# each command and prints whatever the bot says.
+#
+# Lines it runs, from a script or typed in:
+#   !cmd, !!cmd or just cmd      a command, "@server cmd" to pick a server
+#   .batch file [@server]        console commands from a file, as one batch
+#   .sleep seconds
+#   .quit
+# Blank lines and "#" comments are skipped.
+class AdminClient:
+    _config = None
+    _loop = None
+    _agent = None
+    _bottom = None
+    _nick = None
+    _bot_nick = None
+    _channel = None
+    _connected = False
+    _joined = None
+    # (nonce, when we got it), oldest first
+    _nonces = None
+    _nonce_ready = None
+    # Asked for and not yet received
+    _requested = 0
+    # When we last sent a command or heard from the bot
+    _last_activity = 0
+
+    def __init__(self, config, loop, agent):
+        self._config = config
+        self._loop = loop
+        self._agent = agent
+        self._nick = config["irc_nick"]
+        self._bot_nick = config["bot_nick"]
+        self._channel = config["irc_channel"]
+        self._joined = asyncio.Event(loop=loop)
+        self._nonces = collections.deque()
+        self._nonce_ready = asyncio.Event(loop=loop)
+
+        self._bottom = ircclient.Client(host=config["irc_server"],
+                                        port=config["irc_port"],
+                                        ssl=config.get("irc_ssl", False))
+        self.register_irc_handlers()
+
+    def register_irc_handlers(self):
+        @self._bottom.on('PING')
+        def keepalive(message, **kwargs):
+            self._bottom.send('PONG', message=message)
+
+        @self._bottom.on('CLIENT_DISCONNECT')
+        def irc_disconnect(**kwargs):
+            self._connected = False
+
+        @self._bottom.on('JOIN')
+        def irc_join(nick, channel, **kwargs):
+            if (nick == self._nick and
+                    channel.lower() == self._channel.lower()):
+                self._joined.set()
+
+        @self._bottom.on('NOTICE')
+        @self._bottom.on('PRIVMSG')
+        def irc_message(target, message, nick=None, **kwargs):
+            if nick is None or nick.lower() != self._bot_nick.lower():
+                return
+            if target == self._nick and NONCE_RE.match(message):
+                self.nonce_received(binascii.unhexlify(message))
+                return
+            self._last_activity = time.monotonic()
+            print(message)
+
+    async def connect(self):
+        print("Connecting to {}:{}...".format(self._config["irc_server"],
+                                             self._config["irc_port"]))
+        await asyncio.wait_for(self._bottom.connect(),
+                               self._config.get("irc_connect_timeout", 30),
+                               loop=self._loop)
+        self._connected = True
+        if self._config.get("irc_password"):
+            self._bottom.send('PASS', password=self._config["irc_password"])
+        self._bottom.send('NICK', nick=self._nick)
+        self._bottom.send('USER', user=self._nick, realname=self._nick)
+
+        nick_taken = asyncio.ensure_future(
+            self._bottom.wait("ERR_NICKNAMEINUSE"), loop=self._loop)
+        done, pending = await asyncio.wait(
+            [self._bottom.wait("RPL_ENDOFMOTD"),
+             self._bottom.wait("ERR_NOMOTD"),
+             nick_taken],
+            loop=self._loop,
+            timeout=self._config.get("irc_register_timeout", 60),
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        for future in pending:
+            future.cancel()
+        if not done:
+            raise asyncio.TimeoutError("No MOTD")
+        if nick_taken in done:
+            # The bot knows us by nick, so another one won't do
+            raise ConnectionError("Nick {} is taken".format(self._nick))
+
+        self._bottom.send('JOIN', channel=self._channel)
+        await asyncio.wait_for(self._joined.wait(),
+                               self._config.get("irc_join_timeout", 30),
+                               loop=self._loop)
+        print("Joined {}".format(self._channel))
+
+    async def disconnect(self):
+        if self._connected:
+            self._bottom.send('QUIT', message="Done")
+            await self._bottom.disconnect()
+
+    def nonce_received(self, nonce):
+        self._requested = max(0, self._requested - 1)
+        self._nonces.append((nonce, time.monotonic()))
+        self._nonce_ready.set()
+
+    # Ask for nonces so that there are count of them on hand or on the way
+    def prefetch(self, count):
+        count = min(count, NONCE_PREFETCH)
+        while len(self._nonces) + self._requested < count:
+            self._bottom.send('PRIVMSG', target=self._bot_nick,
+                              message="!{} - nonce".format(self._bot_nick))
+            self._requested += 1
+
+    async def nonce(self):
+        while True:
+            now = time.monotonic()
+            while (self._nonces and
+                   self._nonces[0][1] < now - NONCE_MAX_AGE):
+                self._nonces.popleft()
+            if self._nonces:
+                return self._nonces.popleft()[0]
+
+            self.prefetch(1)
+            self._nonce_ready.clear()
+            try:
+                await asyncio.wait_for(
+                    self._nonce_ready.wait(),
+                    self._config.get("nonce_timeout", 30), loop=self._loop)
+            except asyncio.TimeoutError:
+                # Not coming; ask again next time
+                self._requested = 0
+                raise RuntimeError("No nonce from " + self._bot_nick)
+
+    async def run(self, is_special, command):
+        nonce = await self.nonce()
+        sig = await self._agent.sign(is_special, nonce, command)
+        self._bottom.send('PRIVMSG', target=self._channel,
+                          message="{}{} {} {}".format(
+                              "!!" if is_special else "!", self._bot_nick,
+                              sig, command))
+        self._last_activity = time.monotonic()
+
+    # Run a line (see above). ahead is how many commands are likely to
+    # follow, counting this one, to fetch nonces for. False on .quit.
+    async def execute(self, line, ahead=1):
+        line = line.strip()
+        if not line or line[:1] == "#":
+            return True
+
+        if line[:1] == ".":
+            args = line[1:].split()
+            if args[0] == "quit":
+                return False
+            elif args[0] == "sleep" and len(args) == 2:
+                await asyncio.sleep(float(args[1]))
+            elif args[0] == "batch" and len(args) in (2, 3):
+                with open(args[1], "r", encoding='utf-8') as f:
+                    command = batch_command(
+                        f.readlines(), args[2] if len(args) == 3 else None)
+                if command is None:
+                    raise ValueError("No commands in " + args[1])
+                self.prefetch(ahead)
+                await self.run(False, command)
+            else:
+                raise ValueError("Unknown: " + line)
+            return True
+
+        if line[:2] == "!!":
+            is_special, command = True, line[2:]
+        elif line[:1] == "!":
+            is_special, command = False, line[1:]
+        else:
+            is_special, command = False, line
+        self.prefetch(ahead)
+        await self.run(is_special, command.strip())
+        return True
+
+    # Wait until the bot's been quiet for a while, so that the replies to
+    # the last commands get printed
+    async def settle(self):
+        wait = self._config.get("reply_wait", 2)
+        while True:
+            idle = time.monotonic() - self._last_activity
+            if idle >= wait:
+                return
+            await asyncio.sleep(wait - idle)
+
+    async def run_script(self, lines):
+        for i, line in enumerate(lines):
+            if not await self.execute(line, len(lines) - i):
+                break
+        await self.settle()
+
+    def _read_line(self):
+        try:
+            return input("> ") + "\n"
+        except EOFError:
+            return ""
+
+    async def repl(self):
+        while True:
+            line = await self._loop.run_in_executor(None, self._read_line)
+            if not line:
+                break
+            try:
+                if not await self.execute(line, 2):
+                    break
+            except (OSError, RuntimeError, ValueError) as e:
+                print("ERROR: {}".format(e))
+                if not self._connected:
+                    break
+        await self.settle()
+
+    # Run lines from a script, or from the terminal if there's no script
+    async def main(self, lines=None):
+        await self._agent.connect()
+        print("Signing with {}".format(await self._agent.verifying_key()))
+        await self.connect()
+        try:
+            if lines is None:
+                await self.repl()
+            else:
+                await self.run_script(lines)
+        finally:
+            self._agent.close()
+            await self.disconnect()
+
@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 
+import asyncio
 import binascii
 import ed25519
+import json
+import signal
 import sys
 
+import signagent
+
 
 def usage():
     print("Usage: {} vk secret.bin".format(sys.argv[0]))
     print("       {} sign secret.bin nonce !|!! 'args'".format(sys.argv[0]))
+    print("       {} sign-batch secret.bin nonce [@server] [commands.txt]"
+          .format(sys.argv[0]))
     print("       {} verify vk sig nonce !|!! 'args'".format(sys.argv[0]))
+    print("       {} agent secret.bin agent.sock".format(sys.argv[0]))
+    print("       {} client client.json agent.sock [script|-]"
+          .format(sys.argv[0]))
+
+
+# None if the secret is no good
+def load_signing_key(path):
+    with open(path, "rb") as f:
+        secret = f.read()
+    if len(secret) != 32:
+        print("ERROR: Secret must be 32 bytes!")
+        return None
+    return ed25519.SigningKey(secret)
 
 
 def main():
@@ -18,49 +38,67 @@ def main():
 
     if sys.argv[1] == "vk":
         # Generate verify key
-        with open(sys.argv[2], "rb") as f:
-            secret = f.read()
-        if len(secret) != 32:
-            print("ERROR: Secret must be 32 bytes!")
+        sk = load_signing_key(sys.argv[2])
+        if not sk:
             return
 
-        sk = ed25519.SigningKey(secret)
         vk = sk.get_verifying_key()
         print(vk.to_ascii(encoding='base64').decode('ascii'))
 
     elif sys.argv[1] == "sign":
         # Sign a command
-        with open(sys.argv[2], "rb") as f:
-            secret = f.read()
-        if len(secret) != 32:
-            print("ERROR: Secret must be 32 bytes!")
+        sk = load_signing_key(sys.argv[2])
+        if not sk:
             return
 
-        sk = ed25519.SigningKey(secret)
-
-        is_special = sys.argv[4] == "!!"
-        bytes_to_sign = b'\x00' if not is_special else b'\x01'
+        bytes_to_sign = signagent.signed_bytes(
+            sys.argv[4] == "!!", binascii.unhexlify(sys.argv[3]),
+            sys.argv[5])
+        sig = sk.sign(bytes_to_sign, encoding='base64').decode('ascii')
+        print(sig)
 
-        # Nonce
+    elif sys.argv[1] == "sign-batch":
+        # Sign a batch of console commands, one per line, from a file or
+        # stdin. Prints what to send after "!<nick> ".
+        if len(sys.argv) < 4:
+            usage()
+            return
+        sk = load_signing_key(sys.argv[2])
+        if not sk:
+            return
         nonce = binascii.unhexlify(sys.argv[3])
-        bytes_to_sign += nonce
 
-        bytes_to_sign += sys.argv[5].encode('utf-8')
+        args = sys.argv[4:]
+        server = None
+        if args and args[0][:1] == "@":
+            server = args.pop(0)
+        if args and args[0] != "-":
+            with open(args[0], "r", encoding='utf-8') as f:
+                lines = f.readlines()
+        else:
+            lines = sys.stdin.readlines()
+
+        # Blank lines and "#" comments are skipped
+        try:
+            command = signagent.batch_command(lines, server)
+        except ValueError as e:
+            print("ERROR: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        if command is None:
+            print("ERROR: No commands!")
+            return
+
+        bytes_to_sign = signagent.signed_bytes(False, nonce, command)
         sig = sk.sign(bytes_to_sign, encoding='base64').decode('ascii')
-        print(sig)
+        print(sig + " " + command)
 
     elif sys.argv[1] == "verify":
         # Verify a command
         vk = ed25519.VerifyingKey(sys.argv[2], encoding='base64')
 
-        is_special = sys.argv[5] == "!!"
-        bytes_to_sign = b'\x00' if not is_special else b'\x01'
-
-        # Nonce
-        nonce = binascii.unhexlify(sys.argv[4])
-        bytes_to_sign += nonce
-
-        bytes_to_sign += sys.argv[6].encode('utf-8')
+        bytes_to_sign = signagent.signed_bytes(
+            sys.argv[5] == "!!", binascii.unhexlify(sys.argv[4]),
+            sys.argv[6])
 
         try:
             vk.verify(sys.argv[3], bytes_to_sign, encoding='base64')
@@ -68,6 +106,58 @@ def main():
         except ed25519.BadSignatureError:
             print("Signature invalid!")
 
+    elif sys.argv[1] == "agent":
+        # Keep the key in memory and sign for clients on a Unix socket
+        if len(sys.argv) < 4:
+            usage()
+            return
+        sk = load_signing_key(sys.argv[2])
+        if not sk:
+            return
+
+        loop = asyncio.get_event_loop()
+        agent = signagent.SigningAgent(sk, loop, sys.argv[3])
+        try:
+            loop.run_until_complete(agent.start())
+        except (OSError, RuntimeError) as e:
+            print("ERROR: {}".format(e))
+            return
+        print("Agent listening on {}".format(sys.argv[3]))
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, loop.stop)
+        loop.run_forever()
+        agent.close()
+        loop.close()
+
+    elif sys.argv[1] == "client":
+        # Run commands over IRC, signed by the agent, from a script (or
+        # stdin) or typed in
+        if len(sys.argv) < 4:
+            usage()
+            return
+        with open(sys.argv[2], "r") as f:
+            config = json.load(f)
+
+        script = sys.argv[4] if len(sys.argv) > 4 else None
+        if script == "-" or (script is None and not sys.stdin.isatty()):
+            lines = sys.stdin.readlines()
+        elif script is not None:
+            with open(script, "r", encoding='utf-8') as f:
+                lines = f.readlines()
+        else:
+            lines = None
+
+        loop = asyncio.get_event_loop()
+        client = signagent.AdminClient(
+            config, loop, signagent.AgentClient(loop, sys.argv[3]))
+        try:
+            loop.run_until_complete(client.main(lines))
+        except (OSError, RuntimeError, ValueError,
+                asyncio.TimeoutError) as e:
+            print("ERROR: {}".format(e))
+        loop.close()
+
     else:
         usage()
 
@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import json
+import time
+
+
+PRIORITY_ADMIN = 0
+PRIORITY_CHAT = 1
+
+# Don't build tellraw commands much longer than this out of merged chat
+MAX_MERGED_LENGTH = 16384
+
+
+# Console commands waiting to be written to the server's stdin. A single
+# writer feeds the pipe and waits for it to drain after every write, so a
+# slow server makes this queue grow instead of the transport's buffer, and
+# the queue itself is bounded. Admin (and backup) commands always go ahead of
+# chat. Chat that is queued up behind each other as tellraw is merged into
+# one tellraw so the server has fewer commands to run.
+class StdinQueue:
+    _loop = None
+    _max_depth = None
+    _queues = None
+    _wakeup = None
+    _on_written = None
+
+    dropped = 0
+    merged = 0
+
+    # on_written(seconds) is called for every chat message with how long it
+    # waited, once it has been written
+    def __init__(self, loop, max_depth=200, on_written=None):
+        self._loop = loop
+        self._on_written = on_written
+        self._max_depth = max_depth
+        self._queues = [collections.deque()
+                        for _ in range(PRIORITY_CHAT + 1)]
+        self._wakeup = asyncio.Event(loop=loop)
+
+    def put(self, command, priority=PRIORITY_ADMIN):
+        self._put(priority, command, None)
+
+    # Queue chat as a tellraw to everyone. component is the JSON text
+    # component (e.g. a list of fragments).
+    def put_tellraw(self, component):
+        self._put(PRIORITY_CHAT, None, json.dumps(component))
+
+    def _put(self, priority, command, component_json):
+        queue = self._queues[priority]
+        if priority != PRIORITY_ADMIN and len(queue) >= self._max_depth:
+            # Server can't keep up; old chat is worth the least
+            queue.popleft()
+            self.dropped += 1
+        queue.append((command, component_json, time.monotonic()))
+        self._wakeup.set()
+
+    def depth(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def clear(self):
+        for queue in self._queues:
+            queue.clear()
+
+    # What's queued, JSON-friendly, for restore() to put back (in another
+    # wrapper, after a handover)
+    def save(self):
+        return [[priority, command, component_json, queued_at]
+                for priority, queue in enumerate(self._queues)
+                for command, component_json, queued_at in queue]
+
+    def restore(self, saved):
+        for priority, command, component_json, queued_at in saved:
+            self._queues[priority].append(
+                (command, component_json, queued_at))
+        if saved:
+            self._wakeup.set()
+
+    # Returns the next command to write and when each chat message in it
+    # was queued
+    def _pop(self):
+        for priority, queue in enumerate(self._queues):
+            if not queue:
+                continue
+
+            command, component_json, queued_at = queue.popleft()
+            if component_json is None:
+                if priority == PRIORITY_ADMIN:
+                    return command, []
+                return command, [queued_at]
+
+            # Merge any tellraws that are right behind this one. The empty
+            # string goes first so nothing inherits the first message's
+            # formatting.
+            components = [component_json]
+            queued_times = [queued_at]
+            length = len(component_json)
+            while queue and queue[0][1] is not None:
+                length += len(queue[0][1])
+                if length > MAX_MERGED_LENGTH:
+                    break
+                _, component_json, queued_at = queue.popleft()
+                components.append(component_json)
+                queued_times.append(queued_at)
+                self.merged += 1
+
+            if len(components) == 1:
+                return "/tellraw @a " + components[0], queued_times
+            return ('/tellraw @a ["",' + ',"\\n",'.join(components) + ']',
+                    queued_times)
+        return None, None
+
+    # Write queued commands to stdin (a StreamWriter) until cancelled or the
+    # pipe breaks
+    async def run(self, stdin):
+        while True:
+            command, queued_times = self._pop()
+            if command is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            try:
+                stdin.write((command + "\n").encode('utf-8'))
+                await stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+            if self._on_written:
+                now = time.monotonic()
+                for queued_at in queued_times:
+                    self._on_written(now - queued_at)
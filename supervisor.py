@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import time
+
+
+# How long to wait before restarting a server that died. Doubles after each
+# crash, up to maximum, and starts over once the server has stayed up for
+# reset_after seconds.
+class RestartBackoff:
+    _initial = None
+    _maximum = None
+    _reset_after = None
+    _delay = None
+
+    def __init__(self, initial=5, maximum=300, reset_after=600):
+        self._initial = initial
+        self._maximum = maximum
+        self._reset_after = reset_after
+        self._delay = initial
+
+    # uptime is how long the server ran before it went down
+    def next_delay(self, uptime):
+        if uptime >= self._reset_after:
+            self._delay = self._initial
+        delay = self._delay
+        self._delay = min(self._delay * 2, self._maximum)
+        return delay
+
+    def reset(self):
+        self._delay = self._initial
+
+
+# Decides when a running server is hung. It is hung if it has printed
+# nothing for silence seconds, and still nothing for probe_timeout seconds
+# after we poke it with a command that always prints something. It is also
+# hung after lag_warnings "Can't keep up!" lines within lag_window seconds.
+class Watchdog:
+    PROBE_COMMAND = "list"
+
+    _silence = None
+    _probe_timeout = None
+    _lag_warnings = None
+    _lag_window = None
+    _last_output = None
+    _probed_at = None
+    _lag_times = None
+
+    def __init__(self, silence=300, probe_timeout=30, lag_warnings=10,
+                 lag_window=300):
+        self._silence = silence
+        self._probe_timeout = probe_timeout
+        self._lag_warnings = lag_warnings
+        self._lag_window = lag_window
+        self._lag_times = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self._last_output = time.monotonic()
+        self._probed_at = None
+        self._lag_times.clear()
+
+    def output_seen(self):
+        self._last_output = time.monotonic()
+        self._probed_at = None
+
+    def lag_warning(self):
+        self._lag_times.append(time.monotonic())
+
+    # Called every so often. send(command) writes to the server's console.
+    # Returns why the server looks hung, or None.
+    def check(self, send):
+        now = time.monotonic()
+
+        while self._lag_times and self._lag_times[0] < now - self._lag_window:
+            self._lag_times.popleft()
+        if self._lag_warnings and len(self._lag_times) >= self._lag_warnings:
+            return "{} lag warnings in {}s".format(len(self._lag_times),
+                                                   self._lag_window)
+
+        if not self._silence:
+            return None
+        if self._probed_at is not None:
+            if now - self._probed_at >= self._probe_timeout:
+                return "no output for {:.0f}s".format(now - self._last_output)
+        elif now - self._last_output >= self._silence:
+            send(self.PROBE_COMMAND)
+            self._probed_at = now
+        return None
+
+
+# Stop a server process, asking nicely first: send(stop_command), then
+# SIGTERM after stop_timeout seconds, then SIGKILL after another
+# term_timeout seconds. Returns the exit code.
+async def stop_process(loop, process, send, stop_command="stop",
+                       stop_timeout=60, term_timeout=30):
+    steps = [(lambda: send(stop_command), stop_timeout),
+             (process.terminate, term_timeout)]
+    for step, timeout in steps:
+        if process.returncode is not None:
+            break
+        try:
+            step()
+        except ProcessLookupError:
+            break
+        try:
+            return await asyncio.wait_for(process.wait(), timeout, loop=loop)
+        except asyncio.TimeoutError:
+            pass
+
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    return await process.wait()